@@ -0,0 +1,141 @@
+"""
+Benchmark da deteção de codificação (codificacao.descodificar).
+
+Gera ficheiros CSV sintéticos (NC APIFARMA/PAYBACK) em UTF-8, UTF-8
+com BOM, UTF-16 e cp1252, e compara o
+custo por ficheiro dos ciclos anteriores (descodificar o ficheiro todo
+com cada codificação até uma não falhar) com a deteção pelo BOM/prefixo
+seguida de uma única descodificação, e verifica se cada um devolve o
+texto original (os ciclos anteriores aceitavam, p.ex., UTF-8 de
+comprimento par como UTF-16; cp1252 lido como latin-1 continua a ser a
+alternativa de quem já a usava). Escreve um relatório JSON em
+benchmarks/resultados/.
+
+Uso:
+    python benchmarks/benchmark_codificacao.py
+    python benchmarks/benchmark_codificacao.py --mb 1 20 --repeticoes 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+from codificacao import descodificar  # noqa: E402
+
+PASTA_RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+
+
+# ============================================================
+# 1. Ficheiros sintéticos
+# ============================================================
+
+def gerar_texto(rng: random.Random, tamanho: int) -> str:
+    empresas = ["ABBVIE, LDA.", "ROCHE FARMACÊUTICA QUÍMICA, LDA.", "Théa Portugal, SA", "LABORATÓRIOS PFIZER, LDA."]
+    linhas = ["Data;Empresa;Instituição;Tipo;N.º / Ref.ª;Valor (com IVA)"]
+    total = len(linhas[0])
+    while total < tamanho:
+        linha = (
+            f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2025;{rng.choice(empresas)};"
+            f"ULS Sintética;Nota de Crédito;NC {rng.randint(1, 99999)};{rng.randint(1, 99999)},{rng.randint(0, 99):02d} €"
+        )
+        linhas.append(linha)
+        total += len(linha) + 2
+    return "\r\n".join(linhas)
+
+
+# ============================================================
+# 2. Leitores anteriores (referência)
+# ============================================================
+
+def _ciclo(codificacoes: List[str]) -> Callable[[bytes], str]:
+    def ler(dados: bytes) -> str:
+        for enc in codificacoes:
+            try:
+                texto = dados.decode(enc)
+                return texto[1:] if texto.startswith("﻿") else texto
+            except UnicodeDecodeError:
+                continue
+        raise ValueError("sem codificação")
+    return ler
+
+
+LEITORES_ANTERIORES = {
+    # ler_notas_credito (PAYBACK / APIFARMA)
+    "nc": (_ciclo(["utf-16", "utf-16-le", "utf-16-be", "utf-8", "utf-8-sig", "latin-1"]), ("latin-1",)),
+    # mapeamentos_CCM / ler_dmr_txt
+    "ccm_dmr": (_ciclo(["utf-8-sig", "utf-8", "latin-1"]), ("latin-1",)),
+    # descodificar_csv (Confere_ATIVOS) / vencimentos
+    "ativos": (_ciclo(["utf-8-sig", "cp1252", "latin1"]), ("cp1252", "latin1")),
+}
+
+
+# ============================================================
+# 3. Medição e relatório
+# ============================================================
+
+def _medir(funcao: Callable[[bytes], object], dados: bytes, repeticoes: int) -> float:
+    melhor = float("inf")
+    for _ in range(repeticoes):
+        t0 = time.perf_counter()
+        funcao(dados)
+        melhor = min(melhor, time.perf_counter() - t0)
+    return melhor * 1000
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark da deteção de codificação.")
+    parser.add_argument("--mb", type=float, nargs="*", default=[1, 10])
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--semente", type=int, default=2025)
+    parser.add_argument("--saida", default=PASTA_RESULTADOS)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.semente)
+    relatorio: Dict = {"meta": {"data": datetime.now().isoformat(timespec="seconds")}, "casos": []}
+
+    print(f"{'MB':>5} {'codificação':>12} {'leitor':>8} {'anterior ms':>12} {'novo ms':>9} {'ganho':>7}  {'anterior':>8} {'novo':>5}  (texto correto)")
+    for mb in args.mb:
+        texto = gerar_texto(rng, int(mb * 1024 * 1024))
+        for codificacao in ("utf-8", "utf-8-sig", "utf-16", "cp1252"):
+            dados = texto.encode(codificacao)
+            for leitor, (anterior, alternativas) in LEITORES_ANTERIORES.items():
+                try:
+                    anterior_ok = anterior(dados) == texto
+                except ValueError:
+                    anterior_ok = False
+                novo_ok = descodificar(dados, alternativas)[0] == texto
+                ms_ant = _medir(anterior, dados, args.repeticoes)
+                ms_novo = _medir(lambda d: descodificar(d, alternativas), dados, args.repeticoes)
+                relatorio["casos"].append({
+                    "mb": mb,
+                    "codificacao": codificacao,
+                    "leitor": leitor,
+                    "anterior_ms": ms_ant,
+                    "novo_ms": ms_novo,
+                    "anterior_correto": anterior_ok,
+                    "novo_correto": novo_ok,
+                })
+                print(
+                    f"{mb:>5g} {codificacao:>12} {leitor:>8} {ms_ant:>12.1f} {ms_novo:>9.1f} "
+                    f"{ms_ant / ms_novo:>6.1f}x  {'sim' if anterior_ok else 'NÃO':>8} {'sim' if novo_ok else 'NÃO':>5}"
+                )
+
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"codificacao_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(caminho, "w", encoding="utf-8") as fh:
+        json.dump(relatorio, fh, indent=1, ensure_ascii=False)
+    print(f"\nRelatório: {caminho}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark da conversão MCDT / Termas / medicamentos (conversor_mcdt).
+
+Gera ficheiros sintéticos de largura fixa (702, 902-906, com "+93  ",
+coluna 12 a "0", NIF final, convenções com e sem mapeamento e algumas
+linhas irregulares) e compara o ciclo anterior da página (transform_line
+linha a linha) com a conversão em lote (transform_text) e com a procura
+só das convenções em falta (scan_missing_conventions): linhas por
+segundo e igualdade byte a byte do resultado e das convenções em falta.
+Escreve um relatório JSON em benchmarks/resultados/.
+
+Uso:
+    python benchmarks/benchmark_mcdt.py
+    python benchmarks/benchmark_mcdt.py --linhas 10000 200000 1000000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+from conversor_mcdt import (  # noqa: E402
+    group_missing,
+    guess_default_eol,
+    scan_missing_conventions,
+    split_keep_eol,
+    transform_line,
+    transform_text,
+)
+
+PASTA_RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+
+LARGURA = 110
+
+
+# ============================================================
+# 1. Ficheiros sintéticos
+# ============================================================
+
+def gerar_mapeamento(rng: random.Random, n: int = 540) -> Tuple[Dict[str, str], List[str]]:
+    convencoes = [f"{rng.randint(0, 999999):06d}" for _ in range(n)]
+    # ~4% das convenções ficam sem mapeamento
+    mapeamento = {c: str(rng.randint(9800000, 9899999)) for c in convencoes[: int(n * 0.96)]}
+    mapeamento[convencoes[0]] = "0012345"  # entidade com zero à esquerda (903/904/906)
+    return mapeamento, convencoes
+
+
+def gerar_texto(rng: random.Random, n_linhas: int, convencoes: List[str]) -> str:
+    linhas = []
+    for i in range(n_linhas):
+        codigo = rng.choice(["702", "702", "902", "903", "904", "906"])
+        conv = rng.choice(convencoes)
+        token2 = ("" if codigo == "702" else "0") + conv + f"{rng.randint(0, 10 ** 8 - 1):08d}"
+        linha = (
+            f"{codigo}2025{rng.randint(1, 12):02d}{rng.randint(0, 9)}0 {token2}   "
+            f"{rng.choice(['+93  ', '+9197', '     '])} UN {rng.randint(1, 9999)},{rng.randint(0, 99):02d} "
+            f"{rng.randint(10 ** 8, 10 ** 9 - 1)}"
+        ).ljust(LARGURA)[:LARGURA]
+        if i % 997 == 0:
+            linha = linha.replace("UN", "ÚN")      # acentos: caminho linha a linha
+        if i % 1999 == 0:
+            linha = ""
+        linhas.append(linha)
+    return "\r\n".join(linhas) + "\r\n"
+
+
+# ============================================================
+# 2. Conversão anterior (referência: ciclo da página)
+# ============================================================
+
+def converter_linha_a_linha(text: str, mapping: Dict[str, str]) -> Tuple[bytes, List[Tuple[int, str]]]:
+    processed = []
+    missing = []
+    for i, (line_body, eol) in enumerate(split_keep_eol(text)):
+        if not line_body.strip():
+            processed.append(line_body + eol)
+            continue
+        new_line, missing_code = transform_line(line_body, mapping)
+        if missing_code:
+            missing.append((i, missing_code))
+        processed.append(new_line + eol)
+
+    output = "".join(processed)
+    if not output.endswith(("\n", "\r\n", "\r")):
+        output += guess_default_eol(text)
+    return output.encode("utf-8"), missing
+
+
+# ============================================================
+# 3. Casos limite
+# ============================================================
+
+def verificar_casos_limite() -> Dict[str, bool]:
+    """Ficheiros sem convenções em falta (o caso normal) e vazios."""
+    casos = {
+        "tudo_mapeado": ("902 0 003010092030559 abc\n", {"030100": "1234567"}),
+        "vazio": ("", {"030100": "1234567"}),
+    }
+    resultado = {}
+    for nome, (texto, mapeamento) in casos.items():
+        procura = scan_missing_conventions(texto, mapeamento)
+        _, em_falta = converter_linha_a_linha(texto, mapeamento)
+        resultado[nome] = (
+            group_missing(procura.lines, procura.codes) == {}
+            and group_missing(np.empty(0, dtype=np.int64), []) == {}
+            and em_falta == []
+        )
+    return resultado
+
+
+# ============================================================
+# 4. Medição e relatório
+# ============================================================
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark da conversão MCDT em lote.")
+    parser.add_argument("--linhas", type=int, nargs="*", default=[10000, 200000])
+    parser.add_argument("--semente", type=int, default=2025)
+    parser.add_argument("--saida", default=PASTA_RESULTADOS)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.semente)
+    mapeamento, convencoes = gerar_mapeamento(rng)
+    relatorio: Dict = {"meta": {"data": datetime.now().isoformat(timespec="seconds")}, "tamanhos": []}
+
+    relatorio["casos_limite"] = verificar_casos_limite()
+    print("Casos limite: " + ", ".join(f"{k} {'ok' if v else 'FALHOU'}" for k, v in relatorio["casos_limite"].items()) + "\n")
+
+    print(f"{'linhas':>9} {'anterior l/s':>13} {'lote l/s':>11} {'ganho':>7} {'procura l/s':>12} {'ganho':>7}  igual  em falta")
+    for n in args.linhas:
+        texto = gerar_texto(rng, n, convencoes)
+
+        t0 = time.perf_counter()
+        esperado, em_falta = converter_linha_a_linha(texto, mapeamento)
+        s_ant = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        dados, linhas, codigos = transform_text(texto, mapeamento)
+        s_lote = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        procura = scan_missing_conventions(texto, mapeamento)
+        s_procura = time.perf_counter() - t0
+
+        igual = (
+            dados == esperado
+            and list(zip(linhas.tolist(), codigos)) == em_falta
+            and list(zip(procura.lines.tolist(), [f"{c:06d}" for c in procura.codes.tolist()])) == em_falta
+        )
+        relatorio["tamanhos"].append({
+            "linhas": n,
+            "anterior_s": s_ant,
+            "lote_s": s_lote,
+            "procura_s": s_procura,
+            "igual": igual,
+            "em_falta": len(em_falta),
+        })
+        print(
+            f"{n:>9} {n / s_ant:>13,.0f} {n / s_lote:>11,.0f} {s_ant / s_lote:>6.1f}x "
+            f"{n / s_procura:>12,.0f} {s_ant / s_procura:>6.1f}x  {'sim' if igual else 'NÃO':>5} {len(em_falta):>9}"
+        )
+
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"mcdt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(caminho, "w", encoding="utf-8") as fh:
+        json.dump(relatorio, fh, indent=1, ensure_ascii=False)
+    print(f"\nRelatório: {caminho}")
+
+
+if __name__ == "__main__":
+    main()
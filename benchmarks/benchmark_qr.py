@@ -0,0 +1,344 @@
+"""
+Benchmark da leitura QR das faturas (extracao_pdf).
+
+Gera offline um corpus sintético de faturas AT em PDF (PyMuPDF + codificador
+QR do OpenCV) com degradações controladas e mede, por configuração do
+extrator: taxa de descodificação, percentis de latência e pico de memória.
+Cada execução escreve um relatório JSON comparável em benchmarks/resultados/.
+
+Uso:
+    python benchmarks/benchmark_qr.py
+    python benchmarks/benchmark_qr.py --n 10 --configs padrao sem_via_rapida
+    python benchmarks/benchmark_qr.py --comparar benchmarks/resultados/qr_20260101_120000.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+PASTA_CORPUS = os.path.join(RAIZ, "benchmarks", "corpus")
+PASTA_RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+
+
+# ============================================================
+# 1. Corpus sintético
+# ============================================================
+
+# "imagem": QR como imagem embutida; "vetorial": QR desenhado com retângulos;
+# as restantes são "digitalizações" (página rasterizada + degradação).
+DEGRADACOES = ("imagem", "vetorial", "rotacao", "desfoque", "baixa_dpi", "ruido", "perspetiva")
+
+NIF_ADQUIRENTE = "510445152"
+
+
+def _nif_aleatorio(rng: np.random.Generator) -> str:
+    base = str(rng.choice([1, 2, 5, 5, 5, 6, 9])) + "".join(str(d) for d in rng.integers(0, 10, 7))
+    total = sum(int(base[i]) * (9 - i) for i in range(8))
+    dv = 11 - total % 11
+    return base + str(0 if dv >= 10 else dv)
+
+
+def gerar_payload(rng: np.random.Generator, i: int) -> str:
+    """Conteúdo de um QR AT plausível (campos A..S)."""
+    base = float(rng.integers(100, 500000)) / 100
+    iva = round(base * 0.23, 2)
+    data = f"2025{int(rng.integers(1, 13)):02d}{int(rng.integers(1, 29)):02d}"
+    return "*".join([
+        f"A:{_nif_aleatorio(rng)}",
+        f"B:{NIF_ADQUIRENTE}",
+        "C:PT",
+        f"D:{rng.choice(['FT', 'FR', 'NC'])}",
+        "E:N",
+        f"F:{data}",
+        f"G:FT {chr(65 + i % 26)}{2025}/{i + 1}",
+        f"H:JJ{int(rng.integers(1000, 9999))}XX-{i + 1}",
+        "I1:PT",
+        f"I7:{base:.2f}",
+        f"I8:{iva:.2f}",
+        f"N:{iva:.2f}",
+        f"O:{base + iva:.2f}",
+        "Q:" + "".join(rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"), 4)),
+        "R:1234",
+    ])
+
+
+def _modulos_qr(payload: str) -> np.ndarray:
+    """Matriz do QR (1 píxel por módulo, com zona de silêncio): 0 = preto."""
+    return cv2.QRCodeEncoder.create().encode(payload)
+
+
+def _texto_fatura(page, i: int, payload: str):
+    page.insert_text((50, 60), f"FATURA FT A2025/{i + 1}", fontsize=16)
+    page.insert_text((50, 90), "Fornecedor Sintético, Lda.  NIF 500000000", fontsize=10)
+    page.insert_text((50, 105), f"Adquirente: NIF {NIF_ADQUIRENTE}", fontsize=10)
+    for linha in range(12):
+        page.insert_text((50, 160 + 18 * linha), f"Artigo {linha + 1:02d}  ....................  {linha + 1},00 €", fontsize=10)
+    page.insert_text((50, 420), "Total a Pagar ........ " + payload.split("O:")[1].split("*")[0].replace(".", ",") + " €", fontsize=12)
+
+
+def _pagina_com_qr(doc, i: int, payload: str, vetorial: bool):
+    page = doc.new_page(width=595, height=842)  # A4
+    _texto_fatura(page, i, payload)
+    rect = fitz.Rect(450, 700, 545, 795)
+    modulos = _modulos_qr(payload)
+
+    if vetorial:
+        lado = rect.width / modulos.shape[0]
+        shape = page.new_shape()
+        for y, x in zip(*np.nonzero(modulos == 0)):
+            x0, y0 = rect.x0 + x * lado, rect.y0 + y * lado
+            shape.draw_rect(fitz.Rect(x0, y0, x0 + lado, y0 + lado))
+        shape.finish(color=None, fill=(0, 0, 0))
+        shape.commit()
+    else:
+        img = cv2.resize(modulos, None, fx=4, fy=4, interpolation=cv2.INTER_NEAREST)
+        page.insert_image(rect, stream=cv2.imencode(".png", img)[1].tobytes())
+    return page
+
+
+def _degradar(img: np.ndarray, degradacao: str, rng: np.random.Generator) -> np.ndarray:
+    h, w = img.shape[:2]
+    if degradacao == "rotacao":
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), float(rng.uniform(-6, 6)), 1.0)
+        return cv2.warpAffine(img, M, (w, h), borderValue=(255, 255, 255))
+    if degradacao == "desfoque":
+        return cv2.GaussianBlur(img, (5, 5), 1.2)
+    if degradacao == "ruido":
+        ruido = rng.normal(0, 18, img.shape)
+        return np.clip(img.astype(np.float32) + ruido, 0, 255).astype(np.uint8)
+    if degradacao == "perspetiva":
+        d = 0.04
+        src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        dst = src + np.float32(rng.uniform(-d, d, (4, 2)) * [w, h])
+        M = cv2.getPerspectiveTransform(src, dst)
+        return cv2.warpPerspective(img, M, (w, h), borderValue=(255, 255, 255))
+    return img
+
+
+def _digitalizar(pagina, degradacao: str, rng: np.random.Generator) -> bytes:
+    """Simula uma digitalização: rasteriza a página, degrada e embebe como JPEG de página inteira."""
+    dpi = 100 if degradacao == "baixa_dpi" else 200
+    pix = pagina.get_pixmap(dpi=dpi, alpha=False)
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    img = _degradar(cv2.cvtColor(img, cv2.COLOR_RGB2BGR), degradacao, rng)
+
+    doc = fitz.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 75])[1].tobytes())
+    return doc.tobytes()
+
+
+def gerar_corpus(pasta: str, n_por_degradacao: int, semente: int) -> List[dict]:
+    os.makedirs(pasta, exist_ok=True)
+    rng = np.random.default_rng(semente)
+    manifesto = []
+
+    i = 0
+    for degradacao in DEGRADACOES:
+        for _ in range(n_por_degradacao):
+            payload = gerar_payload(rng, i)
+            doc = fitz.open()
+            pagina = _pagina_com_qr(doc, i, payload, vetorial=degradacao != "imagem")
+            dados = doc.tobytes() if degradacao in ("imagem", "vetorial") else _digitalizar(pagina, degradacao, rng)
+
+            nome = f"{i:04d}_{degradacao}.pdf"
+            with open(os.path.join(pasta, nome), "wb") as fh:
+                fh.write(dados)
+            manifesto.append({"ficheiro": nome, "degradacao": degradacao, "payload": payload})
+            i += 1
+
+    with open(os.path.join(pasta, "manifesto.json"), "w", encoding="utf-8") as fh:
+        json.dump({"semente": semente, "n_por_degradacao": n_por_degradacao, "documentos": manifesto}, fh, indent=1)
+    return manifesto
+
+
+def carregar_corpus(pasta: str, n_por_degradacao: int, semente: int) -> List[dict]:
+    caminho = os.path.join(pasta, "manifesto.json")
+    if os.path.isfile(caminho):
+        with open(caminho, encoding="utf-8") as fh:
+            dados = json.load(fh)
+        if dados.get("semente") == semente and dados.get("n_por_degradacao") == n_por_degradacao:
+            return dados["documentos"]
+    return gerar_corpus(pasta, n_por_degradacao, semente)
+
+
+# ============================================================
+# 2. Configurações do extrator e medição
+# ============================================================
+
+CONFIGURACOES: Dict[str, dict] = {
+    "padrao": {},
+    "sem_via_rapida": {"imagens_embutidas": False},
+    "so_pagina_inteira": {"imagens_embutidas": False, "etapas": ("direta", "warp")},
+    # Só detetar + corrigir a perspetiva: mede a cobertura da etapa "warp"
+    "so_warp": {"imagens_embutidas": False, "etapas": ("warp",)},
+    "zooms_3_4": {"zooms": (3.0, 4.0)},
+}
+
+
+def _pico_memoria_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux devolve KB; macOS devolve bytes
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def correr_configuracao(nome: str, pasta: str, documentos: List[dict], pages_to_try: int) -> dict:
+    """Corre num processo próprio, para que o pico de memória seja só desta configuração."""
+    from extracao_pdf import CascataQR, extrair_pdf
+
+    memoria_inicial = _pico_memoria_mb()
+    cascata = CascataQR(**CONFIGURACOES[nome])
+    resultados = []
+
+    for d in documentos:
+        with open(os.path.join(pasta, d["ficheiro"]), "rb") as fh:
+            dados = fh.read()
+        inicio = time.perf_counter()
+        try:
+            qr = extrair_pdf(dados, pages_to_try=pages_to_try, cascata=cascata)["qr_imagem"]
+        except Exception:
+            qr = ""
+        resultados.append({
+            "degradacao": d["degradacao"],
+            "ok": qr == d["payload"],
+            "ms": (time.perf_counter() - inicio) * 1000,
+        })
+
+    return {
+        "resultados": resultados,
+        "memoria_inicial_mb": memoria_inicial,
+        "memoria_pico_mb": _pico_memoria_mb(),
+        "resumo_cascata": cascata.resumo(),
+    }
+
+
+def _estatisticas(resultados: List[dict]) -> dict:
+    ms = np.array([r["ms"] for r in resultados]) if resultados else np.array([0.0])
+    return {
+        "n": len(resultados),
+        "taxa": sum(r["ok"] for r in resultados) / len(resultados) if resultados else 0.0,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "total_s": float(ms.sum() / 1000),
+    }
+
+
+def _versao_git() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, text=True).strip()
+    except Exception:
+        return ""
+
+
+# ============================================================
+# 3. Relatório
+# ============================================================
+
+def imprimir_relatorio(relatorio: dict, anterior: Optional[dict] = None):
+    print(f"\nCommit {relatorio['meta']['git']}  extrator {relatorio['meta']['versao_extrator']}  "
+          f"({relatorio['meta']['n_documentos']} documentos)")
+    cab = f"{'configuração':<20} {'degradação':<12} {'taxa':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'pico MB':>8}"
+    print(cab)
+    print("-" * len(cab))
+
+    for nome, cfg in relatorio["configuracoes"].items():
+        linhas = [("TOTAL", cfg["total"])] + list(cfg["por_degradacao"].items())
+        for deg, e in linhas:
+            pico = f"{cfg['memoria_pico_mb']:.0f}" if deg == "TOTAL" and cfg["memoria_pico_mb"] else ""
+            linha = f"{nome:<20} {deg:<12} {e['taxa']:>6.0%} {e['p50_ms']:>9.1f} {e['p90_ms']:>9.1f} {e['p99_ms']:>9.1f} {pico:>8}"
+            ant = (anterior or {}).get("configuracoes", {}).get(nome)
+            if ant:
+                e_ant = ant["total"] if deg == "TOTAL" else ant["por_degradacao"].get(deg)
+                if e_ant:
+                    linha += f"   Δtaxa {e['taxa'] - e_ant['taxa']:+.0%}  Δp50 {e['p50_ms'] - e_ant['p50_ms']:+.1f} ms"
+            print(linha)
+        if cfg["resumo_cascata"]:
+            print(f"{'':<20} {cfg['resumo_cascata']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark da leitura QR (extracao_pdf).")
+    parser.add_argument("--n", type=int, default=5, help="documentos por degradação")
+    parser.add_argument("--semente", type=int, default=2025)
+    parser.add_argument("--configs", nargs="*", default=list(CONFIGURACOES), choices=list(CONFIGURACOES))
+    parser.add_argument("--paginas", type=int, default=1, help="pages_to_try")
+    parser.add_argument("--corpus", default=PASTA_CORPUS)
+    parser.add_argument("--saida", default=PASTA_RESULTADOS)
+    parser.add_argument("--comparar", help="relatório JSON anterior para mostrar diferenças")
+    args = parser.parse_args(argv)
+
+    documentos = carregar_corpus(args.corpus, args.n, args.semente)
+
+    from extracao_pdf import VERSAO_EXTRATOR
+
+    relatorio = {
+        "meta": {
+            "data": datetime.now().isoformat(timespec="seconds"),
+            "git": _versao_git(),
+            "versao_extrator": VERSAO_EXTRATOR,
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "pymupdf": fitz.VersionBind,
+            "semente": args.semente,
+            "n_documentos": len(documentos),
+            "paginas": args.paginas,
+        },
+        "configuracoes": {},
+    }
+
+    for nome in args.configs:
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            bruto = ex.submit(correr_configuracao, nome, args.corpus, documentos, args.paginas).result()
+
+        por_deg = {
+            deg: _estatisticas([r for r in bruto["resultados"] if r["degradacao"] == deg])
+            for deg in DEGRADACOES
+            if any(r["degradacao"] == deg for r in bruto["resultados"])
+        }
+        relatorio["configuracoes"][nome] = {
+            "parametros": {k: list(v) if isinstance(v, tuple) else v for k, v in CONFIGURACOES[nome].items()},
+            "total": _estatisticas(bruto["resultados"]),
+            "por_degradacao": por_deg,
+            "memoria_inicial_mb": bruto["memoria_inicial_mb"],
+            "memoria_pico_mb": bruto["memoria_pico_mb"],
+            "resumo_cascata": bruto["resumo_cascata"],
+        }
+
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"qr_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(caminho, "w", encoding="utf-8") as fh:
+        json.dump(relatorio, fh, indent=1, ensure_ascii=False)
+
+    anterior = None
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as fh:
+            anterior = json.load(fh)
+
+    imprimir_relatorio(relatorio, anterior)
+    print(f"\nRelatório: {caminho}")
+
+
+if __name__ == "__main__":
+    main()
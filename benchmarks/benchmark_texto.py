@@ -0,0 +1,260 @@
+"""
+Benchmark dos campos de fallback por texto (extracao_texto).
+
+Gera textos sintéticos de faturas com várias páginas (linhas de artigos,
+referências numéricas, NIF inválidos, rodapés repetidos) e compara o
+extrator de varrimento único com os extratores por campo anteriores
+(um regex por campo, sem pré-compilação): tempo por documento e
+concordância campo a campo. Escreve um relatório JSON em
+benchmarks/resultados/.
+
+Uso:
+    python benchmarks/benchmark_texto.py
+    python benchmarks/benchmark_texto.py --n 50 --paginas 1 10 40
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+from extracao_pdf import formatar_data_ddmmaaaa, nif_valido, normalizar_monetario  # noqa: E402
+from extracao_texto import extrair_campos_texto  # noqa: E402
+
+PASTA_RESULTADOS = os.path.join(RAIZ, "benchmarks", "resultados")
+
+CAMPOS = ("nif", "data", "total", "numero", "tipo", "encomenda")
+
+
+# ============================================================
+# 1. Textos sintéticos
+# ============================================================
+
+def _nif(rng: random.Random, valido: bool = True) -> str:
+    base = str(rng.choice([1, 2, 5, 5, 5, 6, 9])) + "".join(str(rng.randint(0, 9)) for _ in range(7))
+    total = sum(int(base[i]) * (9 - i) for i in range(8))
+    dv = 11 - total % 11
+    dv = 0 if dv >= 10 else dv
+    return base + str(dv if valido else (dv + 1) % 10)
+
+
+def gerar_texto(rng: random.Random, i: int, paginas: int) -> str:
+    nif = _nif(rng)
+    tipo = rng.choice(["FATURA", "FATURA-RECIBO", "NOTA DE CRÉDITO", "Fatura Simplificada"])
+    linhas = [
+        f"{tipo}  Original",
+        "Fornecedor Sintético, Lda.",
+        f"Contribuinte: {nif}" if i % 2 else f"NIF: PT {nif}",
+        "Telefone 212345678  Capital social 5000,00",
+        f"Data de Emissão: {rng.randint(1, 28):02d}-{rng.randint(1, 12):02d}-2025",
+        f"Documento FT A{2025}/{i + 1}",
+        f"Vossa Encomenda: {rng.choice('123478')}{rng.randint(1000, 9999)}25",
+    ]
+    corpo = []
+    for p in range(paginas):
+        for linha in range(45):
+            corpo.append(
+                f"{rng.randint(10000000, 99999999)} Artigo {p:02d}.{linha:02d} lote {_nif(rng, valido=False)} "
+                f"{rng.randint(1, 99)} UN {rng.randint(1, 999)},{rng.randint(0, 99):02d} 23% "
+                f"{rng.randint(1, 9999)},{rng.randint(0, 99):02d}"
+            )
+        corpo.append(f"Página {p + 1} de {paginas}  Processado por programa certificado n.º 1234/AT")
+    total = f"{rng.randint(1, 99)}.{rng.randint(100, 999)},{rng.randint(0, 99):02d}"
+    rodape = [f"Total Geral {total}", f"Total a Pagar {total} €", "ATCUD: JJ1234XX-1"]
+    return "\n".join(linhas + corpo + rodape)
+
+
+# ============================================================
+# 2. Extratores por campo anteriores (referência)
+# ============================================================
+
+def _ref_nif(texto: str, filename: str) -> str:
+    candidatos: List[str] = []
+    candidatos.extend(re.findall(r"\b(\d{9})\b", Path(filename).stem))
+    texto_norm = texto.replace("\n", " ")
+    for p in [
+        r"\bContribuinte:?\s*(\d{9})\b",
+        r"\bNIF:?\s*PT?\s*(\d{9})\b",
+        r"\bN\.?IF:?\s*(\d{9})\b",
+        r"\bNIF\s+(\d{9})\b",
+    ]:
+        candidatos.extend(re.findall(p, texto_norm, flags=re.IGNORECASE))
+    candidatos.extend(re.findall(r"\b(\d{9})\b", texto_norm))
+    vistos = set()
+    for c in candidatos:
+        c = re.sub(r"\D", "", c)
+        if c in vistos:
+            continue
+        vistos.add(c)
+        if nif_valido(c):
+            return c
+    return ""
+
+
+def _ref_data(texto: str) -> str:
+    texto_norm = texto.replace("\n", " ")
+    m = re.search(r"Data\s+(?:de\s+)?Emiss[aã]o[:\s]*(\d{2}[./-]\d{2}[./-]\d{4})", texto_norm, flags=re.IGNORECASE)
+    if m:
+        return formatar_data_ddmmaaaa(m.group(1))
+    m = re.search(r"(\d{4}-\d{2}-\d{2})", texto_norm)
+    if m:
+        return formatar_data_ddmmaaaa(m.group(1))
+    datas = re.findall(r"\b(\d{2}[./-]\d{2}[./-]\d{4})\b", texto_norm)
+    return formatar_data_ddmmaaaa(datas[0]) if datas else ""
+
+
+def _ref_total(texto: str) -> str:
+    texto_norm = texto.replace("\n", " ")
+    for p in [
+        r"Total\s+a\s+Pagar.*?(\d{1,3}(?:\.\d{3})*,\d{2})",
+        r"Total\s+Geral.*?(\d{1,3}(?:\.\d{3})*,\d{2})",
+        r"Total\s+\(EUR\).*?(\d{1,3}(?:\.\d{3})*,\d{2})",
+        r"Total.*?(\d{1,3}(?:\.\d{3})*,\d{2})\s*€",
+        r"Total.*?(\d+,\d{2})\s*€",
+        r"Total.*?(\d+\.\d{2})\s*€",
+    ]:
+        m = re.search(p, texto_norm, flags=re.IGNORECASE)
+        if m:
+            return normalizar_monetario(m.group(1))
+    return ""
+
+
+def _ref_numero(texto: str) -> str:
+    texto_norm = texto.replace("\n", " ")
+    m = re.search(r"\b(FT|FR|FS|NC|ND|VD)\s*([A-Z0-9]{0,20})\s*[/-]\s*(\d{1,12})\b", texto_norm, flags=re.IGNORECASE)
+    if m:
+        serie = (m.group(2) or "").upper().strip()
+        return f"{m.group(1).upper()} {serie}/{m.group(3)}".replace("  ", " ").strip()
+    m = re.search(r"\bN[ºo]\.?\s*Documento[:\s]*([A-Z0-9/ -]{3,40})\b", texto_norm, flags=re.IGNORECASE)
+    return m.group(1).strip() if m else ""
+
+
+def _ref_encomenda(texto: str) -> str:
+    texto_norm = texto.replace("\n", " ")
+    m = re.search(r"([123478]\d{4}25)", texto_norm)
+    if m:
+        return m.group(1)
+    for p in [
+        r"(?:Vossa\s+)?Encomenda[:\s\.]*(\d{3,15})",
+        r"(?:Vossa\s+)?Requisi[cç][aã]o[:\s\.]*(\d{3,15})",
+        r"O\/Ref[:\s\.]*(\d{3,15})",
+    ]:
+        m = re.search(p, texto_norm, flags=re.IGNORECASE)
+        if m:
+            return m.group(1)
+    return ""
+
+
+def _ref_tipo(texto: str, filename: str) -> str:
+    txt = texto.lower()
+    for chave, tipo in [
+        ("nota de crédito", "Nota de Crédito"),
+        ("nota de credito", "Nota de Crédito"),
+        ("fatura-recibo", "Fatura-Recibo"),
+        ("venda a dinheiro", "Venda a Dinheiro"),
+        ("fatura simplificada", "Fatura Simplificada"),
+        ("fatura", "Fatura"),
+    ]:
+        if chave in txt:
+            return tipo
+    return "Nota de Crédito" if "credito" in filename.lower() else "Fatura"
+
+
+def extrair_referencia(texto: str, nome: str) -> Dict[str, str]:
+    return {
+        "nif": _ref_nif(texto, nome),
+        "data": _ref_data(texto),
+        "total": _ref_total(texto),
+        "numero": _ref_numero(texto),
+        "tipo": _ref_tipo(texto, nome),
+        "encomenda": _ref_encomenda(texto),
+    }
+
+
+# ============================================================
+# 3. Casos limite (prioridades dos extratores anteriores)
+# ============================================================
+
+CASOS_LIMITE = {
+    # O rótulo "Contribuinte" tem prioridade sobre "NIF", mesmo que apareça depois
+    "contribuinte_antes_de_nif": "Fatura NIF: 500000000 Fornecedor Contribuinte: 510445152 Total 5,00 €",
+    "nif_antes_de_n.if": "Fatura N.IF: 510445152 NIF PT 500000000 Contribuinte PT 503504564",
+    # Encomenda > Requisição > O/Ref, seja qual for a ordem no texto
+    "oref_antes_de_encomenda": "Fatura O/Ref. 1666 Vossa Encomenda: 1194912",
+    "requisicao_antes_de_encomenda": "Fatura Requisição: 55501 Encomenda 66602 O/Ref 777",
+    "oref_antes_de_requisicao": "Fatura O/Ref: 4321 Requisição 98765",
+    # "Total" sem fronteira de palavra: "Subtotal" conta
+    "subtotal": "Fatura Subtotal 100,00 € IVA 23,00",
+}
+
+
+def verificar_casos_limite() -> Dict[str, bool]:
+    return {
+        nome: extrair_referencia(texto, "doc.pdf") == extrair_campos_texto(texto, "doc.pdf")
+        for nome, texto in CASOS_LIMITE.items()
+    }
+
+
+# ============================================================
+# 4. Medição e relatório
+# ============================================================
+
+def _medir(funcao, textos: List[str]) -> tuple:
+    resultados = []
+    t0 = time.perf_counter()
+    for i, texto in enumerate(textos):
+        resultados.append(funcao(texto, f"doc_{i}.pdf"))
+    return resultados, (time.perf_counter() - t0) * 1000 / max(len(textos), 1)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark dos campos de fallback por texto.")
+    parser.add_argument("--n", type=int, default=20, help="documentos por tamanho")
+    parser.add_argument("--paginas", type=int, nargs="*", default=[1, 10, 40])
+    parser.add_argument("--semente", type=int, default=2025)
+    parser.add_argument("--saida", default=PASTA_RESULTADOS)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.semente)
+    relatorio = {"meta": {"data": datetime.now().isoformat(timespec="seconds"), "n": args.n}, "tamanhos": {}}
+
+    relatorio["casos_limite"] = verificar_casos_limite()
+    print("Casos limite: " + ", ".join(f"{k} {'ok' if v else 'DIFERENTE'}" for k, v in relatorio["casos_limite"].items()) + "\n")
+
+    print(f"{'páginas':>8} {'KB':>7} {'anterior ms':>12} {'novo ms':>9} {'ganho':>7}  concordância")
+    for paginas in args.paginas:
+        textos = [gerar_texto(rng, i, paginas) for i in range(args.n)]
+        ref, ms_ref = _medir(extrair_referencia, textos)
+        novo, ms_novo = _medir(extrair_campos_texto, textos)
+
+        concordancia = {c: sum(r[c] == v[c] for r, v in zip(ref, novo)) / len(textos) for c in CAMPOS}
+        kb = sum(len(t) for t in textos) / len(textos) / 1024
+        relatorio["tamanhos"][paginas] = {
+            "kb_medio": kb,
+            "anterior_ms": ms_ref,
+            "novo_ms": ms_novo,
+            "concordancia": concordancia,
+        }
+        conc = " ".join(f"{c}={v:.0%}" for c, v in concordancia.items())
+        print(f"{paginas:>8} {kb:>7.0f} {ms_ref:>12.2f} {ms_novo:>9.2f} {ms_ref / ms_novo:>6.1f}x  {conc}")
+
+    os.makedirs(args.saida, exist_ok=True)
+    caminho = os.path.join(args.saida, f"texto_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(caminho, "w", encoding="utf-8") as fh:
+        json.dump(relatorio, fh, indent=1, ensure_ascii=False)
+    print(f"\nRelatório: {caminho}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Optional
+
+
+# ============================================================
+# CACHE PERSISTENTE DE EXTRAÇÕES DE PDF
+#
+# Guarda em SQLite o resultado da parte cara da leitura de um PDF
+# (texto e QR lido por imagem), endereçado pelo conteúdo:
+#   chave = SHA-256 dos bytes do PDF + extrator/versão + parâmetros
+#
+# Um PDF reenviado (mesmo com outro nome) é servido da cache sem
+# voltar a abrir o documento. Mudar a versão do extrator invalida
+# as entradas antigas, que acabam por sair pela política de limpeza.
+# ============================================================
+
+# Pasta local da aplicação (cache de extrações, registo de faturas...).
+# Fora de ~/.cache: o registo de faturas não é descartável.
+PASTA_DADOS_LOCAIS = os.path.join(os.path.expanduser("~"), ".processos_snc_ap")
+
+CAMINHO_CACHE_PDF = os.path.join(PASTA_DADOS_LOCAIS, "extracao_pdf.sqlite")
+
+# Política de limpeza: entradas sem uso há mais de N dias saem; acima do
+# tamanho máximo saem as usadas há mais tempo.
+CACHE_MAX_IDADE_DIAS = 180
+CACHE_MAX_MB = 200
+
+
+def sha256_bytes(dados: bytes) -> str:
+    return hashlib.sha256(dados).hexdigest()
+
+
+class CachePDF:
+    def __init__(
+        self,
+        extrator: str,
+        versao: str,
+        caminho: str = CAMINHO_CACHE_PDF,
+        max_idade_dias: float = CACHE_MAX_IDADE_DIAS,
+        max_mb: float = CACHE_MAX_MB,
+    ):
+        self.extrator = extrator
+        self.versao = versao
+        self.caminho = caminho
+        self.max_idade_dias = max_idade_dias
+        self.max_mb = max_mb
+        self.hits = 0
+        self.misses = 0
+
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+
+        with closing(self._ligar()) as con, con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extracoes (
+                    chave TEXT PRIMARY KEY,
+                    extrator TEXT NOT NULL,
+                    valor TEXT NOT NULL,
+                    tamanho INTEGER NOT NULL,
+                    criado REAL NOT NULL,
+                    usado REAL NOT NULL
+                )
+                """
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS idx_extracoes_usado ON extracoes (usado)")
+
+        self.limpar()
+
+    def _ligar(self) -> sqlite3.Connection:
+        # Uma ligação por operação: o Streamlit pode correr o script em threads diferentes.
+        return sqlite3.connect(self.caminho, timeout=30)
+
+    def chave(self, ficheiro_bytes: bytes, parametros: str = "") -> str:
+        return f"{sha256_bytes(ficheiro_bytes)}|{self.extrator}|{self.versao}|{parametros}"
+
+    def obter(self, chave: str, contar_miss: bool = True) -> Optional[dict]:
+        """`contar_miss=False` para sondagens que, falhando, são seguidas de outro obter()."""
+        with closing(self._ligar()) as con, con:
+            row = con.execute("SELECT valor FROM extracoes WHERE chave = ?", (chave,)).fetchone()
+            if row is None:
+                if contar_miss:
+                    self.misses += 1
+                return None
+            con.execute("UPDATE extracoes SET usado = ? WHERE chave = ?", (time.time(), chave))
+
+        self.hits += 1
+        return json.loads(row[0])
+
+    def guardar(self, chave: str, valor: dict):
+        texto = json.dumps(valor, ensure_ascii=False)
+        agora = time.time()
+        with closing(self._ligar()) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO extracoes (chave, extrator, valor, tamanho, criado, usado) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (chave, self.extrator, texto, len(texto.encode("utf-8")), agora, agora),
+            )
+
+    def limpar(self) -> int:
+        """Aplica a política de limpeza (idade e tamanho). Devolve o nº de entradas removidas."""
+        removidas = 0
+        with closing(self._ligar()) as con, con:
+            limite = time.time() - self.max_idade_dias * 86400
+            removidas += con.execute("DELETE FROM extracoes WHERE usado < ?", (limite,)).rowcount
+
+            max_bytes = int(self.max_mb * 1024 * 1024)
+            total = con.execute("SELECT COALESCE(SUM(tamanho), 0) FROM extracoes").fetchone()[0]
+            if total > max_bytes:
+                acumulado = 0
+                a_remover = []
+                for chave, tamanho in con.execute("SELECT chave, tamanho FROM extracoes ORDER BY usado ASC"):
+                    if total - acumulado <= max_bytes:
+                        break
+                    a_remover.append((chave,))
+                    acumulado += tamanho
+                con.executemany("DELETE FROM extracoes WHERE chave = ?", a_remover)
+                removidas += len(a_remover)
+
+        return removidas
+
+    def resumo(self) -> str:
+        return f"Cache de extrações: {self.hits} hit(s), {self.misses} miss(es)."
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import codecs
+from typing import NamedTuple, Sequence, Tuple
+
+
+# ============================================================
+# DETEÇÃO DE CODIFICAÇÃO E DIALETO (CSV / TXT)
+#
+# Em vez de tentar descodificar o ficheiro inteiro com cada codificação
+# até uma não falhar, a codificação é escolhida a partir do BOM e de um
+# prefixo limitado dos bytes:
+#   - BOM UTF-8 / UTF-16 / UTF-32;
+#   - UTF-16 sem BOM (bytes nulos alternados);
+#   - UTF-8 válido no prefixo (descodificador incremental, tolera um
+#     carácter cortado no fim do prefixo);
+#   - senão, a primeira alternativa de cada leitor (cp1252, latin-1...).
+# O ficheiro é depois descodificado uma vez. Só se a escolha falhar mais
+# à frente (p.ex. UTF-8 válido no prefixo e cp1252 no resto) se passa às
+# alternativas.
+# O dialeto (separador e preâmbulo "sep=" do Excel) lê-se da 1.ª linha.
+# ============================================================
+
+# Bytes inspecionados para escolher a codificação
+PREFIXO_DETECAO = 64 * 1024
+
+_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+SEPARADORES = (";", ",", "\t")
+
+
+class Dialeto(NamedTuple):
+    separador: str
+    linhas_a_saltar: int     # 1 quando a 1.ª linha é o preâmbulo "sep=;"
+
+
+def _utf16_sem_bom(amostra: bytes) -> str:
+    """'utf-16-le'/'utf-16-be' quando metade dos bytes são nulos alternados, senão ''."""
+    pares, impares = amostra[0::2], amostra[1::2]
+    if len(impares) < 2:
+        return ""
+    nulos_pares, nulos_impares = pares.count(0), impares.count(0)
+    if nulos_impares > 0.3 * len(impares) and nulos_pares < 0.05 * len(pares):
+        return "utf-16-le"
+    if nulos_pares > 0.3 * len(pares) and nulos_impares < 0.05 * len(impares):
+        return "utf-16-be"
+    return ""
+
+
+def detetar_codificacao(
+    dados: bytes,
+    alternativas: Sequence[str] = ("cp1252", "latin-1"),
+    limite: int = PREFIXO_DETECAO,
+) -> str:
+    """Codificação provável de `dados`, olhando só para o BOM e `limite` bytes."""
+    for bom, codificacao in _BOMS:
+        if dados.startswith(bom):
+            return codificacao
+
+    prefixo = dados[:limite]
+    utf16 = _utf16_sem_bom(prefixo[:4096])
+    if utf16:
+        return utf16
+
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(prefixo, final=len(prefixo) == len(dados))
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    for codificacao in alternativas:
+        try:
+            prefixo.decode(codificacao)
+            return codificacao
+        except UnicodeDecodeError:
+            continue
+    return alternativas[-1] if alternativas else "latin-1"
+
+
+def descodificar(
+    dados: bytes,
+    alternativas: Sequence[str] = ("cp1252", "latin-1"),
+) -> Tuple[str, str]:
+    """
+    Devolve (texto, codificação). Uma só descodificação no caso normal;
+    se a codificação detetada falhar mais à frente, tenta as alternativas.
+    Levanta UnicodeDecodeError se nenhuma servir.
+    """
+    detetada = detetar_codificacao(dados, alternativas)
+    erro = None
+    for codificacao in dict.fromkeys((detetada, *alternativas)):
+        try:
+            return dados.decode(codificacao), codificacao
+        except UnicodeDecodeError as e:
+            erro = e
+    raise erro
+
+
+def detetar_dialeto(texto: str) -> Dialeto:
+    """Separador pela 1.ª linha (ou pelo preâmbulo "sep=" do Excel)."""
+    fim = texto.find("\n")
+    bruta = (texto if fim < 0 else texto[:fim]).rstrip("\r").lstrip("\ufeff")
+    primeira = bruta.strip()
+
+    if primeira.lower().lstrip('"').startswith("sep="):
+        declarado = bruta.lstrip(' "')[4:5]
+        if declarado in SEPARADORES:
+            return Dialeto(declarado, 1)
+        return Dialeto(next((s for s in SEPARADORES if s in primeira), "\t"), 1)
+
+    separador = next((s for s in SEPARADORES if s in primeira), "\t")
+    return Dialeto(separador, 0)
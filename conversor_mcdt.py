@@ -0,0 +1,796 @@
+# -*- coding: utf-8 -*-
+"""
+Conversão das linhas dos ficheiros MCDT / Termas / medicamentos
+(702, 902-906): regras por código de ficheiro, transformação linha a
+linha (transform_line) e a versão em lote para ficheiros grandes
+(transform_text), que produz exatamente o mesmo texto.
+"""
+import operator
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+# =========================================================
+# ⚙️ Normalização da convenção
+# =========================================================
+def normalize_mapping_key(value: str) -> str:
+    """
+    Normaliza a convenção apenas para uso interno na app.
+    Mantém o princípio que já existia:
+    - remove tudo o que não é dígito
+    - completa à esquerda até 6 dígitos
+
+    Importante:
+    Isto NÃO altera o valor guardado no CSV exportado.
+    """
+    digits = re.sub(r"\D", "", str(value))
+    return digits.zfill(6) if digits else ""
+
+
+# =========================================================
+# 🔍 Regras de layout por código de ficheiro
+# =========================================================
+def get_file_code(line: str) -> str:
+    """
+    Código de ficheiro = 3 primeiras colunas/caracteres da linha.
+    Exemplo:
+        702... = medicamentos
+        902/903/904/906... = layout MCDT/Termas
+    """
+    return line[:3] if len(line) >= 3 else ""
+
+
+def get_token2_rule(file_code: str, token2: str) -> dict:
+    """
+    Define como ler a parte convertível do 2.º token, consoante
+    o código de ficheiro existente nas 3 primeiras colunas da linha.
+
+    Regras conhecidas:
+      - 702: medicamentos
+          token2 = CCCCCCPPPPPPPP
+          parte convertível = 6 primeiros dígitos
+          exemplo: 80089292015442 -> 800892 + 92015442
+
+      - 902/903/904/906: MCDT/Termas
+          token2 = 0CCCCCCPPPPPPPP
+          parte convertível = 7 primeiros dígitos
+          exemplo: 003010092030559 -> 0030100 + 92030559
+
+    Fallback:
+      - se começar por 0 + 6 dígitos, usa regra de 7
+      - caso contrário, tenta regra de 6
+    """
+    if file_code == "702":
+        return {
+            "name": "medicamentos",
+            "convert_len": 6,
+            "has_leading_zero": False,
+        }
+
+    if file_code in {"902", "903", "904", "906"}:
+        return {
+            "name": "mcdt_termas",
+            "convert_len": 7,
+            "has_leading_zero": True,
+        }
+
+    # Fallback automático para ficheiros não catalogados
+    if re.match(r"^0\d{6}", token2):
+        return {
+            "name": "auto_0_6",
+            "convert_len": 7,
+            "has_leading_zero": True,
+        }
+
+    return {
+        "name": "auto_6",
+        "convert_len": 6,
+        "has_leading_zero": False,
+    }
+
+
+# =========================================================
+# 🔍 Detetar convenção em falta
+# =========================================================
+def extract_missing_convention_from_token2(
+    token2: str,
+    file_code: str
+) -> Optional[str]:
+    """
+    Extrai a convenção candidata apenas da parte convertível do 2.º token,
+    de acordo com o código de ficheiro das 3 primeiras colunas.
+    """
+    rule = get_token2_rule(file_code, token2)
+    convert_len = rule["convert_len"]
+
+    if len(token2) < convert_len:
+        return None
+
+    parte_convertivel = token2[:convert_len]
+
+    if rule["has_leading_zero"]:
+        match = re.match(r"^0(\d{6})$", parte_convertivel)
+        if match:
+            return match.group(1)
+        return None
+
+    match = re.match(r"^(\d{6})$", parte_convertivel)
+    if match:
+        return match.group(1)
+
+    return None
+
+
+# =========================================================
+# 🔍 Procurar convenção apenas na parte convertível do token2
+# =========================================================
+def find_mapping_for_token2(
+    token2: str,
+    mapping: Dict[str, str],
+    file_code: str
+) -> Optional[str]:
+    """
+    Procura o código de convenção apenas na parte convertível do 2.º token,
+    escolhendo a regra através do código de ficheiro nas 3 primeiras colunas.
+
+    Medicamentos:
+        80089292015442
+        800892 = convenção
+
+    MCDT/Termas:
+        003010092030559
+        0030100 = 0 + convenção 030100
+    """
+    candidate = extract_missing_convention_from_token2(token2, file_code)
+
+    if not candidate:
+        return None
+
+    candidate_internal = normalize_mapping_key(candidate)
+
+    if candidate_internal in mapping:
+        return candidate_internal
+
+    return None
+
+# =========================================================
+# 🧩 Transformação + deteção de convenções em falta
+# =========================================================
+def transform_line(
+    line: str,
+    mapping: Dict[str, str],
+    expected_len: int = None
+):
+    original_len = len(line)
+
+    if expected_len is None:
+        expected_len = original_len
+
+    missing_code = None
+
+    # -----------------------------------------------------
+    # 1️⃣ Corrigir Coluna 12
+    # -----------------------------------------------------
+    if len(line) >= 12 and line[11] == "0":
+        line = line[:11] + " " + line[12:]
+
+    # -----------------------------------------------------
+    # 2️⃣ Corrigir CC
+    # -----------------------------------------------------
+    line = re.sub(r"\+93\s\s", "+9197", line)
+
+    # -----------------------------------------------------
+    # 3️⃣ Processar tokens
+    # -----------------------------------------------------
+    file_code = get_file_code(line)
+    parts = line.split(maxsplit=2)
+
+    if len(parts) >= 2:
+        token2 = parts[1]
+
+        # Escolhe a regra pela estrutura/código do ficheiro nas 3 primeiras colunas
+        rule = get_token2_rule(file_code, token2)
+        convert_len = rule["convert_len"]
+
+        # Procura a convenção apenas na parte convertível do token2
+        matched_conv = find_mapping_for_token2(token2, mapping, file_code)
+
+        if matched_conv:
+            ent_code = mapping[matched_conv]
+
+            try:
+                ent7 = f"{int(ent_code):07d}"
+
+                # -------------------------------------------------
+                # Divisão correta do segundo token, dependente do ficheiro:
+                #
+                # Medicamentos, código 702:
+                #   80089292015442
+                #   parte_convertivel = 800892
+                #   parte_fixa        = 92015442
+                #
+                # MCDT/Termas, códigos 902/903/904/906:
+                #   003010092030559
+                #   parte_convertivel = 0030100
+                #   parte_fixa        = 92030559
+                #
+                # Só a parte convertível é substituída.
+                # A parte fixa fica intacta.
+                # -------------------------------------------------
+                parte_fixa = token2[convert_len:]
+
+                new_token2 = ent7 + parte_fixa
+
+                # Linhas especiais 903 / 904 / 906
+                if file_code in {"903", "904", "906"} and new_token2.startswith("0"):
+                    new_token2 = new_token2[1:]
+
+                # Nos medicamentos (702), a convenção tem 6 dígitos e a entidade tem 7.
+                # Por isso o token pode crescer 1 carácter. Não se deve cortar aqui.
+                if len(new_token2) < len(token2):
+                    new_token2 = new_token2.ljust(len(token2))
+
+                # Reconstrução segura da linha
+                prefix = line[:line.find(token2)]
+                suffix = line[line.find(token2) + len(token2):]
+
+                line = prefix.rstrip() + " " + new_token2 + suffix
+
+            except Exception:
+                pass
+
+        else:
+            # -------------------------------------------------
+            # 🔍 Só regista como falta a convenção real existente
+            # na parte convertível do token2
+            # -------------------------------------------------
+            candidate = extract_missing_convention_from_token2(token2, file_code)
+
+            if candidate:
+                candidate_internal = normalize_mapping_key(candidate)
+
+                if candidate_internal not in mapping:
+                    missing_code = candidate_internal
+
+    # -----------------------------------------------------
+    # 4️⃣ Remover NIF final
+    # -----------------------------------------------------
+    line = re.sub(r"\s\d{9}\s*$", " ", line)
+
+    # -----------------------------------------------------
+    # 5️⃣ Ajuste do comprimento final
+    # -----------------------------------------------------
+    if len(line) > expected_len:
+        line = line[:expected_len]
+    elif len(line) < expected_len:
+        line = line.ljust(expected_len)
+
+    return line, missing_code
+
+
+# =========================================================
+# 📄 Utilitários de texto
+# =========================================================
+def split_keep_eol(text: str):
+    parts = text.splitlines(keepends=True)
+    out = []
+
+    for p in parts:
+        if p.endswith("\r\n"):
+            out.append((p[:-2], "\r\n"))
+        elif p.endswith("\n"):
+            out.append((p[:-1], "\n"))
+        elif p.endswith("\r"):
+            out.append((p[:-1], "\r"))
+        else:
+            out.append((p, ""))
+
+    return out
+
+
+def guess_default_eol(text: str) -> str:
+    if "\r\n" in text:
+        return "\r\n"
+    if "\n" in text:
+        return "\n"
+    if "\r" in text:
+        return "\r"
+    return "\n"
+
+
+# =========================================================
+# 🚀 Conversão em lote (ficheiros grandes)
+# =========================================================
+# Os ficheiros 702/902-906 são de largura fixa: as linhas com a largura
+# mais comum e só com ASCII imprimível são tratadas em blocos como uma
+# matriz de bytes (numpy), aplicando as mesmas regras de transform_line
+# a todas as linhas do bloco de uma vez:
+#   - coluna 12 e "+93  " -> "+9197" por comparação de colunas;
+#   - 1.º/2.º token pelas fronteiras espaço/não-espaço;
+#   - convenção -> entidade por uma tabela de 10^6 posições;
+#   - reconstrução da linha por índices e NIF final pela última coluna.
+# As restantes linhas (acentos, largura diferente, casos raros em que
+# find(token2) não coincide com o 2.º token) passam por transform_line.
+# O resultado é byte a byte igual ao da conversão linha a linha.
+
+BATCH_LINES = 65536
+
+# Colunas onde se procuram o 1.º e o 2.º token
+TOKEN_COLUMNS = 64
+
+# Largura mínima para o caminho em lote (coluna 12 + códigos de ficheiro)
+_MIN_BATCH_WIDTH = 16
+
+_SP = ord(" ")
+_DIGIT_0 = ord("0")
+
+# Separadores de linha do str.splitlines() além de \r e \n
+_OTHER_LINE_BREAKS = "\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+_RE_EOL = re.compile(r"\r\n|\r|\n")
+
+
+class ConvertedBatch(NamedTuple):
+    data: bytes                 # linhas convertidas (UTF-8), com os fins de linha
+    missing_lines: np.ndarray   # índice (0-based) da linha no ficheiro
+    missing_codes: List[str]    # convenção em falta em cada uma dessas linhas
+    missing_bodies: List[str]   # conteúdo original dessas linhas (sem fim de linha)
+    lines_done: int             # linhas do ficheiro já tratadas (acumulado)
+
+
+class _MappingTable:
+    """Convenção de 6 dígitos -> entidade com 7 dígitos, como tabela numpy."""
+
+    # Convenção existe mas a entidade não converte em int (transform_line ignora)
+    INVALID = -2
+    # Entidade com mais de 7 dígitos: a linha vai para transform_line
+    SCALAR = -3
+
+    def __init__(self, mapping: Dict[str, str]):
+        self.index = np.full(10 ** 6, -1, dtype=np.int32)
+        entities = []
+        for conv, ent_code in mapping.items():
+            if len(conv) != 6 or not (conv.isascii() and conv.isdigit()):
+                continue
+            try:
+                ent7 = f"{int(ent_code):07d}"
+            except Exception:
+                self.index[int(conv)] = self.INVALID
+                continue
+            if len(ent7) != 7:
+                self.index[int(conv)] = self.SCALAR
+                continue
+            self.index[int(conv)] = len(entities)
+            entities.append(ent7.encode("ascii"))
+        self.ent7 = np.frombuffer(b"".join(entities) or b"0" * 7, dtype=np.uint8).reshape(-1, 7)
+
+
+def split_lines(text: str) -> Tuple[List[str], List[str]]:
+    """Igual a split_keep_eol, mas devolve (corpos, fins de linha) sem ciclo em Python."""
+    if any(sep in text for sep in _OTHER_LINE_BREAKS):
+        pairs = split_keep_eol(text)
+        return [p[0] for p in pairs], [p[1] for p in pairs]
+
+    bodies = text.splitlines()
+    n_cr, n_lf = text.count("\r"), text.count("\n")
+    if not n_cr:
+        eols = ["\n"] * n_lf
+    elif not n_lf:
+        eols = ["\r"] * n_cr
+    elif text.count("\r\n") == n_cr == n_lf:
+        eols = ["\r\n"] * n_lf
+    else:
+        eols = _RE_EOL.findall(text)
+    if len(eols) < len(bodies):
+        eols.append("")
+    return bodies, eols
+
+
+def _transform_block(a: np.ndarray, table: _MappingTable):
+    """
+    Aplica transform_line a uma matriz (linhas, largura) de bytes ASCII.
+    Devolve (matriz convertida, linhas p/ transform_line, linhas em falta, convenções).
+    """
+    m, width = a.shape
+    rows = np.arange(m)
+    cols = np.arange(width)
+    a = a.copy()
+
+    # 1️⃣ Coluna 12
+    a[a[:, 11] == _DIGIT_0, 11] = _SP
+
+    # 2️⃣ CC: "+93  " -> "+9197" (o padrão não se sobrepõe a si próprio);
+    # só se verificam as posições com "+"
+    flat = a.reshape(-1)
+    plus = np.flatnonzero(flat == ord("+"))
+    plus = plus[plus % width <= width - 5]
+    if len(plus):
+        window = flat[plus[:, None] + np.arange(1, 5)]
+        plus = plus[(window == np.frombuffer(b"93  ", dtype=np.uint8)).all(axis=1)]
+        flat[plus + 2] = ord("1")
+        flat[plus + 3] = ord("9")
+        flat[plus + 4] = ord("7")
+
+    # 3️⃣ Tokens: início/fim do 1.º e do 2.º, procurados nas primeiras
+    # TOKEN_COLUMNS colunas (linhas em que não cabem aí vão para transform_line)
+    cols_t = min(width, TOKEN_COLUMNS)
+    ns = a[:, :cols_t] != _SP
+    cols = np.arange(cols_t)
+    has1 = ns.any(axis=1)
+    p1 = ns.argmax(axis=1)
+    space_after = ~ns & (cols > p1[:, None])
+    e1 = np.where(space_after.any(axis=1), space_after.argmax(axis=1), cols_t)
+    token_after = ns & (cols >= e1[:, None])
+    has2 = has1 & token_after.any(axis=1)
+    p2 = np.where(has2, token_after.argmax(axis=1), cols_t)
+    space_after = ~ns & (cols > p2[:, None])
+    e2 = np.where(space_after.any(axis=1), space_after.argmax(axis=1), cols_t)
+    len1, len2 = e1 - p1, e2 - p2
+    tokens_unknown = (~has2 | (e2 == cols_t)) if cols_t < width else np.zeros(m, dtype=bool)
+
+    # Regra pelo código de ficheiro (3 primeiras colunas)
+    c0, c1, c2 = a[:, 0], a[:, 1], a[:, 2]
+    is702 = (c0 == ord("7")) & (c1 == ord("0")) & (c2 == ord("2"))
+    is90x = (c0 == ord("9")) & (c1 == ord("0"))
+    drop_zero_code = is90x & np.isin(c2, np.frombuffer(b"346", dtype=np.uint8))
+    is90x &= np.isin(c2, np.frombuffer(b"2346", dtype=np.uint8))
+
+    k7 = np.arange(7)
+    t = a[rows[:, None], np.minimum(p2[:, None] + k7, width - 1)]
+    digit = (t >= _DIGIT_0) & (t <= ord("9")) & (k7 < len2[:, None])
+    zero_rule = is90x | (~is702 & (t[:, 0] == _DIGIT_0) & digit[:, 1:7].all(axis=1))
+    conv_len = np.where(zero_rule, 7, 6)
+
+    cand_ok = has2 & np.where(
+        zero_rule,
+        (t[:, 0] == _DIGIT_0) & digit[:, 1:7].all(axis=1),
+        digit[:, 0:6].all(axis=1),
+    )
+    values = (t.astype(np.int32) - _DIGIT_0) * (10 ** (6 - k7))  # 7 dígitos, t[0] com peso 10^6
+    cand = np.where(zero_rule, values[:, 1:].sum(axis=1), values[:, :6].sum(axis=1) // 10)
+    cand = np.where(cand_ok, cand, 0)
+    ent_idx = np.where(cand_ok, table.index[cand], -1)
+
+    missing = cand_ok & (ent_idx == -1)
+    change = cand_ok & (ent_idx >= 0)
+    # find(token2) só coincide com o 2.º token se ele não aparecer dentro do 1.º
+    scalar = (cand_ok & (ent_idx == table.SCALAR)) | (change & (len1 >= len2)) | tokens_unknown
+    change &= ~scalar
+
+    # Linha intermédia com largura + 1 (o token dos 702 cresce 1 carácter)
+    b = np.full((m, width + 1), _SP, dtype=np.uint8)
+    b[:, :width] = a
+
+    # Reconstrução: linha[:e1] + " " + novo token + linha[e2:]. Nos ficheiros
+    # de largura fixa quase todas as linhas partilham as mesmas posições,
+    # por isso agrupa-se por (e1, p2, e2, regra, zero a retirar) e cada
+    # grupo é só cópia de fatias de colunas.
+    R = np.nonzero(change)[0]
+    if len(R):
+        drop = drop_zero_code[R] & (table.ent7[ent_idx[R], 0] == _DIGIT_0)
+        w1 = width + 1
+        key = (((e1[R] * w1 + p2[R]) * w1 + e2[R]) * 8 + conv_len[R]) * 2 + drop
+        keys, group = np.unique(key, return_inverse=True)
+        for g, k in enumerate(keys.tolist()):
+            k, g_drop = divmod(k, 2)
+            k, g_conv = divmod(k, 8)
+            k, g_e2 = divmod(k, w1)
+            g_e1, g_p2 = divmod(k, w1)
+            rg = R[group == g]
+            ent = table.ent7[ent_idx[rg], g_drop:]
+            tail = a[rg, g_p2 + g_conv:g_e2]
+            l2 = g_e2 - g_p2
+            token_len = max(ent.shape[1] + tail.shape[1], l2)
+            pos = g_e1
+            b[rg, pos] = _SP
+            pos += 1
+            b[rg, pos:pos + ent.shape[1]] = ent
+            pos += ent.shape[1]
+            b[rg, pos:pos + tail.shape[1]] = tail
+            pos += tail.shape[1]
+            b[rg, pos:g_e1 + 1 + token_len] = _SP
+            pos = g_e1 + 1 + token_len
+            rest = min(width - g_e2, width + 1 - pos)
+            b[rg, pos:pos + rest] = a[rg, g_e2:g_e2 + rest]
+            b[rg, pos + rest:] = _SP
+
+    # 4️⃣ NIF final: espaço + 9 dígitos + espaços até ao fim. O último
+    # não-espaço procura-se nas últimas colunas e, só se preciso, na linha toda.
+    tail = min(width + 1, 32)
+    nsb = b[:, -tail:] != _SP
+    found = nsb.any(axis=1)
+    last = width - nsb[:, ::-1].argmax(axis=1)       # índice do último não-espaço
+    blank_tail = np.nonzero(~found)[0]
+    if len(blank_tail):
+        nsb_full = b[blank_tail] != _SP
+        found[blank_tail] = nsb_full.any(axis=1)
+        last[blank_tail] = width - nsb_full[:, ::-1].argmax(axis=1)
+    start = last - 9
+    k10 = np.arange(10)
+    window = b[rows[:, None], np.clip(start[:, None] + k10, 0, width)]
+    nif = (
+        found & (start >= 0) & (window[:, 0] == _SP)
+        & ((window[:, 1:] >= _DIGIT_0) & (window[:, 1:] <= ord("9"))).all(axis=1)
+    )
+    nif_rows = np.nonzero(nif)[0]
+    for s in np.unique(start[nif_rows]).tolist():
+        b[nif_rows[start[nif_rows] == s], s + 1:] = _SP
+
+    # 5️⃣ Largura original
+    missing_rows = np.nonzero(missing)[0]
+    return b[:, :width], np.nonzero(scalar)[0], missing_rows, cand[missing_rows]
+
+
+def iter_transform_text(
+    text: str,
+    mapping: Dict[str, str],
+    batch_lines: int = BATCH_LINES,
+):
+    """
+    Converte o texto de um ficheiro em blocos de `batch_lines` linhas,
+    com o mesmo resultado do ciclo transform_line (linhas em branco
+    intactas). Produz ConvertedBatch por bloco; o fim de linha final em
+    falta é acrescentado no último.
+    """
+    bodies, eols = split_lines(text)
+    n = len(bodies)
+    table = _MappingTable(mapping)
+
+    lengths = np.fromiter(map(len, bodies), dtype=np.int64, count=n)
+    width = int(np.bincount(lengths).argmax()) if n else 0
+    batch_ok = width >= _MIN_BATCH_WIDTH
+
+    for start in range(0, n, batch_lines) if n else [0]:
+        stop = min(start + batch_lines, n)
+        out = bodies[start:stop]
+        missing_lines: List[int] = []
+        missing_codes: List[str] = []
+
+        fast = np.nonzero(lengths[start:stop] == width)[0] if batch_ok else np.empty(0, dtype=np.int64)
+        raw = "".join([out[i] for i in fast.tolist()])
+        if raw.isascii():
+            matrix = np.frombuffer(raw.encode("ascii"), dtype=np.uint8).reshape(len(fast), width)
+            printable = ((matrix >= _SP) & (matrix <= 126)).all(axis=1) if not raw.isprintable() else np.ones(len(fast), dtype=bool)
+        else:
+            # Com acentos: um código por carácter (UTF-32) para marcar as linhas não ASCII
+            codes = np.frombuffer(raw.encode("utf-32-le"), dtype=np.uint32).reshape(len(fast), width)
+            printable = ((codes >= _SP) & (codes <= 126)).all(axis=1)
+            matrix = codes.astype(np.uint8)
+
+        slow = np.ones(stop - start, dtype=bool)
+        keep = np.zeros(len(fast), dtype=bool)
+        converted = matrix
+        if len(fast):
+            converted, scalar, miss_rows, miss_cand = _transform_block(matrix, table)
+            keep = printable.copy()
+            keep[scalar] = False
+            slow[fast[keep]] = False
+            miss_keep = keep[miss_rows]
+            missing_lines.extend((fast[miss_rows[miss_keep]] + start).tolist())
+            missing_codes.extend(f"{c:06d}" for c in miss_cand[miss_keep].tolist())
+
+        slow_rows = np.nonzero(slow)[0].tolist()
+        for i in slow_rows:
+            body = out[i]
+            if not body.strip():
+                continue
+            out[i], missing_code = transform_line(body, mapping)
+            if missing_code:
+                missing_lines.append(start + i)
+                missing_codes.append(missing_code)
+
+        if missing_lines:
+            order = np.argsort(missing_lines, kind="stable")
+            missing_lines_arr = np.asarray(missing_lines, dtype=np.int64)[order]
+            missing_codes = [missing_codes[i] for i in order]
+        else:
+            missing_lines_arr = np.empty(0, dtype=np.int64)
+
+        chunk_eols = eols[start:stop]
+        if chunk_eols and chunk_eols.count(chunk_eols[0]) == len(chunk_eols):
+            # Fim de linha uniforme: as linhas em lote saem da matriz já em bytes,
+            # por troços contíguos entre as linhas tratadas uma a uma.
+            eol = chunk_eols[0]
+            eol_bytes = np.frombuffer(eol.encode("ascii"), dtype=np.uint8)
+            block = np.empty((len(fast), width + len(eol_bytes)), dtype=np.uint8)
+            block[:, :width] = converted
+            block[:, width:] = eol_bytes
+            pieces = []
+            previous = 0
+            for i in slow_rows + [stop - start]:
+                if i > previous:
+                    f0 = int(np.searchsorted(fast, previous))
+                    pieces.append(block[f0:f0 + i - previous].tobytes())
+                if i < stop - start:
+                    pieces.append((out[i] + eol).encode("utf-8"))
+                previous = i + 1
+            data = b"".join(pieces)
+        else:
+            if keep.any():
+                rows_text = converted[keep].tobytes().decode("ascii")
+                for pos, i in enumerate(fast[keep].tolist()):
+                    out[i] = rows_text[pos * width:(pos + 1) * width]
+            data = "".join(map(operator.add, out, chunk_eols)).encode("utf-8")
+
+        if stop == n and (n == 0 or not eols[-1]):
+            data += guess_default_eol(text).encode("utf-8")
+        missing_bodies = [bodies[i] for i in missing_lines_arr.tolist()]
+        yield ConvertedBatch(data, missing_lines_arr, missing_codes, missing_bodies, stop)
+
+
+def transform_text(
+    text: str,
+    mapping: Dict[str, str],
+) -> Tuple[bytes, np.ndarray, List[str]]:
+    """Converte o ficheiro inteiro: (bytes UTF-8, linhas em falta, convenções)."""
+    parts, lines, codes = [], [], []
+    for batch in iter_transform_text(text, mapping):
+        parts.append(batch.data)
+        lines.append(batch.missing_lines)
+        codes.extend(batch.missing_codes)
+    return b"".join(parts), np.concatenate(lines), codes
+
+
+# =========================================================
+# 🔎 Procura das convenções em falta (sem converter)
+#
+# Só interessa a parte convertível do 2.º token, por isso o texto é
+# codificado uma vez e tratado como um único buffer de bytes:
+#   - os limites das linhas saem das posições de \r e \n (numpy), sem
+#     separar as linhas em Python;
+#   - a posição dos dois primeiros tokens é a dominante numa amostra de
+#     linhas e é confirmada em todas lendo só essas colunas;
+#   - linhas que não seguem essa disposição vão para transform_line.
+# O resultado (linhas e convenções) é o mesmo da conversão.
+# =========================================================
+SCAN_SAMPLE_LINES = 2000
+
+_RE_LAYOUT = re.compile(r"( *)([^ ]+)( +)[^ ]")
+
+
+class MissingScan(NamedTuple):
+    lines: np.ndarray   # índice (0-based) das linhas com convenção em falta, por ordem
+    codes: np.ndarray   # convenção (int de 6 dígitos) em cada uma dessas linhas
+
+
+def _line_bounds(buf: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(início, fim) de cada linha do buffer, como str.splitlines() para \r, \n e \r\n."""
+    lf = np.flatnonzero(buf == ord("\n"))
+    cr = np.flatnonzero(buf == ord("\r"))
+    cr_lf = np.zeros(len(cr), dtype=bool)
+    inside = cr + 1 < len(buf)
+    cr_lf[inside] = buf[cr[inside] + 1] == ord("\n")
+    lone_lf = lf[(lf == 0) | (buf[np.maximum(lf - 1, 0)] != ord("\r"))]
+
+    ends = np.concatenate([cr, lone_lf])
+    eol_len = np.concatenate([np.where(cr_lf, 2, 1), np.ones(len(lone_lf), dtype=np.int64)])
+    if len(cr) and len(lone_lf):
+        order = np.argsort(ends, kind="stable")
+        ends, eol_len = ends[order], eol_len[order]
+
+    starts = np.concatenate([np.zeros(1, dtype=np.int64), ends + eol_len])
+    if starts[-1] < len(buf):
+        ends = np.append(ends, len(buf))
+    else:
+        starts = starts[:-1]
+    return starts, ends
+
+
+def _dominant_layout(sample: List[str]) -> Optional[Tuple[int, int, int]]:
+    """(início do 1.º token, fim do 1.º token, início do 2.º) mais frequente na amostra."""
+    counts: Dict[Tuple[int, int, int], int] = {}
+    for line in sample:
+        if len(line) >= 12 and line[11] == "0":
+            line = line[:11] + " " + line[12:]
+        match = _RE_LAYOUT.match(line)
+        if match:
+            key = (match.end(1), match.end(2), match.end(3))
+            counts[key] = counts.get(key, 0) + 1
+    return max(counts, key=counts.get) if counts else None
+
+
+def _scan_rows(h: np.ndarray, layout: Tuple[int, int, int], table: _MappingTable):
+    """
+    `h`: primeiras colunas (até ao fim da parte convertível) de cada linha.
+    Devolve (linhas com a disposição, linhas em falta entre elas, convenções).
+    """
+    p1, e1, p2 = layout
+    if h.shape[1] > 11:
+        h[h[:, 11] == _DIGIT_0, 11] = _SP
+
+    # Só se confia nas colunas lidas: sem "+" (a correção do CC mexe em
+    # espaços), carateres de controlo ou não ASCII antes do fim da parte convertível
+    ok = ((h > _SP) & (h <= 126) & (h != ord("+"))) | (h == _SP)
+    ok = ok.all(axis=1)
+    ok &= (h[:, p1:e1] != _SP).all(axis=1) & (h[:, e1:p2] == _SP).all(axis=1) & (h[:, p2] != _SP)
+    if p1:
+        ok &= (h[:, :p1] == _SP).all(axis=1)
+
+    t = h[:, p2:p2 + 7]
+    digit = (t >= _DIGIT_0) & (t <= ord("9"))
+    c0, c1, c2 = h[:, 0], h[:, 1], h[:, 2]
+    is702 = (c0 == ord("7")) & (c1 == ord("0")) & (c2 == ord("2"))
+    is90x = (c0 == ord("9")) & (c1 == ord("0")) & np.isin(c2, np.frombuffer(b"2346", dtype=np.uint8))
+    zero_digits = (t[:, 0] == _DIGIT_0) & digit[:, 1:7].all(axis=1)
+    zero_rule = is90x | (~is702 & zero_digits)
+    cand_ok = ok & np.where(zero_rule, zero_digits, digit[:, 0:6].all(axis=1))
+
+    values = (t.astype(np.int32) - _DIGIT_0) * (10 ** (6 - np.arange(7)))
+    cand = np.where(zero_rule, values[:, 1:].sum(axis=1), values[:, :6].sum(axis=1) // 10)
+    cand = np.where(cand_ok, cand, 0)
+    missing = np.nonzero(cand_ok & (table.index[cand] == -1))[0]
+    return ok, missing, cand[missing]
+
+
+def scan_missing_conventions(text: str, mapping: Dict[str, str]) -> MissingScan:
+    """
+    Convenções em falta no ficheiro, sem o converter: as mesmas linhas e
+    convenções que iter_transform_text indicaria.
+    """
+    if any(sep in text for sep in _OTHER_LINE_BREAKS):
+        # Separadores raros: as linhas de splitlines() passam a separar-se por \n
+        text = "\n".join(split_lines(text)[0])
+
+    table = _MappingTable(mapping)
+    buf = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    starts, ends = _line_bounds(buf)
+    n = len(starts)
+
+    sample = [
+        buf[s:min(e, s + TOKEN_COLUMNS)].tobytes().decode("latin-1")
+        for s, e in zip(starts[:SCAN_SAMPLE_LINES].tolist(), ends[:SCAN_SAMPLE_LINES].tolist())
+    ]
+    layout = _dominant_layout(sample)
+
+    slow = np.ones(n, dtype=bool)
+    lines, codes = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    if layout is not None:
+        head = layout[2] + 7
+        rows = np.nonzero(ends - starts >= head)[0]
+        h = buf[starts[rows, None] + np.arange(head)]
+        ok, miss, cand = _scan_rows(h, layout, table)
+        slow[rows[ok]] = False
+        lines.append(rows[miss])
+        codes.append(cand.astype(np.int64))
+
+    slow_lines, slow_codes = [], []
+    for i in np.nonzero(slow)[0].tolist():
+        line = buf[starts[i]:ends[i]].tobytes().decode("utf-8")
+        if not line.strip():
+            continue
+        missing_code = transform_line(line, mapping)[1]
+        if missing_code:
+            slow_lines.append(i)
+            slow_codes.append(int(missing_code))
+    lines.append(np.asarray(slow_lines, dtype=np.int64))
+    codes.append(np.asarray(slow_codes, dtype=np.int64))
+
+    lines_arr = np.concatenate(lines)
+    order = np.argsort(lines_arr, kind="stable")
+    return MissingScan(lines_arr[order], np.concatenate(codes)[order])
+
+
+def group_missing(lines: np.ndarray, codes) -> Dict[str, np.ndarray]:
+    """Convenção -> índices (0-based, por ordem) das linhas em que falta."""
+    lines = np.asarray(lines, dtype=np.int64)
+    codes = np.asarray(codes)
+    if not len(codes):
+        return {}
+    if codes.dtype.kind in "iu":
+        codes = np.char.zfill(codes.astype(str), 6)
+    order = np.lexsort((lines, codes))
+    codes, lines = codes[order], lines[order]
+    unique, first = np.unique(codes, return_index=True)
+    bounds = first.tolist() + [len(codes)]
+    return {code: lines[bounds[k]:bounds[k + 1]] for k, code in enumerate(unique.tolist())}
+
+
+def read_lines(text: str, line_indices: List[int]) -> List[str]:
+    """Conteúdo (sem fim de linha) das linhas indicadas, sem separar o ficheiro todo."""
+    if any(sep in text for sep in _OTHER_LINE_BREAKS):
+        bodies = split_lines(text)[0]
+        return [bodies[i] for i in line_indices]
+    buf = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    starts, ends = _line_bounds(buf)
+    return [buf[starts[i]:ends[i]].tobytes().decode("utf-8") for i in line_indices]
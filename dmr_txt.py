@@ -8,6 +8,8 @@ from typing import List, Tuple, Optional
 
 import pandas as pd
 
+from codificacao import descodificar
+
 
 # ============================================================
 # POSIÇÕES FIXAS DA LINHA 006 DA DMR TXT
@@ -197,11 +199,8 @@ def ler_dmr_txt(uploaded_file) -> Tuple[List[str], List[LinhaDMR]]:
     if isinstance(raw, str):
         texto = raw
     else:
-        # tentar utf-8 e fallback latin-1
-        try:
-            texto = raw.decode("utf-8")
-        except Exception:
-            texto = raw.decode("latin-1")
+        # utf-8 (pelo prefixo) ou, em alternativa, latin-1
+        texto, _ = descodificar(raw, alternativas=("latin-1",))
 
     linhas = texto.splitlines()
     linhas_006: List[LinhaDMR] = []
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import io
+import re
+import zipfile
+from typing import Dict, List, Optional, Sequence, Tuple
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape, unescape
+
+
+# ============================================================
+# ACRESCENTAR LINHAS A UM XLSX SEM O REESCREVER
+#
+# Um livro de controlo que cresce todos os meses não deve ser lido e
+# reescrito célula a célula (openpyxl) só para juntar umas centenas de
+# linhas. Aqui o XML da folha é alterado diretamente:
+#   - as linhas novas são inseridas antes de </sheetData>, com o estilo
+#     (formato) de cada coluna copiado da última linha existente;
+#   - dimension, autoFilter e o nome _FilterDatabase são atualizados;
+#   - as restantes partes do ficheiro são copiadas tal como estão.
+# O trabalho em Python é proporcional às linhas novas; o resto é cópia
+# e (des)compressão dos bytes, feita em C.
+# ============================================================
+
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+_RE_ATRIBUTOS = re.compile(r'([\w:]+)="([^"]*)"')
+_RE_CELULA = re.compile(rb"<c\b([^>]*?)(/>|>(.*?)</c>)", re.S)
+# <row ...>...</row> ou <row .../> (linhas vazias com formato, que o Excel
+# escreve sem células); no segundo caso o grupo 2 é None
+_RE_LINHA = re.compile(rb"<row\b([^>]*?)(?:/>|>(.*?)</row>)", re.S)
+_RE_REF = re.compile(r"([A-Z]+)(\d+)")
+# Caracteres não permitidos em XML 1.0
+_RE_INVALIDOS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def letra_coluna(n: int) -> str:
+    """1 -> A, 27 -> AA."""
+    letras = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        letras = chr(65 + r) + letras
+    return letras
+
+
+def numero_coluna(letras: str) -> int:
+    n = 0
+    for ch in letras:
+        n = n * 26 + ord(ch) - 64
+    return n
+
+
+def _atributos(texto: bytes) -> Dict[str, str]:
+    return dict(_RE_ATRIBUTOS.findall(texto.decode("utf-8")))
+
+
+def _celula_xml(ref: str, valor, estilo: Optional[str]) -> str:
+    s = f' s="{estilo}"' if estilo is not None else ""
+    if valor is None or (isinstance(valor, str) and valor == ""):
+        return f'<c r="{ref}"{s}/>' if s else ""
+    if isinstance(valor, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, float)):
+        if valor != valor:  # NaN
+            return f'<c r="{ref}"{s}/>' if s else ""
+        return f'<c r="{ref}"{s}><v>{valor!r}</v></c>'
+    texto = escape(_RE_INVALIDOS.sub("", str(valor)))
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+
+def _linha_xml(r: int, valores: Sequence, estilos: Dict[int, str]) -> str:
+    celulas = "".join(
+        _celula_xml(f"{letra_coluna(j)}{r}", v, estilos.get(j)) for j, v in enumerate(valores, start=1)
+    )
+    return f'<row r="{r}">{celulas}</row>'
+
+
+class LivroXlsx:
+    """
+    Acesso mínimo a um .xlsx para acrescentar/substituir linhas de folhas
+    existentes. As alterações ficam em memória até guardar().
+    """
+
+    def __init__(self, dados: bytes):
+        self._zip = zipfile.ZipFile(io.BytesIO(dados))
+        self._partes: Dict[str, bytes] = {}
+        self._strings: Optional[List[str]] = None
+        self._folhas = self._mapear_folhas()
+
+    # ---------- estrutura ----------
+
+    def _ler(self, parte: str) -> bytes:
+        if parte not in self._partes:
+            self._partes[parte] = self._zip.read(parte)
+        return self._partes[parte]
+
+    def _mapear_folhas(self) -> Dict[str, Tuple[int, str]]:
+        """nome -> (posição, parte XML)"""
+        rels = ET.fromstring(self._zip.read("xl/_rels/workbook.xml.rels"))
+        destinos = {}
+        for rel in rels:
+            alvo = rel.get("Target", "")
+            alvo = alvo.lstrip("/") if alvo.startswith("/") else "xl/" + alvo
+            destinos[rel.get("Id")] = alvo
+
+        livro = ET.fromstring(self._zip.read("xl/workbook.xml"))
+        folhas = {}
+        for i, folha in enumerate(livro.iter(f"{{{NS_MAIN}}}sheet")):
+            folhas[folha.get("name")] = (i, destinos.get(folha.get(f"{{{NS_REL}}}id"), ""))
+        return folhas
+
+    @property
+    def nomes_folhas(self) -> List[str]:
+        return sorted(self._folhas, key=lambda n: self._folhas[n][0])
+
+    def _shared_string(self, indice: int) -> str:
+        # Só se lê até ao índice pedido (os cabeçalhos estão no início)
+        if self._strings is None:
+            self._strings = []
+            self._iter_strings = None
+            if "xl/sharedStrings.xml" in self._zip.namelist():
+                self._iter_strings = ET.iterparse(self._zip.open("xl/sharedStrings.xml"), events=("end",))
+        while len(self._strings) <= indice and self._iter_strings is not None:
+            try:
+                _, el = next(self._iter_strings)
+            except StopIteration:
+                self._iter_strings = None
+                break
+            if el.tag == f"{{{NS_MAIN}}}si":
+                self._strings.append("".join(t.text or "" for t in el.iter(f"{{{NS_MAIN}}}t")))
+                el.clear()
+        return self._strings[indice] if indice < len(self._strings) else ""
+
+    def _valor_celula(self, atributos: Dict[str, str], corpo: bytes) -> str:
+        tipo = atributos.get("t", "")
+        if tipo == "inlineStr":
+            return unescape("".join(m.decode("utf-8") for m in re.findall(rb"<t[^>]*>(.*?)</t>", corpo or b"", re.S)))
+        m = re.search(rb"<v>(.*?)</v>", corpo or b"", re.S)
+        if not m:
+            return ""
+        v = unescape(m.group(1).decode("utf-8"))
+        return self._shared_string(int(v)) if tipo == "s" else v
+
+    # ---------- leitura ----------
+
+    def _xml_folha(self, nome: str) -> bytes:
+        return self._ler(self._folhas[nome][1])
+
+    def _celulas_linha(self, corpo: bytes) -> List[Tuple[int, Dict[str, str], bytes]]:
+        celulas = []
+        for m in _RE_CELULA.finditer(corpo):
+            atributos = _atributos(m.group(1))
+            ref = _RE_REF.match(atributos.get("r", ""))
+            if ref:
+                celulas.append((numero_coluna(ref.group(1)), atributos, m.group(3) or b""))
+        return celulas
+
+    def cabecalho(self, nome: str) -> List[str]:
+        """Valores da 1.ª linha da folha, por coluna (A = índice 0)."""
+        xml = self._xml_folha(nome)
+        m = _RE_LINHA.search(xml)
+        if not m:
+            return []
+        celulas = self._celulas_linha(m.group(2) or b"")
+        if not celulas:
+            return []
+        valores = [""] * max(c for c, _, _ in celulas)
+        for c, atributos, corpo in celulas:
+            valores[c - 1] = self._valor_celula(atributos, corpo).strip()
+        return valores
+
+    def _ultima_linha(self, xml: bytes) -> Tuple[int, Dict[int, str]]:
+        """
+        (n.º da última linha, estilo de cada coluna na última linha com
+        células). O n.º conta também linhas vazias com formato (<row .../>),
+        para as linhas novas ficarem depois delas, por ordem.
+        """
+        fim = xml.rfind(b"</sheetData>")
+        if fim < 0:
+            return 0, {}
+        ultima = 0
+        while True:
+            inicio = xml.rfind(b"<row", 0, fim)
+            if inicio < 0:
+                return ultima, {}
+            m = _RE_LINHA.match(xml, inicio)
+            if not m:
+                fim = inicio
+                continue
+            if not ultima:
+                ultima = int(_atributos(m.group(1)).get("r", "0"))
+            celulas = self._celulas_linha(m.group(2) or b"")
+            if celulas:
+                return ultima, {c: a["s"] for c, a, _ in celulas if "s" in a}
+            fim = inicio
+
+    def _estilos_colunas(self, xml: bytes) -> Dict[int, str]:
+        """Estilo por omissão de cada coluna (<cols><col style=...>)."""
+        estilos = {}
+        for m in re.finditer(rb"<col\b([^>]*)/?>", xml):
+            a = _atributos(m.group(1))
+            if "style" in a and "min" in a and "max" in a:
+                for c in range(int(a["min"]), min(int(a["max"]), 16384) + 1):
+                    estilos[c] = a["style"]
+        return estilos
+
+    def n_linhas(self, nome: str) -> int:
+        return self._ultima_linha(self._xml_folha(nome))[0]
+
+    def estilos_dados(self, nome: str) -> Dict[int, str]:
+        """
+        Formato de cada coluna: o da última linha e, nas colunas sem célula
+        nessa linha, o estilo por omissão da coluna.
+        """
+        xml = self._xml_folha(nome)
+        return {**self._estilos_colunas(xml), **self._ultima_linha(xml)[1]}
+
+    # ---------- escrita ----------
+
+    def _atualizar_intervalo(self, nome: str, xml: bytes, ultima_linha: int, n_colunas: int) -> bytes:
+        ultima_col = letra_coluna(max(n_colunas, 1))
+        ref = f"A1:{ultima_col}{max(ultima_linha, 1)}".encode()
+        xml = re.sub(rb'<dimension ref="[^"]*"', b'<dimension ref="' + ref + b'"', xml, count=1)
+        xml = re.sub(rb'<autoFilter ref="[^"]*"', b'<autoFilter ref="' + ref + b'"', xml, count=1)
+
+        # Nome oculto do filtro automático no workbook.xml
+        posicao = self._folhas[nome][0]
+        livro = self._ler("xl/workbook.xml")
+        padrao = (
+            rb'(<definedName name="_xlnm\._FilterDatabase" localSheetId="' + str(posicao).encode()
+            + rb'"[^>]*>[^<]*!)\$A\$1:\$[A-Z]+\$\d+'
+        )
+        novo = b"\\1$A$1:$" + ultima_col.encode() + b"$" + str(max(ultima_linha, 1)).encode()
+        self._partes["xl/workbook.xml"] = re.sub(padrao, novo, livro, count=1)
+        return xml
+
+    def acrescentar(
+        self,
+        nome: str,
+        linhas: Sequence[Sequence],
+        estilos: Optional[Dict[int, str]] = None,
+    ):
+        """
+        Acrescenta `linhas` (listas alinhadas com as colunas da folha, A = 0)
+        no fim da folha. `estilos` (coluna 1-based -> índice de estilo) por
+        omissão vem de estilos_dados().
+        """
+        if not linhas:
+            return
+        parte = self._folhas[nome][1]
+        xml = self._ler(parte)
+        ultima, _ = self._ultima_linha(xml)
+        if estilos is None:
+            estilos = self.estilos_dados(nome)
+
+        novas = "".join(_linha_xml(ultima + i, v, estilos) for i, v in enumerate(linhas, start=1))
+        fim = xml.rfind(b"</sheetData>")
+        xml = xml[:fim] + novas.encode("utf-8") + xml[fim:]
+
+        n_colunas = max(len(self.cabecalho(nome)), max(len(v) for v in linhas))
+        self._partes[parte] = self._atualizar_intervalo(nome, xml, ultima + len(linhas), n_colunas)
+
+    def substituir(
+        self,
+        nome: str,
+        colunas: Sequence[str],
+        linhas: Sequence[Sequence],
+        estilos: Optional[Dict[int, str]] = None,
+    ):
+        """Substitui o conteúdo da folha (cabeçalho + linhas), mantendo o estilo do cabeçalho."""
+        parte = self._folhas[nome][1]
+        xml = self._ler(parte)
+
+        estilos_cab = {}
+        m = _RE_LINHA.search(xml)
+        if m:
+            estilos_cab = {c: a["s"] for c, a, _ in self._celulas_linha(m.group(2) or b"") if "s" in a}
+
+        corpo = _linha_xml(1, list(colunas), estilos_cab) + "".join(
+            _linha_xml(i, v, estilos or {}) for i, v in enumerate(linhas, start=2)
+        )
+        corpo = f"<sheetData>{corpo}</sheetData>".encode("utf-8")
+
+        xml = re.sub(rb"<sheetData\s*/>|<sheetData>.*</sheetData>", lambda _: corpo, xml, count=1, flags=re.S)
+        self._partes[parte] = self._atualizar_intervalo(nome, xml, len(linhas) + 1, len(colunas))
+
+    def guardar(self) -> bytes:
+        saida = io.BytesIO()
+        with zipfile.ZipFile(saida, "w", zipfile.ZIP_DEFLATED) as z:
+            for info in self._zip.infolist():
+                dados = self._partes.get(info.filename)
+                if dados is None:
+                    dados = self._zip.read(info.filename)
+                z.writestr(info, dados, compress_type=zipfile.ZIP_DEFLATED)
+        return saida.getvalue()
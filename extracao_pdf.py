@@ -0,0 +1,1597 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+from cache_pdf import CachePDF
+
+
+# ============================================================
+# MOTOR DE EXTRAÇÃO DE PDFs (FATURAS / NOTAS DE CRÉDITO AT)
+#
+# Partilhado pelas páginas "Faturas para P2" e "NC PDF Manager":
+# leitura robusta do QR AT (imagens embutidas, regiões candidatas,
+# cascata adaptativa de zooms/variantes), texto do documento e
+# normalizadores de datas, valores e NIFs.
+#
+# API de lote: extrair_lote(lista de bytes) -> lista de registos
+#   {"texto": ..., "qr_imagem": ...}  (ou {"erro": ...})
+# Um PDF de cada vez: extrair_pdf(bytes), com as mesmas opções.
+#
+# Vários documentos por PDF: extrair_pdf(..., multi=True) lê todos os
+# QR de todas as páginas e devolve um documento fiscal por ATCUD.
+#
+# Orçamento por documento: com um VigilanteExtracao, cada PDF é lido
+# num processo à parte, com limite de tempo e de memória.
+#
+# Fontes de PDFs (uploads, ZIP, pasta no servidor): cada documento
+# só é lido quando chega a sua vez, para a memória não crescer com
+# o tamanho do lote.
+#
+# Triagem pelo texto: o texto da 1.ª e da última página decide se é
+# preciso renderizar (ver triagem_texto). O texto devolvido é só o das
+# páginas lidas ("texto_completo" diz se são todas); as páginas do meio
+# só são lidas (ler_texto_completo) se faltar algum campo.
+# ============================================================
+
+# Versão da extração (texto + QR). Mudar sempre que a extração mudar,
+# para que a cache persistente não devolva resultados antigos.
+VERSAO_EXTRATOR = "2026.10.9"
+NOME_EXTRATOR = "extracao_pdf"
+
+
+# ============================================================
+# 1. Normalizadores e validação
+# ============================================================
+
+def normalizar_nif(nif: str) -> str:
+    """Remove PT, espaços e caracteres não numéricos."""
+    return re.sub(r"\D", "", str(nif or "").upper().replace("PT", ""))
+
+
+def formatar_data_ddmmaaaa(valor: str) -> str:
+    """Converte datas para DD/MM/AAAA. Suporta (2023-01-01) e (20230101)."""
+    if not valor:
+        return ""
+    valor = str(valor).strip()
+
+    if re.fullmatch(r"\d{8}", valor):
+        return f"{valor[6:8]}/{valor[4:6]}/{valor[0:4]}"
+
+    formatos = ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y"]
+    for fmt in formatos:
+        try:
+            dt = datetime.strptime(valor, fmt)
+            return dt.strftime("%d/%m/%Y")
+        except ValueError:
+            continue
+
+    m = re.search(r"(\d{2})[./-](\d{2})[./-](\d{4})", valor)
+    if m:
+        return f"{m.group(1)}/{m.group(2)}/{m.group(3)}"
+
+    m = re.search(r"(\d{4})-(\d{2})-(\d{2})", valor)
+    if m:
+        return f"{m.group(3)}/{m.group(2)}/{m.group(1)}"
+
+    return valor
+
+
+def normalizar_monetario(valor: str) -> str:
+    """Devolve sempre formato PT: 1234,56 (tenta forçar 2 casas decimais)."""
+    if not valor:
+        return ""
+    v = re.sub(r"[^\d.,]", "", str(valor))
+    if not v:
+        return ""
+
+    if "." in v and "," in v:
+        last = max(v.rfind("."), v.rfind(","))
+        inteiro = re.sub(r"[.,]", "", v[:last])
+        dec = re.sub(r"[^\d]", "", v[last + 1 :])
+        dec = (dec + "00")[:2]
+        return f"{inteiro},{dec}"
+
+    if "," in v:
+        a, *b = v.split(",")
+        inteiro = re.sub(r"[^\d]", "", a)
+        dec = re.sub(r"[^\d]", "", b[0]) if b else ""
+        dec = (dec + "00")[:2]
+        return f"{inteiro},{dec}"
+
+    if "." in v:
+        partes = v.split(".")
+        if len(partes) == 1:
+            return partes[0]
+        inteiro = re.sub(r"[^\d]", "", "".join(partes[:-1]))
+        dec = re.sub(r"[^\d]", "", partes[-1])
+        dec = (dec + "00")[:2]
+        return f"{inteiro},{dec}"
+
+    return v
+
+
+def nif_valido(nif: str) -> bool:
+    """
+    Valida NIF português (9 dígitos) pelo dígito de controlo.
+    dv = 11 - (soma % 11); se dv >= 10 => 0.
+    """
+    if not nif:
+        return False
+    nif = re.sub(r"\D", "", str(nif))
+
+    if len(nif) != 9:
+        return False
+
+    # Conjunto típico. Ajusta se necessário.
+    if nif[0] not in "1235689":
+        return False
+
+    total = 0
+    for i in range(8):
+        total += int(nif[i]) * (9 - i)
+
+    resto = total % 11
+    dv = 11 - resto
+    if dv >= 10:
+        dv = 0
+
+    return int(nif[8]) == dv
+
+
+def normalizar_monetario_para_float(valor) -> float:
+    if valor is None:
+        return 0.0
+
+    if isinstance(valor, (int, float)) and not np.isnan(valor):
+        return float(valor)
+
+    v = str(valor).strip()
+    if not v or v.lower() in ("nan", "none"):
+        return 0.0
+
+    v = re.sub(r"[^\d,.\-]", "", v)
+    if not v:
+        return 0.0
+
+    negativo = "-" in v
+    v = v.replace("-", "")
+
+    if "." in v and "," in v:
+        last = max(v.rfind("."), v.rfind(","))
+        inteiro = re.sub(r"[.,]", "", v[:last]) or "0"
+        dec = re.sub(r"\D", "", v[last + 1:])
+        dec = (dec + "00")[:2]
+        num = float(f"{inteiro}.{dec}")
+    elif "," in v:
+        partes = v.split(",")
+        inteiro = re.sub(r"\D", "", "".join(partes[:-1])) if len(partes) > 1 else re.sub(r"\D", "", partes[0])
+        inteiro = inteiro or "0"
+        dec = re.sub(r"\D", "", partes[-1]) if len(partes) > 1 else "00"
+        dec = (dec + "00")[:2]
+        num = float(f"{inteiro}.{dec}")
+    elif "." in v:
+        partes = v.split(".")
+        if len(partes[-1]) == 2:
+            inteiro = re.sub(r"\D", "", "".join(partes[:-1])) or "0"
+            dec = re.sub(r"\D", "", partes[-1])
+            num = float(f"{inteiro}.{dec}")
+        else:
+            num = float(re.sub(r"\D", "", v) or 0)
+    else:
+        num = float(v or 0)
+
+    return -num if negativo else num
+
+
+def formatar_valor_pt(valor) -> str:
+    try:
+        return f"{float(valor):.2f}".replace(".", ",")
+    except Exception:
+        return ""
+
+
+# ============================================================
+# 2. PDF -> Imagem / QR robusto (detetar, recortar, corrigir perspetiva)
+# ============================================================
+
+def abrir_pdf_bytes(file_bytes: bytes):
+    return fitz.open(stream=file_bytes, filetype="pdf")
+
+
+def pagina_para_cv2(doc, page_index: int = 0, zoom: float = 3.0) -> np.ndarray:
+    """
+    Renderiza uma página com zoom para melhorar leitura de QR.
+    Os píxeis do MuPDF são lidos sem cópia (vista NumPy sobre pix.samples);
+    a única cópia é a conversão para BGR, que fica com memória própria.
+    """
+    page = doc.load_page(page_index)
+    matriz = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=matriz, alpha=False)
+    rgb = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def redimensionar_zoom(img: np.ndarray, zoom_origem: float, zoom_destino: float) -> np.ndarray:
+    """Obtém a imagem noutro zoom a partir de uma render já feita (sem voltar ao MuPDF)."""
+    if zoom_destino == zoom_origem:
+        return img
+    f = zoom_destino / zoom_origem
+    interp = cv2.INTER_AREA if f < 1 else cv2.INTER_CUBIC
+    return cv2.resize(img, None, fx=f, fy=f, interpolation=interp)
+
+
+def _order_points(pts: np.ndarray) -> np.ndarray:
+    """Ordena 4 pontos (tl, tr, br, bl) para warpPerspective."""
+    pts = pts.reshape(4, 2).astype(np.float32)
+    s = pts.sum(axis=1)
+    diff = np.diff(pts, axis=1).reshape(-1)
+
+    tl = pts[np.argmin(s)]
+    br = pts[np.argmax(s)]
+    tr = pts[np.argmin(diff)]
+    bl = pts[np.argmax(diff)]
+
+    return np.array([tl, tr, br, bl], dtype=np.float32)
+
+
+def _warp_quad(image: np.ndarray, quad_pts: np.ndarray, pad: int = 10) -> np.ndarray:
+    """Warp de um quadrilátero para um retângulo (com padding)."""
+    pts = _order_points(quad_pts)
+
+    w1 = np.linalg.norm(pts[1] - pts[0])
+    w2 = np.linalg.norm(pts[2] - pts[3])
+    h1 = np.linalg.norm(pts[3] - pts[0])
+    h2 = np.linalg.norm(pts[2] - pts[1])
+    W = int(max(w1, w2)) + pad * 2
+    H = int(max(h1, h2)) + pad * 2
+    W = max(W, 250)
+    H = max(H, 250)
+
+    dst = np.array(
+        [[pad, pad], [W - pad - 1, pad], [W - pad - 1, H - pad - 1], [pad, H - pad - 1]],
+        dtype=np.float32,
+    )
+
+    M = cv2.getPerspectiveTransform(pts, dst)
+    warped = cv2.warpPerspective(image, M, (W, H), flags=cv2.INTER_CUBIC)
+    return warped
+
+
+# Variantes de pré-processamento, da mais barata para a mais cara.
+# A ordem é a ordem inicial da cascata; os upscales ficam para o fim.
+VARIANTES_QR = (
+    "cinza",
+    "original",
+    "clahe",
+    "otsu",
+    "adaptativo",
+    "nitidez",
+    "nitidez_x2",
+    "adaptativo_x3",
+)
+
+# Na página inteira só se tentam as variantes baratas; as restantes
+# correm apenas sobre recortes (regiões candidatas e warp).
+VARIANTES_PAGINA_QR = ("cinza", "clahe", "otsu")
+
+# Zoom a que se procuram as regiões candidatas (página reduzida).
+ZOOM_REGIOES_QR = 2.0
+
+ZOOMS_QR = (3.0, 4.0, 2.5, 5.0)
+
+ETAPAS_QR = ("regiao", "direta", "warp")
+
+# Ramos da triagem pelo texto (contados na CascataQR do lote)
+RAMOS_TRIAGEM = ("qr_texto", "imagem_direta", "mais_paginas_qr_texto", "mais_paginas_imagem")
+
+
+class _VariantesQR:
+    """
+    Variantes de pré-processamento de uma imagem, calculadas só quando pedidas.
+    Os passos intermédios (cinza, CLAHE, nitidez) são guardados e partilhados;
+    as variantes finais (incluindo os upscales) não ficam em memória.
+    """
+
+    def __init__(self, bgr: np.ndarray):
+        self.bgr = bgr
+        self._cache = {}
+
+    def _intermedio(self, nome: str, fn):
+        if nome not in self._cache:
+            self._cache[nome] = fn()
+        return self._cache[nome]
+
+    def cinza(self) -> np.ndarray:
+        return self._intermedio(
+            "cinza",
+            lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY) if self.bgr.ndim == 3 else self.bgr,
+        )
+
+    def clahe(self) -> np.ndarray:
+        return self._intermedio(
+            "clahe",
+            lambda: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(self.cinza()),
+        )
+
+    def original(self) -> np.ndarray:
+        return self.bgr
+
+    def otsu(self) -> np.ndarray:
+        _, thr_otsu = cv2.threshold(self.clahe(), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return thr_otsu
+
+    def adaptativo(self) -> np.ndarray:
+        # Blur + adaptativo
+        g_blur = cv2.GaussianBlur(self.clahe(), (3, 3), 0)
+        return cv2.adaptiveThreshold(
+            g_blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2
+        )
+
+    def nitidez(self) -> np.ndarray:
+        # Sharpen (unsharp mask)
+        def _calc():
+            blur = cv2.GaussianBlur(self.clahe(), (0, 0), sigmaX=1.0)
+            return cv2.addWeighted(self.clahe(), 1.6, blur, -0.6, 0)
+
+        return self._intermedio("nitidez", _calc)
+
+    def nitidez_x2(self) -> np.ndarray:
+        # Upscale + sharpen
+        return cv2.resize(self.nitidez(), None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+
+    def adaptativo_x3(self) -> np.ndarray:
+        # Upscale + adaptativo (muito eficaz em QR fino)
+        up = cv2.resize(self.clahe(), None, fx=3, fy=3, interpolation=cv2.INTER_CUBIC)
+        up_blur = cv2.GaussianBlur(up, (3, 3), 0)
+        return cv2.adaptiveThreshold(
+            up_blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2
+        )
+
+    def obter(self, nome: str) -> np.ndarray:
+        return getattr(self, nome)()
+
+
+def _preprocess_variants(
+    bgr: np.ndarray, ordem: Iterable[str] = VARIANTES_QR
+) -> Iterator[Tuple[str, np.ndarray]]:
+    """Gera (nome, imagem) de forma preguiçosa, pela ordem pedida."""
+    variantes = _VariantesQR(bgr)
+    for nome in ordem:
+        yield nome, variantes.obter(nome)
+
+
+def _decode_with_detector(
+    detector: cv2.QRCodeDetector, img, aceitar: Optional[Callable[[str], bool]] = None
+) -> Optional[str]:
+    """
+    Tenta detectAndDecodeMulti (se disponível) e detectAndDecode. Com
+    `aceitar`, só devolve um QR que o satisfaça (p.ex. _e_qr_at).
+    """
+    try:
+        ok, decoded_info, _, _ = detector.detectAndDecodeMulti(img)
+        if ok and decoded_info:
+            for d in decoded_info:
+                if d and d.strip() and (aceitar is None or aceitar(d.strip())):
+                    return d.strip()
+    except Exception:
+        pass
+
+    try:
+        data, _, _ = detector.detectAndDecode(img)
+        if data and data.strip() and (aceitar is None or aceitar(data.strip())):
+            return data.strip()
+    except Exception:
+        pass
+
+    return None
+
+
+class CascataQR:
+    """
+    Ordem adaptativa das tentativas de leitura QR para um lote.
+
+    Cada tentativa é (zoom, etapa, variante), com etapa "regiao" (recortes
+    das regiões candidatas), "direta" (página inteira, só variantes baratas)
+    ou "warp" (após detetar e corrigir a perspetiva). Começa pela ordem
+    clássica (zoom a zoom, variantes da mais barata para a mais cara) e,
+    à medida que os documentos do lote vão sendo lidos, passa à frente as
+    combinações que mais vezes deram resultado.
+
+    `etapas` e `imagens_embutidas` permitem desligar partes da leitura
+    (útil para comparar configurações no benchmark).
+    """
+
+    def __init__(
+        self,
+        zooms: Iterable[float] = ZOOMS_QR,
+        variantes: Iterable[str] = VARIANTES_QR,
+        etapas: Iterable[str] = ETAPAS_QR,
+        imagens_embutidas: bool = True,
+    ):
+        variantes = list(variantes)
+        variantes_pagina = [v for v in variantes if v in VARIANTES_PAGINA_QR]
+        variantes_etapa = {"regiao": variantes, "direta": variantes_pagina, "warp": variantes}
+        self.tentativas: List[Tuple[float, str, str]] = [
+            (zoom, etapa, var)
+            for zoom in zooms
+            for etapa in etapas
+            for var in variantes_etapa[etapa]
+        ]
+        self.imagens_embutidas = imagens_embutidas
+        self.sucessos: Dict[Tuple[float, str, str], int] = {}
+        self.tentativas_por_documento: List[int] = []
+        # Contadores por via de leitura: "imagem_embutida" (via rápida) e "render"
+        self.documentos: Dict[str, int] = {"imagem_embutida": 0, "render": 0}
+        self.segundos: Dict[str, float] = {"imagem_embutida": 0.0, "render": 0.0}
+        # Ramos da triagem pelo texto (ver triagem_texto)
+        self.triagem: Dict[str, int] = {ramo: 0 for ramo in RAMOS_TRIAGEM}
+
+    def ordem(self) -> List[Tuple[float, str, str]]:
+        # sorted é estável: em empate mantém a ordem inicial (mais barata primeiro)
+        return sorted(self.tentativas, key=lambda t: -self.sucessos.get(t, 0))
+
+    def registar(self, tentativa: Optional[Tuple[float, str, str]], n_tentativas: int):
+        if tentativa is not None:
+            self.sucessos[tentativa] = self.sucessos.get(tentativa, 0) + 1
+        self.tentativas_por_documento.append(n_tentativas)
+
+    def registar_via(self, via: str, segundos: float):
+        """Regista um documento lido com sucesso pela via indicada."""
+        self.documentos[via] += 1
+        self.segundos[via] += segundos
+
+    def registar_triagem(self, ramo: str):
+        self.triagem[ramo] += 1
+
+    def resumo(self) -> str:
+        rapidos = self.documentos["imagem_embutida"]
+        render = self.documentos["render"]
+        partes = []
+        if rapidos + render:
+            partes.append(
+                f"QR lido em imagem embutida: {rapidos}/{rapidos + render} documento(s) "
+                f"({rapidos / (rapidos + render):.0%})"
+            )
+        if rapidos and render:
+            # Estimativa: cada leitura rápida teria custado o tempo médio de uma render com sucesso
+            media_render = self.segundos["render"] / render
+            media_rapida = self.segundos["imagem_embutida"] / rapidos
+            partes.append(f"tempo poupado estimado: {rapidos * (media_render - media_rapida):.1f} s")
+        if self.tentativas_por_documento:
+            partes.append(
+                f"render da página: mediana de {int(np.median(self.tentativas_por_documento))} "
+                f"tentativa(s) por documento"
+            )
+        if any(self.triagem.values()):
+            t = self.triagem
+            partes.append(
+                f"triagem pelo texto: {t['qr_texto']} com QR em texto na 1.ª/última página, "
+                f"{t['imagem_direta']} direto à imagem, "
+                f"{t['mais_paginas_qr_texto'] + t['mais_paginas_imagem']} com leitura das restantes páginas "
+                f"({t['mais_paginas_qr_texto']} com QR em texto, {t['mais_paginas_imagem']} à imagem)"
+            )
+        return "; ".join(partes) + "." if partes else ""
+
+
+def _padroes_localizacao(gray: np.ndarray) -> List[Tuple[int, int, int, int]]:
+    """
+    Procura os padrões de localização do QR (três quadrados concêntricos):
+    contornos com filho e neto na hierarquia, aproximadamente quadrados.
+    """
+    _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    contornos, hier = cv2.findContours(bw, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if hier is None:
+        return []
+    hier = hier[0]
+
+    caixas = []
+    for i, c in enumerate(contornos):
+        filho = hier[i][2]
+        if filho < 0 or hier[filho][2] < 0:
+            continue
+        x, y, w, h = cv2.boundingRect(c)
+        if min(w, h) < 6 or max(w, h) / min(w, h) > 1.5:
+            continue
+        caixas.append((x, y, w, h))
+    return caixas
+
+
+def _unir_regioes(regioes: List[List[float]]) -> List[List[float]]:
+    """Junta regiões (x0, y0, x1, y1) que se sobrepõem."""
+    regioes = [list(r) for r in regioes]
+    mudou = True
+    while mudou:
+        mudou = False
+        for i in range(len(regioes)):
+            for j in range(i + 1, len(regioes)):
+                a, b = regioes[i], regioes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regioes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regioes[j]
+                    mudou = True
+                    break
+            if mudou:
+                break
+    return regioes
+
+
+def regioes_candidatas_qr(bgr: np.ndarray, detector: cv2.QRCodeDetector) -> List[Tuple[float, float, float, float]]:
+    """
+    Regiões onde é provável estar o QR, em frações da página (x0, y0, x1, y1),
+    por ordem de confiança:
+    1. quadrilátero devolvido por detector.detect
+    2. agrupamentos de padrões de localização (finder patterns)
+    3. posições habituais do QR AT: canto inferior direito e rodapé
+    """
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if bgr.ndim == 3 else bgr
+    H, W = gray.shape[:2]
+    regioes: List[Tuple[float, float, float, float]] = []
+
+    def _normalizar(x0, y0, x1, y1):
+        return (max(0.0, x0 / W), max(0.0, y0 / H), min(1.0, x1 / W), min(1.0, y1 / H))
+
+    try:
+        ok, pts = detector.detect(gray)
+        if ok and pts is not None and len(pts.reshape(-1, 2)) >= 4:
+            pts = pts.reshape(-1, 2)
+            x0, y0 = pts.min(axis=0)
+            x1, y1 = pts.max(axis=0)
+            m = 0.25 * max(x1 - x0, y1 - y0)
+            regioes.append(_normalizar(x0 - m, y0 - m, x1 + m, y1 + m))
+    except Exception:
+        pass
+
+    try:
+        # Um QR tem até ~8 vezes o lado do padrão de localização (versões usuais)
+        finder = []
+        for x, y, w, h in _padroes_localizacao(gray):
+            lado = 8 * max(w, h)
+            cx, cy = x + w / 2, y + h / 2
+            finder.append([cx - lado, cy - lado, cx + lado, cy + lado])
+        finder = _unir_regioes(finder)
+        # Os agrupamentos mais pequenos primeiro: tipicamente são o próprio QR
+        finder.sort(key=lambda r: (r[2] - r[0]) * (r[3] - r[1]))
+        for r in finder[:4]:
+            regioes.append(_normalizar(*r))
+    except Exception:
+        pass
+
+    regioes.append((0.5, 0.6, 1.0, 1.0))  # canto inferior direito
+    regioes.append((0.0, 0.75, 1.0, 1.0))  # rodapé
+
+    unicas = []
+    for r in regioes:
+        if r[2] - r[0] > 0 and r[3] - r[1] > 0 and r not in unicas:
+            unicas.append(r)
+    return unicas
+
+
+def _recortar(img: np.ndarray, regiao: Tuple[float, float, float, float]) -> np.ndarray:
+    """Recorte (vista, sem cópia) de uma região em frações da imagem."""
+    H, W = img.shape[:2]
+    x0, y0, x1, y1 = regiao
+    return img[int(y0 * H):int(np.ceil(y1 * H)), int(x0 * W):int(np.ceil(x1 * W))]
+
+
+# Imagens embutidas candidatas a QR: pequenas e aproximadamente quadradas.
+QR_EMBUTIDO_LADO_MIN = 21
+QR_EMBUTIDO_LADO_MAX = 1500
+QR_EMBUTIDO_RACIO_MAX = 1.3
+# Imagens abaixo deste lado (px) têm ainda uma tentativa ampliada 2x
+QR_EMBUTIDO_AMPLIAR_ABAIXO = 300
+
+
+def _imagem_embutida_para_cinza(doc, xref: int) -> np.ndarray:
+    """Extrai uma imagem embutida na resolução nativa, em cinza."""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return img[:, :, 0].copy() if pix.n == 1 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+def _ler_imagem_embutida(doc, info: tuple, detector: cv2.QRCodeDetector) -> Optional[str]:
+    """Tenta ler um QR AT numa imagem embutida (info de page.get_images(full=True))."""
+    xref, largura, altura = info[0], info[2], info[3]
+
+    lado_min, lado_max = min(largura, altura), max(largura, altura)
+    if lado_min < QR_EMBUTIDO_LADO_MIN or lado_max > QR_EMBUTIDO_LADO_MAX:
+        return None
+    if lado_max / lado_min > QR_EMBUTIDO_RACIO_MAX:
+        return None
+
+    try:
+        gray = _imagem_embutida_para_cinza(doc, xref)
+    except Exception:
+        return None
+
+    # Os QR embutidos vêm muitas vezes recortados sem zona de silêncio,
+    # e as máscaras de 1 bit podem vir invertidas.
+    m = max(8, lado_min // 8)
+    for img in (gray, cv2.bitwise_not(gray)):
+        img = cv2.copyMakeBorder(img, m, m, m, m, cv2.BORDER_CONSTANT, value=255)
+        for _, var in _preprocess_variants(img, ordem=("cinza", "otsu")):
+            data = _decode_with_detector(detector, var, aceitar=_e_qr_at)
+            if data:
+                return data
+
+    # Imagens pequenas (poucos píxeis por módulo): uma tentativa ampliada 2x,
+    # sem interpolação para os módulos continuarem nítidos
+    if lado_max < QR_EMBUTIDO_AMPLIAR_ABAIXO:
+        img = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)
+        img = cv2.copyMakeBorder(img, 2 * m, 2 * m, 2 * m, 2 * m, cv2.BORDER_CONSTANT, value=255)
+        data = _decode_with_detector(detector, img, aceitar=_e_qr_at)
+        if data:
+            return data
+    return None
+
+
+def _e_qr_at(data: str) -> bool:
+    """QR AT: tem o NIF do emissor (A) e o do adquirente (B) ou o ATCUD (H)."""
+    campos = parse_qr_at(data)
+    return "A" in campos and ("B" in campos or "H" in campos)
+
+
+def ler_qr_imagens_embutidas(doc, detector: cv2.QRCodeDetector, paginas: Iterable[int]) -> Optional[str]:
+    """
+    Via rápida: tenta ler o QR diretamente das imagens embutidas nas páginas
+    (pela ordem dada), sem renderizar a página inteira. Só aceita um QR AT:
+    um QR de site ou de pagamento em imagem não pode esconder o QR AT
+    (muitas vezes desenhado em vetores), que fica para a renderização.
+    """
+    vistos = set()
+    for p in paginas:
+        try:
+            imagens = doc.load_page(p).get_images(full=True)
+        except Exception:
+            continue
+
+        for info in imagens:
+            if info[0] in vistos:
+                continue
+            vistos.add(info[0])
+
+            data = _ler_imagem_embutida(doc, info, detector)
+            if data:
+                return data
+
+    return None
+
+
+def _falta_memoria(e: Exception) -> bool:
+    """MuPDF e OpenCV não levantam MemoryError quando uma alocação falha."""
+    if isinstance(e, MemoryError):
+        return True
+    msg = str(e).lower()
+    return any(t in msg for t in ("malloc", "insufficient memory", "failed to allocate", "out of memory"))
+
+
+# Texto que costuma estar junto do QR (a AT obriga a imprimir o ATCUD)
+_RE_PISTA_QR = re.compile(r"\bATCUD\b|\bA:\s*\d{9}\s*\*", re.IGNORECASE)
+
+# Zoom da sonda visual que ordena as páginas das digitalizações
+ZOOM_SONDA_QR = 1.5
+
+# Páginas analisadas em simultâneo depois de falhar a página mais provável.
+# O OpenCV liberta o GIL; mesmo com poucos núcleos, intercalar as páginas
+# faz com que a que tem o QR termine cedo e cancele as outras.
+MAX_PAGINAS_PARALELO = 4
+
+# O MuPDF não é seguro entre threads: renderização sempre sob este lock
+_LOCK_MUPDF = threading.Lock()
+
+
+def ordenar_paginas_qr(doc, pages_to_try: int = 1, textos: Optional[List[str]] = None) -> List[int]:
+    """
+    Páginas a analisar (só as primeiras `pages_to_try`), da mais para a
+    menos provável de ter o QR AT: páginas cujo texto tem o ATCUD, a última
+    das candidatas, a primeira e depois as restantes. Sem pista no texto,
+    uma sonda visual (padrões de localização do QR) decide a ordem. Com
+    `pages_to_try` <= 1 é só a primeira página, como antes.
+    """
+    limite = min(max(pages_to_try, 1), doc.page_count)
+    if limite <= 1:
+        return [0] if limite else []
+
+    paginas: List[int] = []
+
+    def juntar(p: int):
+        if 0 <= p < limite and p not in paginas:
+            paginas.append(p)
+
+    if textos is None:
+        textos = []
+        for p in range(limite):
+            try:
+                textos.append(doc.load_page(p).get_text("text"))
+            except Exception:
+                textos.append("")
+
+    for p, texto in enumerate(textos[:limite]):
+        if _RE_PISTA_QR.search(texto or ""):
+            juntar(p)
+    n_pistas_texto = len(paginas)
+
+    juntar(limite - 1)
+    juntar(0)
+    for p in range(1, limite):
+        juntar(p)
+
+    # Sem pista no texto (digitalizações): sonda visual barata, e as páginas
+    # com aspeto de QR passam à frente (mantendo a ordem entre empates).
+    if n_pistas_texto == 0:
+        pontos = {p: _sonda_visual_qr(doc, p) for p in paginas}
+        paginas.sort(key=lambda p: -pontos[p])
+    return paginas
+
+
+def _sonda_visual_qr(doc, p: int) -> int:
+    """2 = o detetor encontra um QR; 1 = há 3+ padrões de localização; 0 = nada."""
+    try:
+        with _LOCK_MUPDF:
+            pix = doc.load_page(p).get_pixmap(matrix=fitz.Matrix(ZOOM_SONDA_QR, ZOOM_SONDA_QR), colorspace=fitz.csGRAY)
+        gray = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width)
+        ok, _ = cv2.QRCodeDetector().detect(gray)
+        if ok:
+            return 2
+        return 1 if len(_padroes_localizacao(gray)) >= 3 else 0
+    except Exception:
+        return 0
+
+
+def _ler_qr_pagina(
+    doc,
+    p: int,
+    ordem: List[Tuple[float, str, str]],
+    cancelar: Optional[threading.Event] = None,
+) -> Tuple[Optional[str], Optional[Tuple[float, str, str]], int]:
+    """
+    Corre a cascata numa página. Devolve (dados, tentativa vencedora, n.º de
+    tentativas). Pára cedo se `cancelar` for ativado (outra página já leu o QR).
+    """
+    detector = cv2.QRCodeDetector()
+    # A página só é renderizada quando a cascata pede um zoom maior do que
+    # o da maior render já feita; os zooms menores obtêm-se reduzindo essa
+    # render. Um documento lido à 1.ª tentativa custa uma só render, ao 1.º zoom.
+    n_tentativas = 0
+
+    base = None
+    zoom_base = 0.0
+    regioes = None
+    paginas = {}
+    geradores = {}
+
+    for tentativa in ordem:
+        if cancelar is not None and cancelar.is_set():
+            break
+
+        zoom, etapa, _ = tentativa
+        chave = (zoom, etapa)
+
+        if chave not in geradores:
+            geradores[chave] = None
+
+            if zoom not in paginas:
+                try:
+                    if zoom > zoom_base:
+                        with _LOCK_MUPDF:
+                            base = pagina_para_cv2(doc, page_index=p, zoom=zoom)
+                        zoom_base = zoom
+                    paginas[zoom] = redimensionar_zoom(base, zoom_base, zoom)
+                except Exception as e:
+                    if _falta_memoria(e):
+                        raise MemoryError(str(e)) from e
+                    paginas[zoom] = None
+
+            img_bgr = paginas[zoom]
+            imagens = [img_bgr] if img_bgr is not None else []
+
+            if img_bgr is not None and etapa == "regiao":
+                # Regiões calculadas uma vez por página, numa versão reduzida
+                if regioes is None:
+                    try:
+                        reduzida = redimensionar_zoom(base, zoom_base, min(ZOOM_REGIOES_QR, zoom_base))
+                        regioes = regioes_candidatas_qr(reduzida, detector)
+                    except Exception:
+                        regioes = []
+                imagens = [_recortar(img_bgr, r) for r in regioes]
+                imagens = [i for i in imagens if min(i.shape[:2]) >= QR_EMBUTIDO_LADO_MIN]
+
+            if img_bgr is not None and etapa == "warp":
+                # Detetar e warpar (uma vez por zoom)
+                try:
+                    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+                    ok, pts = detector.detect(gray)
+                    # detect devolve os cantos com forma (1, 4, 2)
+                    if ok and pts is not None and pts.reshape(-1, 2).shape[0] == 4:
+                        imagens = [_warp_quad(img_bgr, pts.reshape(-1, 2), pad=20)]
+                    else:
+                        imagens = []
+                except Exception:
+                    imagens = []
+
+            if imagens:
+                # As variantes de cada imagem seguem a mesma ordem relativa da cascata
+                ordem_var = [v for (z, e, v) in ordem if (z, e) == chave]
+                geradores[chave] = [_preprocess_variants(img, ordem=ordem_var) for img in imagens]
+
+        if geradores[chave] is None:
+            continue
+
+        try:
+            imgs = [next(g)[1] for g in geradores[chave]]
+        except Exception:
+            geradores[chave] = None
+            continue
+
+        n_tentativas += 1
+        for img in imgs:
+            # Um QR que não é AT (site, pagamento) não pára a cascata
+            data = _decode_with_detector(detector, img, aceitar=_e_qr_at)
+            if data:
+                return data, tentativa, n_tentativas
+
+    return None, None, n_tentativas
+
+
+def ler_qr_robusto(
+    doc,
+    pages_to_try: int = 1,
+    cascata: Optional[CascataQR] = None,
+    textos: Optional[List[str]] = None,
+) -> Optional[str]:
+    """
+    Leitura QR robusta:
+    - zooms múltiplos
+    - regiões candidatas recortadas antes do pré-processamento pesado
+    - variantes de pré-processamento (geradas só quando necessárias)
+    - detetar pontos -> warp -> tentar novamente
+    A ordem das tentativas vem de `cascata` (partilhada pelo lote, se dada).
+    Antes de renderizar, tenta as imagens embutidas na página (via rápida).
+
+    As páginas seguem ordenar_paginas_qr (`textos` = texto de cada página, se
+    já extraído): a mais provável é analisada sozinha; se falhar, as restantes
+    são analisadas em simultâneo e a primeira que ler o QR cancela as outras.
+    """
+    if cascata is None:
+        cascata = CascataQR()
+
+    paginas = ordenar_paginas_qr(doc, pages_to_try, textos)
+
+    if cascata.imagens_embutidas:
+        inicio = time.perf_counter()
+        data = ler_qr_imagens_embutidas(doc, cv2.QRCodeDetector(), paginas)
+        if data:
+            cascata.registar_via("imagem_embutida", time.perf_counter() - inicio)
+            return data
+
+    inicio = time.perf_counter()
+    ordem = cascata.ordem()
+    if not ordem or not paginas:
+        cascata.registar(None, 0)
+        return None
+
+    data, tentativa, n_tentativas = _ler_qr_pagina(doc, paginas[0], ordem)
+
+    restantes = paginas[1:]
+    if not data and restantes:
+        cancelar = threading.Event()
+        n_threads = min(len(restantes), MAX_PAGINAS_PARALELO)
+        with ThreadPoolExecutor(max_workers=n_threads) as ex:
+            futuros = [ex.submit(_ler_qr_pagina, doc, p, ordem, cancelar) for p in restantes]
+            for futuro in as_completed(futuros):
+                d, t, n = futuro.result()
+                n_tentativas += n
+                if d and not data:
+                    data, tentativa = d, t
+                    cancelar.set()
+                    for f in futuros:
+                        f.cancel()
+
+    if data:
+        cascata.registar(tentativa, n_tentativas)
+        cascata.registar_via("render", time.perf_counter() - inicio)
+        return data
+
+    cascata.registar(None, n_tentativas)
+    return None
+
+
+# ============================================================
+# 3. Texto do documento e QR em texto oculto
+# ============================================================
+
+def extrair_texto_doc(doc) -> str:
+    texto_total: List[str] = []
+    for page in doc:
+        texto_total.append(page.get_text("text"))
+    return "\n".join(texto_total)
+
+
+def extrair_qr_string_do_texto(texto: str) -> Optional[str]:
+    """Procura conteúdo do QR em texto oculto (quando existe)."""
+    if not texto:
+        return None
+    t = re.sub(r"\s+", " ", texto).strip()
+
+    m = re.search(r"\bA:.*?\bB:.*?\bF:", t)
+    if m:
+        return t[m.start():].strip()
+
+    m = re.search(r"\bA:.*?\bB:", t)
+    if m:
+        return t[m.start():].strip()
+
+    return None
+
+
+def parse_qr_at(data: str) -> dict:
+    """
+    Parser do QR AT:
+    - normaliza | para *
+    - remove espaços
+    - split por *
+    - split por ':' (1 vez)
+    """
+    if not data:
+        return {}
+
+    s = str(data).replace("|", "*")
+    s = re.sub(r"\s+", "", s)
+    parts = [p for p in s.split("*") if p]
+
+    res = {}
+    for p in parts:
+        if ":" not in p:
+            continue
+        k, v = p.split(":", 1)
+        if k and len(k) == 1 and k.isalpha():
+            res[k.upper()] = v
+    return res
+
+
+# ============================================================
+# 4. Extração de um PDF e API de lote
+# ============================================================
+
+# Abaixo disto a página não tem camada de texto útil (digitalização)
+TRIAGEM_MIN_CARATERES = 20
+
+# Campos do QR que tornam dispensável renderizar o documento
+CAMPOS_CHAVE_QR = ("A", "B", "F", "G")
+
+
+def _ler_textos(doc, textos: List[Optional[str]], paginas: Iterable[int]):
+    """Preenche `textos` (None = página ainda por ler) nas páginas pedidas."""
+    for p in paginas:
+        if textos[p] is None:
+            try:
+                textos[p] = doc.load_page(p).get_text("text")
+            except Exception:
+                textos[p] = ""
+
+
+def _juntar_textos(textos: List[Optional[str]]) -> str:
+    return "\n".join(t for t in textos if t is not None)
+
+
+def triagem_texto(doc, textos: List[Optional[str]]) -> str:
+    """
+    Decide o caminho de um documento lendo primeiro só o texto da 1.ª e da
+    última página (o resto só é lido depois, quando já não há renderização
+    a decidir):
+      "qr_texto"       QR em texto oculto com os campos-chave: não renderizar
+      "imagem_direta"  sem camada de texto, ou ATCUD impresso sem o QR em
+                       texto: renderizar já (o QR é imagem)
+      "mais_paginas"   há texto mas sem QR/ATCUD (ou QR incompleto):
+                       ler o texto das restantes páginas antes de renderizar
+    `textos` tem uma entrada por página (None = por ler) e é preenchido aqui.
+    """
+    n = len(textos)
+    extremos = sorted({0, n - 1}) if n else []
+    _ler_textos(doc, textos, extremos)
+
+    campos = parse_qr_at(extrair_qr_string_do_texto(_juntar_textos(textos)) or "")
+    if campos and all(k in campos for k in CAMPOS_CHAVE_QR):
+        return "qr_texto"
+    if n <= 2:
+        # Já está tudo lido
+        return "qr_texto" if campos else "imagem_direta"
+
+    if not any(len((textos[p] or "").strip()) >= TRIAGEM_MIN_CARATERES for p in extremos):
+        return "imagem_direta"
+    if not campos and any(_RE_PISTA_QR.search(textos[p] or "") for p in extremos):
+        return "imagem_direta"
+    return "mais_paginas"
+
+
+def extrair_conteudo_pdf(
+    ficheiro_bytes: bytes,
+    pages_to_try: int = 1,
+    cascata: Optional[CascataQR] = None,
+    textos: Optional[List[Optional[str]]] = None,
+) -> dict:
+    """
+    Parte cara do processamento: abre o PDF, faz a triagem pelo texto e, se
+    não houver QR em texto oculto, lê o QR por imagem. O resultado é
+    serializável (cache): {"texto", "qr_imagem", "texto_completo"}. "texto"
+    é o das páginas que a triagem leu; se faltarem páginas ("texto_completo"
+    False), ler_texto_completo lê-as quando um campo não aparecer.
+    `textos`: texto das páginas já lido (p.ex. por sondar_pdf), para não o reler.
+    """
+    doc = abrir_pdf_bytes(ficheiro_bytes)
+    try:
+        n = doc.page_count
+        if textos is not None and len(textos) == n:
+            textos = list(textos)
+        else:
+            textos = [None] * n
+        qr_imagem = ""
+
+        ramo = triagem_texto(doc, textos)
+        if ramo == "mais_paginas":
+            _ler_textos(doc, textos, range(n))
+            qr_str = extrair_qr_string_do_texto(_juntar_textos(textos))
+            ramo = "mais_paginas_qr_texto" if qr_str and parse_qr_at(qr_str) else "mais_paginas_imagem"
+
+        if ramo in ("imagem_direta", "mais_paginas_imagem"):
+            qr_imagem = ler_qr_robusto(
+                doc, pages_to_try=pages_to_try, cascata=cascata, textos=[t or "" for t in textos]
+            ) or ""
+
+        if cascata is not None:
+            cascata.registar_triagem(ramo)
+        return {
+            "texto": _juntar_textos(textos),
+            "qr_imagem": qr_imagem,
+            "texto_completo": all(t is not None for t in textos),
+        }
+    finally:
+        doc.close()
+
+
+def extrair_pdf(
+    ficheiro_bytes: bytes,
+    pages_to_try: int = 1,
+    cascata: Optional[CascataQR] = None,
+    cache: Optional[CachePDF] = None,
+    vigilante: Optional[VigilanteExtracao] = None,
+    multi: bool = False,
+    textos: Optional[List[Optional[str]]] = None,
+) -> dict:
+    """
+    Extrai um PDF, passando primeiro pela cache (se dada). Com `vigilante`,
+    a extração corre no processo isolado, sob o orçamento de tempo/memória.
+    Com `multi`, lê todos os documentos do PDF (ver extrair_conteudo_pdf_multi).
+    `textos`: páginas já lidas por sondar_pdf (ignorado com `multi`).
+    """
+    funcao = extrair_conteudo_pdf_multi if multi else extrair_conteudo_pdf
+    opcoes = {"pages_to_try": pages_to_try, "cascata": cascata}
+    if textos is not None and not multi:
+        opcoes["textos"] = textos
+
+    conteudo = None
+    if cache is not None:
+        parametros = f"multi;paginas={pages_to_try}" if multi else f"paginas={pages_to_try}"
+        chave = cache.chave(ficheiro_bytes, parametros)
+        conteudo = cache.obter(chave)
+
+    if conteudo is None:
+        if vigilante is not None:
+            conteudo = vigilante.extrair(ficheiro_bytes, funcao=funcao, **opcoes)
+        else:
+            conteudo = funcao(ficheiro_bytes, **opcoes)
+        if cache is not None:
+            cache.guardar(chave, conteudo)
+
+    return conteudo
+
+
+def sondar_pdf(
+    ficheiro_bytes: bytes,
+    pages_to_try: int = 1,
+    cache: Optional[CachePDF] = None,
+    textos: Optional[List[Optional[str]]] = None,
+) -> Optional[dict]:
+    """
+    Sonda barata, sem renderizar: devolve o mesmo que extrair_pdf quando o
+    resultado já está na cache ou quando o QR vem em texto oculto; senão None.
+    Serve para reconhecer documentos já registados antes do trabalho pesado.
+    O resultado da sonda fica na cache com a mesma chave de extrair_pdf.
+    Se `textos` for uma lista (vazia), fica com o texto de cada página
+    (None nas não lidas), para passar a extrair_pdf e não o reler.
+    """
+    chave = None
+    if cache is not None:
+        chave = cache.chave(ficheiro_bytes, f"paginas={pages_to_try}")
+        conteudo = cache.obter(chave, contar_miss=False)
+        if conteudo is not None:
+            return conteudo
+
+    doc = abrir_pdf_bytes(ficheiro_bytes)
+    try:
+        lidos: List[Optional[str]] = [None] * doc.page_count
+        ramo = triagem_texto(doc, lidos)
+        if ramo == "mais_paginas":
+            _ler_textos(doc, lidos, range(doc.page_count))
+    finally:
+        doc.close()
+
+    if textos is not None:
+        textos[:] = lidos
+
+    texto = _juntar_textos(lidos)
+    qr_str = extrair_qr_string_do_texto(texto)
+    if ramo != "imagem_direta" and qr_str and parse_qr_at(qr_str):
+        # É exatamente o que extrair_conteudo_pdf devolveria
+        conteudo = {"texto": texto, "qr_imagem": "", "texto_completo": all(t is not None for t in lidos)}
+        if cache is not None:
+            cache.guardar(chave, conteudo)
+        return conteudo
+    return None
+
+
+def ler_texto_completo(conteudo: dict, ficheiro_bytes: bytes) -> str:
+    """
+    Texto do documento todo. Se a extração só leu algumas páginas, abre o
+    PDF e lê-as todas (uma vez: o resultado fica em `conteudo`).
+    """
+    if conteudo.get("texto_completo", True):
+        return conteudo["texto"]
+
+    doc = abrir_pdf_bytes(ficheiro_bytes)
+    try:
+        conteudo["texto"] = extrair_texto_doc(doc)
+    finally:
+        doc.close()
+    conteudo["texto_completo"] = True
+    return conteudo["texto"]
+
+
+def extrair_lote(
+    ficheiros: Iterable[bytes],
+    pages_to_try: int = 1,
+    cascata: Optional[CascataQR] = None,
+    cache: Optional[CachePDF] = None,
+    vigilante: Optional[VigilanteExtracao] = None,
+    multi: bool = False,
+) -> List[dict]:
+    """
+    API de lote: uma lista de PDFs (bytes) dá uma lista de registos, pela
+    mesma ordem, com as opções de extrair_pdf (cache, vigilante, multi).
+    A cascata QR é partilhada por todo o lote. Um PDF que falhe (ou exceda
+    o orçamento do vigilante) dá {"erro": ...} em vez de interromper o lote.
+    `ficheiros` pode ser um gerador: cada PDF só é lido quando chega a vez.
+    """
+    if cascata is None:
+        cascata = CascataQR()
+
+    registos = []
+    for ficheiro_bytes in ficheiros:
+        try:
+            registos.append(extrair_pdf(
+                ficheiro_bytes,
+                pages_to_try=pages_to_try,
+                cascata=cascata,
+                cache=cache,
+                vigilante=vigilante,
+                multi=multi,
+            ))
+        except Exception as e:
+            registos.append({"erro": str(e)})
+    return registos
+
+
+# ============================================================
+# 5. Fontes de PDFs (uploads, ZIP, pasta no servidor)
+#
+# Cada fonte devolve (n.º de PDFs, iterador de (nome, ler)), em que
+# ler() só lê os bytes desse documento quando é chamado. O ciclo de
+# processamento lê, processa e liberta um documento de cada vez; um
+# erro de leitura (membro corrompido, demasiado grande) fica no
+# registo desse documento em vez de interromper o lote.
+# ============================================================
+
+# Limite por documento (protege contra ZIPs "bomba" e PDFs absurdos)
+PDF_MAX_MB = 200
+
+FontePDFs = Tuple[int, Iterator[Tuple[str, Callable[[], bytes]]]]
+
+
+def _e_pdf(nome: str) -> bool:
+    base = os.path.basename(nome)
+    return (
+        base.lower().endswith(".pdf")
+        and not base.startswith("._")  # metadados do macOS
+        and "__MACOSX/" not in nome.replace("\\", "/")
+    )
+
+
+def _verificar_tamanho(nome: str, tamanho: int):
+    if tamanho > PDF_MAX_MB * 1024 * 1024:
+        raise ValueError(f"{nome}: {tamanho / 1024 / 1024:.0f} MB excede o limite de {PDF_MAX_MB} MB")
+
+
+def pdfs_de_uploads(ficheiros: Iterable) -> FontePDFs:
+    """Ficheiros do st.file_uploader (já estão em memória; não se fazem cópias extra)."""
+    ficheiros = list(ficheiros or [])
+
+    def gerar():
+        for f in ficheiros:
+            yield f.name, f.getvalue
+
+    return len(ficheiros), gerar()
+
+
+def pdfs_de_zip(origem: Union[str, IO[bytes]]) -> FontePDFs:
+    """PDFs dentro de um ZIP (caminho ou ficheiro aberto), descomprimidos um a um."""
+    zf = zipfile.ZipFile(origem)
+    membros = sorted((m for m in zf.infolist() if not m.is_dir() and _e_pdf(m.filename)), key=lambda m: m.filename)
+
+    def ler_membro(m: zipfile.ZipInfo) -> Callable[[], bytes]:
+        def ler() -> bytes:
+            _verificar_tamanho(m.filename, m.file_size)
+            return zf.read(m)
+        return ler
+
+    def gerar():
+        try:
+            for m in membros:
+                yield m.filename, ler_membro(m)
+        finally:
+            zf.close()
+
+    return len(membros), gerar()
+
+
+def pdfs_de_pasta(caminho: str, recursivo: bool = True) -> FontePDFs:
+    """PDFs de uma pasta no servidor (nome = caminho relativo à pasta)."""
+    caminho = os.path.abspath(os.path.expanduser(caminho))
+    if not os.path.isdir(caminho):
+        raise FileNotFoundError(f"Pasta não encontrada: {caminho}")
+
+    encontrados = []
+    for raiz, pastas, nomes in os.walk(caminho):
+        pastas.sort()
+        encontrados.extend(os.path.join(raiz, n) for n in sorted(nomes) if _e_pdf(n))
+        if not recursivo:
+            break
+
+    def ler_ficheiro(p: str) -> Callable[[], bytes]:
+        def ler() -> bytes:
+            _verificar_tamanho(p, os.path.getsize(p))
+            with open(p, "rb") as fh:
+                return fh.read()
+        return ler
+
+    def gerar():
+        for p in encontrados:
+            yield os.path.relpath(p, caminho), ler_ficheiro(p)
+
+    return len(encontrados), gerar()
+
+
+# ============================================================
+# 6. Orçamento por documento (processo isolado com vigilância)
+#
+# Um PDF patológico (digitalização de 60 páginas, página que faz o
+# detectAndDecodeMulti "encravar") não pode parar o lote. Cada PDF é
+# enviado a um processo trabalhador; se não responder dentro do tempo,
+# o trabalhador é morto e substituído e o documento fica com ERRO
+# "timeout". Em Linux o trabalhador tem também um teto de memória.
+# ============================================================
+
+TEMPO_MAX_DOC_S = 60
+MEMORIA_MAX_DOC_MB = 1536
+# Arranque do trabalhador (importar OpenCV/PyMuPDF) não conta para o orçamento
+TEMPO_ARRANQUE_S = 120
+
+
+class OrcamentoExcedido(RuntimeError):
+    """Documento abandonado por exceder o orçamento de tempo ou de memória."""
+
+
+def _limitar_memoria(max_mb: float):
+    """Teto de espaço de endereçamento (só onde há RLIMIT_AS e /proc)."""
+    try:
+        import resource
+
+        with open("/proc/self/statm") as fh:
+            atual = int(fh.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (ImportError, OSError, ValueError, AttributeError):
+        return
+    limite = atual + int(max_mb * 1024 * 1024)
+    resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+
+
+def _trabalhador_extracao(conn, memoria_max_mb: float):
+    _limitar_memoria(memoria_max_mb)
+    conn.send("pronto")
+
+    while True:
+        try:
+            pedido = conn.recv()
+        except EOFError:
+            break
+        if pedido is None:
+            break
+
+        funcao, ficheiro_bytes, opcoes = pedido
+        cascata = opcoes.get("cascata")
+        try:
+            conteudo = funcao(ficheiro_bytes, **opcoes)
+            conn.send(("ok", conteudo, cascata))
+        except MemoryError:
+            del pedido, ficheiro_bytes
+            conn.send(("memoria", None, cascata))
+            break
+        except Exception as e:
+            conn.send(("erro", f"{type(e).__name__}: {e}", cascata))
+
+
+class VigilanteExtracao:
+    """
+    Executa a extração de um PDF num processo trabalhador, um documento de
+    cada vez, com limite de tempo (e de memória, em Linux) por documento.
+    A cascata do lote vai e volta com cada pedido, para continuar a aprender.
+    Usar como context manager (ou chamar fechar()) para terminar o trabalhador.
+    """
+
+    def __init__(self, tempo_max_s: float = TEMPO_MAX_DOC_S, memoria_max_mb: float = MEMORIA_MAX_DOC_MB):
+        self.tempo_max_s = tempo_max_s
+        self.memoria_max_mb = memoria_max_mb
+        self.timeouts = 0
+        self.excessos_memoria = 0
+        self.reciclagens = 0
+        # "spawn": o processo do Streamlit tem threads, fork não é seguro
+        self._ctx = multiprocessing.get_context("spawn")
+        self._proc = None
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+
+    def _arrancar(self):
+        self._conn, filho = self._ctx.Pipe()
+        self._proc = self._ctx.Process(
+            target=_trabalhador_extracao, args=(filho, self.memoria_max_mb), daemon=True
+        )
+        self._proc.start()
+        filho.close()
+        try:
+            pronto = self._conn.poll(TEMPO_ARRANQUE_S) and self._conn.recv() == "pronto"
+        except (OSError, EOFError):
+            pronto = False
+        if not pronto:
+            self._parar()
+            raise RuntimeError("O processo de leitura de PDFs não arrancou.")
+
+    def _parar(self):
+        if self._proc is None:
+            return
+        if self._proc.is_alive():
+            self._proc.kill()
+        self._proc.join(5)
+        self._conn.close()
+        self._proc = None
+        self._conn = None
+
+    def _reciclar(self):
+        self._parar()
+        self.reciclagens += 1
+
+    def fechar(self):
+        if self._proc is not None and self._proc.is_alive():
+            try:
+                self._conn.send(None)
+                self._proc.join(2)
+            except (OSError, EOFError):
+                pass
+        self._parar()
+
+    def extrair(
+        self,
+        ficheiro_bytes: bytes,
+        pages_to_try: int = 1,
+        cascata: Optional[CascataQR] = None,
+        funcao: Optional[Callable[..., dict]] = None,
+        **opcoes,
+    ) -> dict:
+        """
+        `funcao`: extrair_conteudo_pdf (por omissão) ou extrair_conteudo_pdf_multi.
+        `opcoes`: argumentos extra da função (p.ex. `textos`).
+        """
+        if self._proc is None or not self._proc.is_alive():
+            self._parar()
+            self._arrancar()
+
+        try:
+            opcoes.update(pages_to_try=pages_to_try, cascata=cascata)
+            self._conn.send((funcao or extrair_conteudo_pdf, ficheiro_bytes, opcoes))
+            pronto = self._conn.poll(self.tempo_max_s)
+        except (OSError, EOFError):
+            pronto = False
+
+        if not pronto:
+            self.timeouts += 1
+            self._reciclar()
+            raise OrcamentoExcedido("timeout")
+
+        try:
+            estado, valor, cascata_nova = self._conn.recv()
+        except (OSError, EOFError):
+            # Trabalhador morreu (p.ex. OOM killer)
+            self.excessos_memoria += 1
+            self._reciclar()
+            raise OrcamentoExcedido("memória excedida (processo de leitura terminou)")
+
+        if cascata is not None:
+            cascata.__dict__.update(cascata_nova.__dict__)
+
+        if estado == "memoria":
+            self.excessos_memoria += 1
+            self._reciclar()
+            raise OrcamentoExcedido("memória excedida")
+        if estado == "erro":
+            raise RuntimeError(valor)
+        return valor
+
+    def resumo(self) -> str:
+        return (
+            f"Orçamento por documento: {self.tempo_max_s:g} s / {self.memoria_max_mb:g} MB; "
+            f"{self.timeouts} timeout(s), {self.excessos_memoria} por memória, "
+            f"{self.reciclagens} reinício(s) do processo de leitura."
+        )
+
+
+# ============================================================
+# 7. PDFs com vários documentos fiscais
+#
+# Exportações de portais de fornecedores juntam muitas faturas num
+# PDF, e uma digitalização pode ter vários talões na mesma página.
+# Aqui cada página é renderizada uma vez, todos os QR são recolhidos
+# (texto oculto, imagens embutidas, detectAndDecodeMulti) e
+# deduplicados pelo ATCUD (campo H).
+# ============================================================
+
+ZOOM_MULTI_QR = 3.0
+VARIANTES_MULTI_QR = ("cinza", "clahe", "otsu")
+
+# Início de um QR AT em texto: A:<NIF>*B:
+_RE_INICIO_QR_TEXTO = re.compile(r"\bA:\s*\d{9}\s*\*\s*B:")
+
+
+def _decode_todos(detector: cv2.QRCodeDetector, img) -> List[str]:
+    try:
+        ok, decoded_info, _, _ = detector.detectAndDecodeMulti(img)
+    except Exception:
+        return []
+    if not ok or not decoded_info:
+        return []
+    return [d.strip() for d in decoded_info if d and d.strip()]
+
+
+def qrs_do_texto(texto: str) -> List[str]:
+    """Todos os QR AT em texto oculto (um por ocorrência de 'A:<NIF>*B:')."""
+    if not texto:
+        return []
+    t = re.sub(r"\s+", " ", texto).strip()
+    inicios = [m.start() for m in _RE_INICIO_QR_TEXTO.finditer(t)]
+    return [t[a:b].strip() for a, b in zip(inicios, inicios[1:] + [len(t)])]
+
+
+def chave_documento_qr(qr: str) -> str:
+    """ATCUD (H) quando existe; senão emissor + n.º do documento; senão o próprio QR."""
+    campos = parse_qr_at(qr)
+    atcud = (campos.get("H") or "").strip()
+    if atcud and atcud != "0":
+        return f"H:{atcud}"
+    if campos.get("A") and campos.get("G"):
+        return f"A:{normalizar_nif(campos['A'])}|G:{campos['G'].strip()}"
+    return re.sub(r"\s+", "", qr)
+
+
+def _qrs_da_pagina_renderizada(doc, p: int, detector: cv2.QRCodeDetector) -> List[str]:
+    bgr = pagina_para_cv2(doc, page_index=p, zoom=ZOOM_MULTI_QR)
+
+    encontrados: List[str] = []
+    for _, var in _preprocess_variants(bgr, ordem=VARIANTES_MULTI_QR):
+        encontrados.extend(_decode_todos(detector, var))
+    if encontrados:
+        return encontrados
+
+    # Nada na página inteira: QR isolados nas regiões candidatas
+    for r in regioes_candidatas_qr(bgr, detector):
+        recorte = _recortar(bgr, r)
+        if min(recorte.shape[:2]) < QR_EMBUTIDO_LADO_MIN:
+            continue
+        for _, var in _preprocess_variants(recorte, ordem=VARIANTES_MULTI_QR):
+            data = _decode_with_detector(detector, var)
+            if data:
+                encontrados.append(data)
+                break
+    return encontrados
+
+
+def ler_todos_qr(doc, max_pages: int = 0) -> List[dict]:
+    """
+    Todos os documentos fiscais (QR AT) das primeiras `max_pages` páginas
+    (0 = todas), pela ordem em que aparecem:
+        [{"qr": ..., "paginas": [1, 2]}, ...]   (páginas a contar de 1)
+    Um QR repetido (mesmo ATCUD) junta as páginas num só documento.
+    """
+    detector = cv2.QRCodeDetector()
+    n_paginas = doc.page_count if max_pages <= 0 else min(max_pages, doc.page_count)
+
+    documentos: Dict[str, dict] = {}
+    for p in range(n_paginas):
+        page = doc.load_page(p)
+
+        # Texto oculto e imagens embutidas primeiro; só se renderiza a página
+        # quando nenhuma das vias baratas encontrou QR.
+        qrs = qrs_do_texto(page.get_text("text"))
+        vistos = set()
+        for info in page.get_images(full=True):
+            if info[0] not in vistos:
+                vistos.add(info[0])
+                data = _ler_imagem_embutida(doc, info, detector)
+                if data:
+                    qrs.append(data)
+
+        if not qrs:
+            try:
+                qrs = _qrs_da_pagina_renderizada(doc, p, detector)
+            except Exception as e:
+                if _falta_memoria(e):
+                    raise MemoryError(str(e)) from e
+                qrs = []
+
+        for qr in qrs:
+            if not parse_qr_at(qr).get("A"):
+                continue
+            doc_qr = documentos.setdefault(chave_documento_qr(qr), {"qr": qr, "paginas": []})
+            if p + 1 not in doc_qr["paginas"]:
+                doc_qr["paginas"].append(p + 1)
+
+    return list(documentos.values())
+
+
+def extrair_conteudo_pdf_multi(
+    ficheiro_bytes: bytes,
+    pages_to_try: int = 0,
+    cascata: Optional[CascataQR] = None,
+) -> dict:
+    """
+    Como extrair_conteudo_pdf, mas para PDFs com vários documentos:
+        {"texto": ..., "documentos": [{"qr", "paginas", "texto"}, ...]}
+    O "texto" de cada documento é o das suas páginas. `pages_to_try` limita
+    as páginas lidas (0 = todas); `cascata` não é usada (a leitura é
+    exaustiva), existe só para a assinatura ser a mesma.
+    """
+    doc = abrir_pdf_bytes(ficheiro_bytes)
+    try:
+        textos = [page.get_text("text") for page in doc]
+        documentos = ler_todos_qr(doc, max_pages=pages_to_try)
+        for d in documentos:
+            d["texto"] = "\n".join(textos[p - 1] for p in d["paginas"])
+        return {"texto": "\n".join(textos), "documentos": documentos}
+    finally:
+        doc.close()
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from extracao_pdf import formatar_data_ddmmaaaa, nif_valido, normalizar_monetario
+
+
+# ============================================================
+# CAMPOS DA FATURA POR TEXTO (fallback sem QR)
+#
+# O texto é normalizado uma vez (minúsculas, sem quebras de linha) e
+# percorrido uma vez por uma única expressão pré-compilada com todos os
+# rótulos (Data de Emissão, Total..., NIF/Contribuinte, Encomenda,
+# N.º Documento), o n.º de documento (FT/FR/...) e o tipo de documento.
+# O valor de cada rótulo é lido com um match ancorado no fim do rótulo.
+# Só sem rótulo se procuram NIF/datas/encomendas "soltos", parando no
+# primeiro candidato válido (NIF com dígito de controlo).
+# No fim aplicam-se as prioridades dos antigos extratores por campo.
+#
+# Nota: as alternativas começam por letras concretas (sem \b à cabeça)
+# para o motor de regex saltar depressa as zonas de artigos/valores;
+# as fronteiras de palavra verificam-se depois, só nos tokens.
+# ============================================================
+
+_RE_TOKENS = re.compile(
+    r"""
+    (?=[cdefnortv])
+    (?:
+      (?P<rot_data>data\s+(?:de\s+)?emiss[aã]o)
+    | (?P<rot_total>total(?P<total_tipo>\s+a\s+pagar|\s+geral|\s+\(eur\))?)
+    | (?P<rot_contribuinte>contribuinte)
+    | (?P<rot_nif>n\.?if)
+    | (?P<rot_enc>(?:vossa\s+)?(?P<enc_tipo>encomenda|requisi[cç][aã]o)|o/ref)
+    | (?P<rot_doc>n[ºo]\.?\s*documento)
+    | (?P<num_doc>(?P<doc_tipo>ft|fr|fs|nc|nd|vd)\s*(?P<doc_serie>[a-z0-9]{0,20})\s*[/-]\s*(?P<doc_num>\d{1,12})(?!\w))
+    | (?P<tipo>nota\s+de\s+cr[ée]dito|fatura-recibo|venda\s+a\s+dinheiro|fatura\s+simplificada|fatura)
+    )
+    """,
+    re.VERBOSE,
+)
+
+# Rótulos que exigem fronteira de palavra antes (como os padrões antigos;
+# "Total" não a exigia, por isso "Subtotal" também conta)
+_ROTULOS_COM_FRONTEIRA = {"rot_contribuinte", "rot_nif", "rot_doc", "num_doc"}
+
+# Valor de cada rótulo, ancorado no fim do rótulo
+_RE_DATA_APOS_ROTULO = re.compile(r"[:\s]*(\d{2}[./-]\d{2}[./-]\d{4})")
+_RE_NIF_SEM_PT_APOS_ROTULO = re.compile(r":?\s*(\d{9})(?!\w)")
+_RE_NIF_APOS_ROTULO = re.compile(r":?\s*(?:pt?\s*)?(\d{9})(?!\w)")
+_RE_ENC_APOS_ROTULO = re.compile(r"[:\s.]*(\d{3,15})")
+_RE_DOC_APOS_ROTULO = re.compile(r"[:\s]*([a-z0-9/ -]{3,40})\b")
+
+# Valores monetários (procura a partir do rótulo "Total")
+_RE_VALOR_VIRGULA = re.compile(r"(?:\d{1,3}(?:\.\d{3})+|\d+),\d{2}(?!\d)")
+_RE_VALOR_VIRGULA_EURO = re.compile(r"((?:\d{1,3}(?:\.\d{3})+|\d+),\d{2})(?!\d)\s*€")
+_RE_VALOR_PONTO_EURO = re.compile(r"(\d+\.\d{2})(?!\d)\s*€")
+
+# Candidatos sem rótulo
+_RE_NIF_SOLTO = re.compile(r"\b\d{9}\b")
+_RE_DATA_ISO = re.compile(r"\d{4}-\d{2}-\d{2}")
+_RE_DATA_DMY = re.compile(r"\b\d{2}[./-]\d{2}[./-]\d{4}\b")
+_RE_ENCOMENDA = re.compile(r"(?<!\d)[123478]\d{4}25(?!\d)")
+
+_TIPOS = {
+    "nota de crédito": "Nota de Crédito",
+    "nota de credito": "Nota de Crédito",
+    "fatura-recibo": "Fatura-Recibo",
+    "venda a dinheiro": "Venda a Dinheiro",
+    "fatura simplificada": "Fatura Simplificada",
+    "fatura": "Fatura",
+}
+_PRIORIDADE_TIPOS = ("Nota de Crédito", "Fatura-Recibo", "Venda a Dinheiro", "Fatura Simplificada", "Fatura")
+
+# (rótulo, regex do valor): mesma ordem de prioridade dos padrões antigos
+_REGRAS_TOTAL = (
+    ("apagar", _RE_VALOR_VIRGULA),
+    ("geral", _RE_VALOR_VIRGULA),
+    ("eur", _RE_VALOR_VIRGULA),
+    ("total", _RE_VALOR_VIRGULA_EURO),
+    ("total", _RE_VALOR_PONTO_EURO),
+)
+
+
+def _e_palavra(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+def _primeiro_nif_valido(candidatos: Iterable[str], vistos: set) -> str:
+    for c in candidatos:
+        if c in vistos:
+            continue
+        vistos.add(c)
+        if nif_valido(c):
+            return c
+    return ""
+
+
+def extrair_campos_texto(texto: str, nome_ficheiro: str = "") -> Dict[str, str]:
+    """
+    Extrai num só varrimento os campos de fallback de uma fatura:
+    {"nif", "data", "total", "numero", "tipo", "encomenda"}.
+    """
+    texto_norm = (texto or "").replace("\n", " ")
+    texto_min = texto_norm.lower()
+    if len(texto_min) != len(texto_norm):
+        # Raro (carateres que mudam de tamanho em minúsculas): as posições
+        # deixam de coincidir, os valores vêm do texto em minúsculas.
+        texto_norm = texto_min
+
+    # Por prioridade: Contribuinte, NIF, N.IF (a ordem dos padrões antigos)
+    nifs_contribuinte: List[str] = []
+    nifs_nif: List[str] = []
+    nifs_n_if: List[str] = []
+    data_emissao = ""
+    rotulos_total: Dict[str, int] = {}
+    numero = numero_rotulado = ""
+    # Por prioridade: Encomenda, Requisição, O/Ref (a ordem dos padrões antigos)
+    encomendas: Dict[str, str] = {"encomenda": "", "requisicao": "", "oref": ""}
+    tipos = set()
+
+    for m in _RE_TOKENS.finditer(texto_min):
+        g = m.lastgroup
+        inicio, fim = m.span()
+        if g in _ROTULOS_COM_FRONTEIRA and inicio and _e_palavra(texto_min[inicio - 1]):
+            continue
+
+        if g == "rot_total":
+            tipo_total = re.sub(r"\W+", "", m.group("total_tipo") or "") or "total"
+            rotulos_total.setdefault(tipo_total, inicio)
+            rotulos_total.setdefault("total", inicio)
+
+        elif g == "rot_contribuinte":
+            v = _RE_NIF_SEM_PT_APOS_ROTULO.match(texto_min, fim)
+            if v:
+                nifs_contribuinte.append(v.group(1))
+
+        elif g == "rot_nif":
+            if m.group() == "nif":
+                v = _RE_NIF_APOS_ROTULO.match(texto_min, fim)
+                if v:
+                    nifs_nif.append(v.group(1))
+            else:
+                v = _RE_NIF_SEM_PT_APOS_ROTULO.match(texto_min, fim)
+                if v:
+                    nifs_n_if.append(v.group(1))
+
+        elif g == "rot_data":
+            if not data_emissao:
+                v = _RE_DATA_APOS_ROTULO.match(texto_min, fim)
+                if v:
+                    data_emissao = v.group(1)
+
+        elif g == "rot_enc":
+            enc_tipo = m.group("enc_tipo")
+            tipo_enc = "oref" if not enc_tipo else "encomenda" if enc_tipo == "encomenda" else "requisicao"
+            if not encomendas[tipo_enc]:
+                v = _RE_ENC_APOS_ROTULO.match(texto_min, fim)
+                if v:
+                    encomendas[tipo_enc] = v.group(1)
+
+        elif g == "rot_doc":
+            if not numero_rotulado:
+                v = _RE_DOC_APOS_ROTULO.match(texto_min, fim)
+                if v:
+                    numero_rotulado = texto_norm[v.start(1):v.end(1)].strip()
+
+        elif g == "num_doc":
+            if not numero:
+                serie = m.group("doc_serie").upper().strip()
+                numero = f"{m.group('doc_tipo').upper()} {serie}/{m.group('doc_num')}".replace("  ", " ").strip()
+
+        elif g == "tipo":
+            tipos.add(_TIPOS.get(re.sub(r"\s+", " ", m.group()), "Fatura"))
+
+    # ---------------- NIF: nome do ficheiro, rotulados e, por fim, soltos ----------------
+    vistos: set = set()
+    nif = _primeiro_nif_valido(
+        _RE_NIF_SOLTO.findall(Path(nome_ficheiro).stem) + nifs_contribuinte + nifs_nif + nifs_n_if, vistos
+    )
+    if not nif:
+        nif = _primeiro_nif_valido((m.group() for m in _RE_NIF_SOLTO.finditer(texto_min)), vistos)
+
+    # ---------------- Data ----------------
+    data = data_emissao
+    if not data:
+        m = _RE_DATA_ISO.search(texto_min) or _RE_DATA_DMY.search(texto_min)
+        data = m.group() if m else ""
+
+    # ---------------- Total ----------------
+    total = ""
+    for tipo_total, padrao in _REGRAS_TOTAL:
+        if tipo_total in rotulos_total:
+            m = padrao.search(texto_min, rotulos_total[tipo_total])
+            if m:
+                total = normalizar_monetario(m.group(1) if m.re.groups else m.group())
+                break
+
+    # ---------------- Tipo ----------------
+    tipo = next((t for t in _PRIORIDADE_TIPOS if t in tipos), "")
+    if not tipo:
+        tipo = "Nota de Crédito" if "credito" in nome_ficheiro.lower() else "Fatura"
+
+    # ---------------- Encomenda ----------------
+    m = _RE_ENCOMENDA.search(texto_min)
+    encomenda = m.group() if m else next((v for v in encomendas.values() if v), "")
+
+    return {
+        "nif": nif,
+        "data": formatar_data_ddmmaaaa(data),
+        "total": total,
+        "numero": numero or numero_rotulado,
+        "tipo": tipo,
+        "encomenda": encomenda,
+    }
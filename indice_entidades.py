@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import math
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+# ============================================================
+# ÍNDICE APROXIMADO EMPRESA -> ENTIDADE (APIFARMA / PAYBACK)
+#
+# Os nomes das empresas nos ficheiros dos laboratórios nem sempre
+# coincidem com os do mapeamento ("LDA." vs "LDA", acentos, texto
+# com mojibake, "S.A." vs "SA"). O índice é construído uma vez por
+# mapeamento:
+#   1. chave normalizada: mojibake reparado, acentos retirados,
+#      pontuação e sufixos societários (LDA, SA, UNIPESSOAL...) fora;
+#   2. índice invertido de trigramas de carateres dessa chave, com
+#      peso IDF (palavras como FARMACEUTICOS ou PORTUGAL pesam pouco).
+# Procura: exata primeiro; depois semelhança (Dice ponderado) contra
+# os candidatos que partilham trigramas, aceite só acima do limiar.
+# ============================================================
+
+# Semelhança mínima para aceitar uma correspondência aproximada
+LIMIAR_SEMELHANCA = 0.82
+
+SUFIXOS_SOCIETARIOS = {
+    "LDA", "LIMITADA", "SA", "SNC", "SGPS", "UNIPESSOAL", "SU", "CRL",
+    "SL", "SAS", "SRL", "SPA", "BV", "NV", "AG", "GMBH", "LTD", "PLC", "INC", "CORP",
+}
+
+_RE_MOJIBAKE = re.compile("[ÃÂ]")
+
+
+class Correspondencia(NamedTuple):
+    entidade: Optional[str]      # None: empresa conhecida sem entidade, ou sem correspondência
+    empresa_mapa: str            # nome no mapeamento ("" sem correspondência)
+    semelhanca: float            # 1.0 nas correspondências exatas
+    tipo: str                    # "exata", "normalizada", "aproximada" ou "sem_mapa"
+
+
+def reparar_mojibake(s: str) -> str:
+    """'FARMACÃŠUTICA' (UTF-8 lido como latin-1/cp1252) -> 'FARMACÊUTICA'."""
+    if not _RE_MOJIBAKE.search(s):
+        return s
+    for enc in ("cp1252", "latin-1"):
+        try:
+            return s.encode(enc).decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            continue
+    return s
+
+
+def chave_empresa(nome: str) -> str:
+    """Chave de comparação: sem acentos, pontuação e sufixos societários."""
+    s = reparar_mojibake(str(nome or ""))
+    s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii").upper()
+    s = s.replace("&", " E ").replace(".", "")
+    tokens = re.sub(r"[^A-Z0-9]+", " ", s).split()
+    sem_sufixos = [t for t in tokens if t not in SUFIXOS_SOCIETARIOS]
+    return " ".join(sem_sufixos or tokens)
+
+
+def _trigramas(chave: str) -> set:
+    s = f"  {chave} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class IndiceEntidades:
+    def __init__(self, entradas: Iterable[Tuple[str, Optional[str]]], limiar: float = LIMIAR_SEMELHANCA):
+        """`entradas`: pares (empresa, entidade), com entidade None quando não tem código."""
+        self.limiar = limiar
+        self._exatas: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._chaves: Dict[str, Tuple[str, Optional[str]]] = {}
+        for empresa, entidade in entradas:
+            empresa = str(empresa).strip()
+            if not empresa:
+                continue
+            # Como no dicionário do mapeamento: a última linha repetida prevalece
+            self._exatas[re.sub(r"\s+", " ", empresa).upper()] = (empresa, entidade)
+            self._chaves[chave_empresa(empresa)] = (empresa, entidade)
+
+        # Índice invertido trigrama -> chaves, com pesos IDF
+        self._documentos = list(self._chaves)
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+        for i, chave in enumerate(self._documentos):
+            for t in _trigramas(chave):
+                self._postings[t].append(i)
+        n = max(len(self._documentos), 1)
+        self._idf = {t: math.log(1 + n / len(docs)) for t, docs in self._postings.items()}
+        self._idf_ausente = math.log(1 + n)
+        self._peso_doc = [sum(self._idf[t] for t in _trigramas(c)) for c in self._documentos]
+        self._memo: Dict[str, Correspondencia] = {}
+
+    @classmethod
+    def de_dataframe(cls, mapping_df, limiar: float = LIMIAR_SEMELHANCA) -> "IndiceEntidades":
+        """Mapeamento com colunas Empresa;Entidade (Entidade vazia = empresa sem código)."""
+        entradas = []
+        for emp, ent in zip(mapping_df["Empresa"], mapping_df["Entidade"]):
+            ent = str(ent).strip()
+            if ent.endswith(".0"):
+                ent = ent[:-2]
+            if not ent or ent.lower() in ("nan", "none"):
+                ent = None
+            entradas.append((emp, ent))
+        return cls(entradas, limiar=limiar)
+
+    def procurar(self, empresa: str) -> Correspondencia:
+        """Exata, depois pela chave normalizada, depois a mais semelhante acima do limiar."""
+        chave_exata = re.sub(r"\s+", " ", str(empresa).strip()).upper()
+        memo = self._memo.get(chave_exata)
+        if memo is not None:
+            return memo
+
+        if chave_exata in self._exatas:
+            nome, ent = self._exatas[chave_exata]
+            res = Correspondencia(ent, nome, 1.0, "exata")
+        else:
+            chave = chave_empresa(empresa)
+            if chave in self._chaves:
+                nome, ent = self._chaves[chave]
+                res = Correspondencia(ent, nome, 1.0, "normalizada")
+            else:
+                res = self._aproximada(chave)
+
+        self._memo[chave_exata] = res
+        return res
+
+    def _aproximada(self, chave: str) -> Correspondencia:
+        peso_q = 0.0
+        comuns: Dict[int, float] = defaultdict(float)
+        for t in _trigramas(chave):
+            peso = self._idf.get(t)
+            if peso is None:
+                # Trigramas que não existem no mapeamento só contam no peso da consulta
+                peso_q += self._idf_ausente
+                continue
+            peso_q += peso
+            for i in self._postings[t]:
+                comuns[i] += peso
+
+        melhor, melhor_score = None, 0.0
+        for i, peso in comuns.items():
+            score = 2 * peso / (peso_q + self._peso_doc[i])
+            if score > melhor_score:
+                melhor, melhor_score = i, score
+
+        if melhor is None or melhor_score < self.limiar:
+            return Correspondencia(None, "", melhor_score, "sem_mapa")
+        nome, ent = self._chaves[self._documentos[melhor]]
+        return Correspondencia(ent, nome, melhor_score, "aproximada")
@@ -10,6 +10,8 @@ import pandas as pd
 import streamlit as st
 from openpyxl.utils import get_column_letter
 
+from codificacao import descodificar
+
 
 # ============================================================
 # CONFIGURAÇÃO DA PÁGINA
@@ -78,15 +80,11 @@ def formatar_euro(valor: float) -> str:
 
 
 def descodificar_csv(dados: bytes) -> str:
-    for encoding in ("utf-8-sig", "cp1252", "latin1"):
-        try:
-            texto = dados.decode(encoding)
-            if ";" in texto:
-                return texto
-        except UnicodeDecodeError:
-            continue
-
-    return dados.decode("latin1", errors="replace")
+    try:
+        texto, _ = descodificar(dados, alternativas=("cp1252", "latin1"))
+        return texto
+    except UnicodeDecodeError:
+        return dados.decode("latin1", errors="replace")
 
 
 def encontrar_coluna(colunas: Iterable[str], alternativas: Iterable[str]) -> str | None:
@@ -1,16 +1,33 @@
 import io
+import os
 import re
 from datetime import datetime
-from pathlib import Path
-from typing import Optional, List
+from typing import Callable, List, Optional
 
-import cv2
-import fitz  # PyMuPDF
-import numpy as np
 import pandas as pd
 import streamlit as st
-from PIL import Image
 
+from cache_pdf import CachePDF, sha256_bytes
+from excel_incremental import LivroXlsx
+from extracao_pdf import (
+    NOME_EXTRATOR,
+    TEMPO_MAX_DOC_S,
+    VERSAO_EXTRATOR,
+    CascataQR,
+    VigilanteExtracao,
+    extrair_pdf,
+    extrair_qr_string_do_texto,
+    formatar_data_ddmmaaaa,
+    formatar_valor_pt,
+    ler_texto_completo,
+    normalizar_monetario_para_float,
+    normalizar_nif,
+    parse_qr_at,
+    pdfs_de_pasta,
+    pdfs_de_uploads,
+    pdfs_de_zip,
+    sondar_pdf,
+)
 
 # ============================================================
 # 0. Configuração
@@ -32,94 +49,21 @@ COLUNAS_CONTROLO = COLUNAS_EXCEL + [
     "Origem",
     "NIF Emissor QR",
     "QR bruto",
+    "Hash PDF",
 ]
 
 CHAVE_COLS = ["Empresa", "Nº da NC"]
 
+# Folha auxiliar do Excel com o SHA-256 de cada PDF já registado, para
+# reconhecer PDFs repetidos (mesmo com outro nome) sem os voltar a ler.
+FOLHA_INDICE = "Indice_PDFs"
+COLUNAS_INDICE = ["Nome do ficheiro", "Hash PDF", "Empresa", "Nº da NC"]
+
 
 # ============================================================
 # 1. Funções auxiliares
 # ============================================================
 
-def normalizar_monetario_para_float(valor) -> float:
-    if valor is None:
-        return 0.0
-
-    if isinstance(valor, (int, float)) and not pd.isna(valor):
-        return float(valor)
-
-    v = str(valor).strip()
-    if not v or v.lower() in ("nan", "none"):
-        return 0.0
-
-    v = re.sub(r"[^\d,.\-]", "", v)
-    if not v:
-        return 0.0
-
-    negativo = "-" in v
-    v = v.replace("-", "")
-
-    if "." in v and "," in v:
-        last = max(v.rfind("."), v.rfind(","))
-        inteiro = re.sub(r"[.,]", "", v[:last]) or "0"
-        dec = re.sub(r"\D", "", v[last + 1:])
-        dec = (dec + "00")[:2]
-        num = float(f"{inteiro}.{dec}")
-    elif "," in v:
-        partes = v.split(",")
-        inteiro = re.sub(r"\D", "", "".join(partes[:-1])) if len(partes) > 1 else re.sub(r"\D", "", partes[0])
-        inteiro = inteiro or "0"
-        dec = re.sub(r"\D", "", partes[-1]) if len(partes) > 1 else "00"
-        dec = (dec + "00")[:2]
-        num = float(f"{inteiro}.{dec}")
-    elif "." in v:
-        partes = v.split(".")
-        if len(partes[-1]) == 2:
-            inteiro = re.sub(r"\D", "", "".join(partes[:-1])) or "0"
-            dec = re.sub(r"\D", "", partes[-1])
-            num = float(f"{inteiro}.{dec}")
-        else:
-            num = float(re.sub(r"\D", "", v) or 0)
-    else:
-        num = float(v or 0)
-
-    return -num if negativo else num
-
-
-def formatar_valor_pt(valor) -> str:
-    try:
-        return f"{float(valor):.2f}".replace(".", ",")
-    except Exception:
-        return ""
-
-
-def formatar_data_ddmmaaaa(valor: str) -> str:
-    if not valor:
-        return ""
-
-    valor = str(valor).strip()
-
-    if re.fullmatch(r"\d{8}", valor):
-        return f"{valor[6:8]}/{valor[4:6]}/{valor[0:4]}"
-
-    formatos = ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y"]
-    for fmt in formatos:
-        try:
-            return datetime.strptime(valor, fmt).strftime("%d/%m/%Y")
-        except ValueError:
-            pass
-
-    m = re.search(r"(\d{2})[./-](\d{2})[./-](\d{4})", valor)
-    if m:
-        return f"{m.group(1)}/{m.group(2)}/{m.group(3)}"
-
-    m = re.search(r"(\d{4})-(\d{2})-(\d{2})", valor)
-    if m:
-        return f"{m.group(3)}/{m.group(2)}/{m.group(1)}"
-
-    return valor
-
-
 def normalizar_chave(valor) -> str:
     if valor is None:
         return ""
@@ -136,216 +80,35 @@ def criar_chave_linha(row) -> str:
     return f"{nif}|{nc}"
 
 
-def garantir_colunas(df: pd.DataFrame, colunas: List[str]) -> pd.DataFrame:
-    df = df.copy()
-    for c in colunas:
-        if c not in df.columns:
-            df[c] = ""
-    return df[colunas]
-
-
-# ============================================================
-# 2. PDF -> imagem / QR robusto
-# ============================================================
-
-def abrir_pdf_bytes(file_bytes: bytes):
-    return fitz.open(stream=file_bytes, filetype="pdf")
-
-
-def pagina_para_cv2(doc, page_index: int = 0, zoom: float = 3.0) -> np.ndarray:
-    page = doc.load_page(page_index)
-    matriz = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=matriz)
-    mode = "RGBA" if pix.alpha else "RGB"
-    img_pil = Image.frombytes(mode, [pix.width, pix.height], pix.samples)
-    if img_pil.mode == "RGBA":
-        img_pil = img_pil.convert("RGB")
-    return cv2.cvtColor(np.array(img_pil), cv2.COLOR_RGB2BGR)
-
-
-def _order_points(pts: np.ndarray) -> np.ndarray:
-    pts = pts.reshape(4, 2).astype(np.float32)
-    s = pts.sum(axis=1)
-    diff = np.diff(pts, axis=1).reshape(-1)
-
-    tl = pts[np.argmin(s)]
-    br = pts[np.argmax(s)]
-    tr = pts[np.argmin(diff)]
-    bl = pts[np.argmax(diff)]
-
-    return np.array([tl, tr, br, bl], dtype=np.float32)
+def normalizar_chave_serie(serie: pd.Series) -> pd.Series:
+    """normalizar_chave aplicada a uma coluna inteira (vetorizada)."""
+    s = serie.fillna("").astype(str).str.strip()
+    s = s.mask(s.str.lower().isin(["nan", "none"]), "")
+    return s.str.replace(r"\s+", "", regex=True).str.upper()
 
 
-def _warp_quad(image: np.ndarray, quad_pts: np.ndarray, pad: int = 10) -> np.ndarray:
-    pts = _order_points(quad_pts)
+def chaves_dataframe(df: pd.DataFrame) -> pd.Series:
+    """criar_chave_linha para todas as linhas ("Empresa|Nº da NC")."""
+    return normalizar_chave_serie(df["Empresa"]) + "|" + normalizar_chave_serie(df["Nº da NC"])
 
-    w1 = np.linalg.norm(pts[1] - pts[0])
-    w2 = np.linalg.norm(pts[2] - pts[3])
-    h1 = np.linalg.norm(pts[3] - pts[0])
-    h2 = np.linalg.norm(pts[2] - pts[1])
 
-    W = max(int(max(w1, w2)) + pad * 2, 250)
-    H = max(int(max(h1, h2)) + pad * 2, 250)
+def chaves_completas(df: pd.DataFrame) -> pd.Series:
+    """Máscara das linhas com Empresa e Nº da NC preenchidos."""
+    return (normalizar_chave_serie(df["Empresa"]) != "") & (normalizar_chave_serie(df["Nº da NC"]) != "")
 
-    dst = np.array(
-        [[pad, pad], [W - pad - 1, pad], [W - pad - 1, H - pad - 1], [pad, H - pad - 1]],
-        dtype=np.float32,
-    )
-
-    M = cv2.getPerspectiveTransform(pts, dst)
-    return cv2.warpPerspective(image, M, (W, H), flags=cv2.INTER_CUBIC)
-
-
-def _preprocess_variants(bgr: np.ndarray) -> List[np.ndarray]:
-    variants = [bgr]
-
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if len(bgr.shape) == 3 else bgr
-    variants.append(gray)
-
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    g_clahe = clahe.apply(gray)
-    variants.append(g_clahe)
-
-    g_blur = cv2.GaussianBlur(g_clahe, (3, 3), 0)
-
-    thr_adapt = cv2.adaptiveThreshold(
-        g_blur,
-        255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY,
-        31,
-        2,
-    )
-    variants.append(thr_adapt)
-
-    _, thr_otsu = cv2.threshold(g_clahe, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    variants.append(thr_otsu)
-
-    up = cv2.resize(g_clahe, None, fx=3, fy=3, interpolation=cv2.INTER_CUBIC)
-    up_blur = cv2.GaussianBlur(up, (3, 3), 0)
-    up_thr = cv2.adaptiveThreshold(
-        up_blur,
-        255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY,
-        31,
-        2,
-    )
-    variants.append(up_thr)
-
-    blur = cv2.GaussianBlur(g_clahe, (0, 0), sigmaX=1.0)
-    sharp = cv2.addWeighted(g_clahe, 1.6, blur, -0.6, 0)
-    variants.append(sharp)
-
-    up2 = cv2.resize(sharp, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-    variants.append(up2)
-
-    return variants
-
-
-def _decode_with_detector(detector: cv2.QRCodeDetector, img) -> Optional[str]:
-    try:
-        ok, decoded_info, _, _ = detector.detectAndDecodeMulti(img)
-        if ok and decoded_info:
-            for d in decoded_info:
-                if d and d.strip():
-                    return d.strip()
-    except Exception:
-        pass
-
-    try:
-        data, _, _ = detector.detectAndDecode(img)
-        if data and data.strip():
-            return data.strip()
-    except Exception:
-        pass
-
-    return None
 
-
-def ler_qr_robusto(doc, pages_to_try: int = 1) -> Optional[str]:
-    detector = cv2.QRCodeDetector()
-    max_pages = min(pages_to_try, doc.page_count)
-    zooms = [3.0, 4.0, 2.5, 5.0]
-
-    for p in range(max_pages):
-        for zoom in zooms:
-            try:
-                img_bgr = pagina_para_cv2(doc, page_index=p, zoom=zoom)
-            except Exception:
-                continue
-
-            for var in _preprocess_variants(img_bgr):
-                data = _decode_with_detector(detector, var)
-                if data:
-                    return data
-
-            try:
-                gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-                ok, pts = detector.detect(gray)
-                if ok and pts is not None and len(pts) >= 4:
-                    warped = _warp_quad(img_bgr, pts, pad=20)
-                    for var in _preprocess_variants(warped):
-                        data = _decode_with_detector(detector, var)
-                        if data:
-                            return data
-            except Exception:
-                pass
-
-    return None
+def garantir_colunas(df: pd.DataFrame, colunas: List[str]) -> pd.DataFrame:
+    df = df.copy()
+    for c in colunas:
+        if c not in df.columns:
+            df[c] = ""
+    return df[colunas]
 
 
 # ============================================================
-# 3. Extração de dados
+# 2. Extração de dados
 # ============================================================
 
-def extrair_texto_doc(doc) -> str:
-    texto_total = []
-    for page in doc:
-        texto_total.append(page.get_text("text"))
-    return "\n".join(texto_total)
-
-
-def extrair_qr_string_do_texto(texto: str) -> Optional[str]:
-    if not texto:
-        return None
-
-    t = re.sub(r"\s+", " ", texto).strip()
-
-    m = re.search(r"\bA:.*?\bB:.*?\bF:", t)
-    if m:
-        return t[m.start():].strip()
-
-    m = re.search(r"\bA:.*?\bB:", t)
-    if m:
-        return t[m.start():].strip()
-
-    return None
-
-
-def parse_qr_at(data: str) -> dict:
-    if not data:
-        return {}
-
-    s = str(data).replace("|", "*")
-    s = re.sub(r"\s+", "", s)
-    parts = [p for p in s.split("*") if p]
-
-    res = {}
-    for p in parts:
-        if ":" not in p:
-            continue
-        k, v = p.split(":", 1)
-        if k and len(k) == 1 and k.isalpha():
-            res[k.upper()] = v
-
-    return res
-
-
-def normalizar_nif(nif: str) -> str:
-    return re.sub(r"\D", "", str(nif or "").upper().replace("PT", ""))
-
-
 def obter_nif_emissor_qr(campos_qr: dict) -> str:
     if not campos_qr:
         return ""
@@ -432,100 +195,130 @@ def extrair_valor_nc_texto(texto: str) -> str:
     return ""
 
 
-def processar_pdf_nc(nome_ficheiro: str, ficheiro_bytes: bytes, pages_to_try: int = 1) -> dict:
-    doc = abrir_pdf_bytes(ficheiro_bytes)
+def completar_campos_nc(texto: str, numero_nc: str, data_nc: str, valor: str) -> tuple:
+    """Preenche pelo texto os campos da NC que o QR não deu."""
+    if not numero_nc:
+        numero_nc = extrair_numero_nc_texto(texto)
 
-    try:
-        texto = extrair_texto_doc(doc)
-        campos_qr = {}
-        origem = "Texto"
-        qr_raw = ""
-
-        qr_str = extrair_qr_string_do_texto(texto)
-        if qr_str:
-            campos_qr = parse_qr_at(qr_str)
-            if campos_qr:
-                origem = "QR texto oculto"
-                qr_raw = qr_str
+    if not data_nc:
+        data_nc = extrair_data_nc_texto(texto)
 
-        if not campos_qr:
-            qr_img = ler_qr_robusto(doc, pages_to_try=pages_to_try)
-            if qr_img and "A:" in qr_img:
-                campos_qr = parse_qr_at(qr_img)
-                if campos_qr:
-                    origem = "QR imagem"
-                    qr_raw = qr_img
+    if not valor or valor == "0,00":
+        valor = extrair_valor_nc_texto(texto)
 
-        nif_emissor = obter_nif_emissor_qr(campos_qr)
+    return numero_nc, data_nc, valor
 
-        # Empresa fica com o NIF do emissor, conforme definido.
-        empresa = nif_emissor
 
-        numero_nc = ""
-        data_nc = ""
-        valor = ""
+def processar_pdf_nc(
+    nome_ficheiro: str,
+    ficheiro_bytes: bytes,
+    pages_to_try: int = 1,
+    cascata: Optional[CascataQR] = None,
+    cache: Optional[CachePDF] = None,
+    vigilante: Optional[VigilanteExtracao] = None,
+    textos: Optional[List[Optional[str]]] = None,
+) -> dict:
+    # Só a extração (texto + QR) vai para a cache; a interpretação dos campos
+    # corre sempre, porque também depende do nome do ficheiro.
+    # `textos`: páginas já lidas pela sonda, para a extração não as reler.
+    conteudo = extrair_pdf(
+        ficheiro_bytes, pages_to_try=pages_to_try, cascata=cascata, cache=cache, vigilante=vigilante,
+        textos=textos,
+    )
+    return interpretar_nc(nome_ficheiro, conteudo, lambda: ler_texto_completo(conteudo, ficheiro_bytes))
+
 
+def interpretar_nc(
+    nome_ficheiro: str, conteudo: dict, texto_completo: Optional[Callable[[], str]] = None
+) -> dict:
+    """
+    Campos da NC a partir do conteúdo extraído ({"texto", "qr_imagem"}).
+    `texto_completo` devolve o texto do documento todo; só é chamado se
+    algum fallback não encontrar o campo nas páginas já lidas.
+    """
+    texto = conteudo["texto"]
+    campos_qr = {}
+    origem = "Texto"
+    qr_raw = ""
+
+    qr_str = extrair_qr_string_do_texto(texto)
+    if qr_str:
+        campos_qr = parse_qr_at(qr_str)
         if campos_qr:
-            tipo_doc = (campos_qr.get("D", "") or "").upper().strip()
+            origem = "QR texto oculto"
+            qr_raw = qr_str
+
+    if not campos_qr:
+        qr_img = conteudo["qr_imagem"]
+        if qr_img and "A:" in qr_img:
+            campos_qr = parse_qr_at(qr_img)
+            if campos_qr:
+                origem = "QR imagem"
+                qr_raw = qr_img
 
-            if tipo_doc and tipo_doc != "NC":
-                origem += f" / Aviso: tipo QR {tipo_doc}"
+    nif_emissor = obter_nif_emissor_qr(campos_qr)
 
-            numero_nc = (campos_qr.get("G", "") or "").strip()
-            data_nc = formatar_data_ddmmaaaa(campos_qr.get("F", ""))
-            valor = formatar_valor_pt(
-                abs(normalizar_monetario_para_float(campos_qr.get("O", "") or campos_qr.get("M", "")))
-            )
+    # Empresa fica com o NIF do emissor, conforme definido.
+    empresa = nif_emissor
 
-        if not numero_nc:
-            numero_nc = extrair_numero_nc_texto(texto)
+    numero_nc = ""
+    data_nc = ""
+    valor = ""
 
-        if not data_nc:
-            data_nc = extrair_data_nc_texto(texto)
+    if campos_qr:
+        tipo_doc = (campos_qr.get("D", "") or "").upper().strip()
 
-        if not valor or valor == "0,00":
-            valor = extrair_valor_nc_texto(texto)
+        if tipo_doc and tipo_doc != "NC":
+            origem += f" / Aviso: tipo QR {tipo_doc}"
 
-        estado = "OK"
-        erro = ""
+        numero_nc = (campos_qr.get("G", "") or "").strip()
+        data_nc = formatar_data_ddmmaaaa(campos_qr.get("F", ""))
+        valor = formatar_valor_pt(
+            abs(normalizar_monetario_para_float(campos_qr.get("O", "") or campos_qr.get("M", "")))
+        )
 
-        if not empresa:
-            estado = "VERIFICAR"
-            erro += "NIF emissor não encontrado. "
+    # Fallbacks pelo texto: primeiro as páginas já lidas, depois o documento todo
+    numero_nc, data_nc, valor = completar_campos_nc(texto, numero_nc, data_nc, valor)
+    if texto_completo is not None and not (numero_nc and data_nc and valor and valor != "0,00"):
+        numero_nc, data_nc, valor = completar_campos_nc(texto_completo(), numero_nc, data_nc, valor)
 
-        if not numero_nc:
-            estado = "VERIFICAR"
-            erro += "Nº da NC não encontrado. "
+    estado = "OK"
+    erro = ""
 
-        if not data_nc:
-            estado = "VERIFICAR"
-            erro += "Data da NC não encontrada. "
+    if not empresa:
+        estado = "VERIFICAR"
+        erro += "NIF emissor não encontrado. "
 
-        if not valor:
-            estado = "VERIFICAR"
-            erro += "Valor não encontrado. "
+    if not numero_nc:
+        estado = "VERIFICAR"
+        erro += "Nº da NC não encontrado. "
 
-        return {
-            "Nome do ficheiro": nome_ficheiro,
-            "Empresa": empresa,
-            "Nº da NC": numero_nc,
-            "Data da NC": data_nc,
-            "Valor": valor,
-            "Valor utilizado": "",
-            "Data de registo no SGICM": "",
-            "Estado": estado,
-            "Erro": erro.strip(),
-            "Origem": origem,
-            "NIF Emissor QR": nif_emissor,
-            "QR bruto": qr_raw,
-        }
+    if not data_nc:
+        estado = "VERIFICAR"
+        erro += "Data da NC não encontrada. "
 
-    finally:
-        doc.close()
+    if not valor:
+        estado = "VERIFICAR"
+        erro += "Valor não encontrado. "
+
+    return {
+        "Nome do ficheiro": nome_ficheiro,
+        "Empresa": empresa,
+        "Nº da NC": numero_nc,
+        "Data da NC": data_nc,
+        "Valor": valor,
+        "Valor utilizado": "",
+        "Data de registo no SGICM": "",
+        "Estado": estado,
+        "Erro": erro.strip(),
+        "Origem": origem,
+        "NIF Emissor QR": nif_emissor,
+        "QR bruto": qr_raw,
+    }
 
 
 # ============================================================
-# 4. Excel existente + acrescentar só novos PDFs
+# 3. Excel existente + acrescentar só novos PDFs
 # ============================================================
 
 def ler_excel_existente(uploaded_excel) -> pd.DataFrame:
@@ -543,35 +336,83 @@ def ler_excel_existente(uploaded_excel) -> pd.DataFrame:
     return df
 
 
-def separar_novos(df_existente: pd.DataFrame, df_extraido: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
-    df_existente = garantir_colunas(df_existente, COLUNAS_EXCEL).copy()
-    df_extraido = garantir_colunas(df_extraido, COLUNAS_EXCEL).copy()
+def ler_indice_pdfs(uploaded_excel) -> pd.DataFrame:
+    """Folha FOLHA_INDICE do Excel existente (vazia se não existir)."""
+    if uploaded_excel is None:
+        return pd.DataFrame(columns=COLUNAS_INDICE)
+
+    uploaded_excel.seek(0)
+    try:
+        df = pd.read_excel(uploaded_excel, sheet_name=FOLHA_INDICE, dtype=str).fillna("")
+    except ValueError:
+        # Excel anterior ao índice
+        return pd.DataFrame(columns=COLUNAS_INDICE)
+
+    df.columns = [str(c).strip() for c in df.columns]
+    return garantir_colunas(df, COLUNAS_INDICE)
+
+
+def normalizar_nome_ficheiro(nome) -> str:
+    return os.path.basename(str(nome or "").strip().replace("\\", "/")).lower()
+
 
-    chaves_existentes = set()
-    for _, row in df_existente.iterrows():
-        chave = criar_chave_linha(row)
-        if chave != "|":
-            chaves_existentes.add(chave)
+def chave_completa(row) -> bool:
+    return bool(normalizar_chave(row.get("Empresa", ""))) and bool(normalizar_chave(row.get("Nº da NC", "")))
 
-    novas = []
-    duplicadas = []
 
-    chaves_novas_na_sessao = set()
+def construir_indice_existente(df_existente: pd.DataFrame, df_indice: pd.DataFrame) -> dict:
+    """
+    Índice do que já está registado, para o pré-filtro:
+      nomes  -> nomes de ficheiro (só indicação, nunca motivo sozinho)
+      hashes -> SHA-256 dos PDFs
+      chaves -> Empresa|Nº da NC
+    Só entram linhas com Empresa e Nº da NC: um PDF que ficou com erro ou
+    por verificar volta a ser lido se for carregado de novo.
+    """
+    nomes = set()
+    chaves = set()
+    hashes = set()
+    for df in (df_existente, df_indice):
+        df = df[chaves_completas(df)]
+        chaves.update(chaves_dataframe(df))
+        nomes.update(n for n in map(normalizar_nome_ficheiro, df["Nome do ficheiro"]) if n)
+        if "Hash PDF" in df.columns:
+            hashes.update(h for h in df["Hash PDF"].fillna("").astype(str).str.strip().str.lower() if h)
+
+    return {"nomes": nomes, "hashes": hashes, "chaves": chaves}
 
-    for _, row in df_extraido.iterrows():
-        chave = criar_chave_linha(row)
 
-        if chave == "|":
-            novas.append(row.to_dict())
-            continue
+def motivo_ja_registado(nome_ficheiro: str, hash_pdf: str, registo: Optional[dict], indice: dict) -> str:
+    """
+    Porque é que o PDF já está registado ("" se não está). Só o hash ou a
+    chave Empresa + Nº da NC confirmam; o nome (scan0001.pdf, NC.pdf...)
+    repete-se entre documentos diferentes e só acompanha o motivo.
+    """
+    if hash_pdf in indice["hashes"]:
+        return "mesmo PDF (hash)"
+    if registo is not None and chave_completa(registo) and criar_chave_linha(registo) in indice["chaves"]:
+        if normalizar_nome_ficheiro(nome_ficheiro) in indice["nomes"]:
+            return "mesma Empresa + Nº da NC (e mesmo nome de ficheiro)"
+        return "mesma Empresa + Nº da NC"
+    return ""
+
 
-        if chave in chaves_existentes or chave in chaves_novas_na_sessao:
-            duplicadas.append(row.to_dict())
-        else:
-            novas.append(row.to_dict())
-            chaves_novas_na_sessao.add(chave)
+def separar_novos(df_existente: pd.DataFrame, df_extraido: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Anti-join por Empresa + Nº da NC. Linhas sem chave contam sempre como
+    novas; uma chave repetida no próprio lote só entra a primeira vez.
+    """
+    df_existente = garantir_colunas(df_existente, COLUNAS_EXCEL)
+    df_extraido = garantir_colunas(df_extraido, COLUNAS_EXCEL).reset_index(drop=True)
 
-    return pd.DataFrame(novas, columns=COLUNAS_EXCEL), pd.DataFrame(duplicadas, columns=COLUNAS_EXCEL)
+    chaves_existentes = set(chaves_dataframe(df_existente))
+    chaves_existentes.discard("|")
+
+    chaves = chaves_dataframe(df_extraido)
+    sem_chave = chaves == "|"
+    duplicada = ~sem_chave & (chaves.isin(chaves_existentes) | chaves.duplicated())
+
+    return df_extraido[~duplicada].reset_index(drop=True), df_extraido[duplicada].reset_index(drop=True)
 
 
 def atualizar_excel(df_existente: pd.DataFrame, df_novas: pd.DataFrame) -> pd.DataFrame:
@@ -584,57 +425,153 @@ def atualizar_excel(df_existente: pd.DataFrame, df_novas: pd.DataFrame) -> pd.Da
     return pd.concat([df_existente, df_novas], ignore_index=True)
 
 
-def escrever_excel(df_final: pd.DataFrame, df_controlo: pd.DataFrame, df_novas: pd.DataFrame, df_duplicadas: pd.DataFrame) -> io.BytesIO:
+# Formato de cada coluna (aplicado por coluna, não célula a célula)
+FORMATOS_COLUNA = {
+    "Nome do ficheiro": "@",
+    "Empresa": "@",
+    "Nº da NC": "@",
+    "Data da NC": "@",
+    "Data de registo no SGICM": "@",
+    "Valor": "#,##0.00",
+    "Valor utilizado": "#,##0.00",
+}
+COLUNAS_MONETARIAS = ["Valor", "Valor utilizado"]
+FOLHAS_DO_LOTE = ["Novas_adicionadas", "Ja_existiam", "Controlo_extracao"]
+
+
+def _valor_para_excel(valor):
+    if isinstance(valor, str) and valor.strip():
+        try:
+            return normalizar_monetario_para_float(valor)
+        except Exception:
+            return valor
+    return valor
+
+
+def preparar_para_excel(df: pd.DataFrame) -> pd.DataFrame:
+    """Colunas monetárias como números (o Excel formata-as com #,##0.00)."""
+    df = df.copy()
+    for c in COLUNAS_MONETARIAS:
+        if c in df.columns:
+            df[c] = df[c].map(_valor_para_excel)
+    return df.astype(object).where(df.notna(), None)
+
+
+def _largura_coluna(df: pd.DataFrame, coluna: str) -> int:
+    max_len = len(str(coluna))
+    if len(df):
+        max_len = max(max_len, int(df[coluna].fillna("").astype(str).str.len().max()))
+    return min(max(max_len + 2, 12), 60)
+
+
+def escrever_excel(
+    df_final: pd.DataFrame,
+    df_controlo: pd.DataFrame,
+    df_novas: pd.DataFrame,
+    df_duplicadas: pd.DataFrame,
+    df_indice: Optional[pd.DataFrame] = None,
+) -> io.BytesIO:
+    """
+    Escreve o Excel completo (primeira vez, ou Excel existente noutro formato).
+    Formatos e larguras são definidos por coluna, sem percorrer as células.
+    """
     buffer = io.BytesIO()
 
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        df_final.to_excel(writer, index=False, sheet_name="NC_APIFARMA_PAYBACK")
-        df_novas.to_excel(writer, index=False, sheet_name="Novas_adicionadas")
-        df_duplicadas.to_excel(writer, index=False, sheet_name="Ja_existiam")
-        df_controlo.to_excel(writer, index=False, sheet_name="Controlo_extracao")
+    folhas = [
+        ("NC_APIFARMA_PAYBACK", df_final),
+        ("Novas_adicionadas", df_novas),
+        ("Ja_existiam", df_duplicadas),
+        ("Controlo_extracao", df_controlo),
+    ]
+    if df_indice is not None:
+        folhas.append((FOLHA_INDICE, df_indice))
 
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
         wb = writer.book
+        fmt_cabecalho = wb.add_format({"bold": True, "align": "center"})
+        formatos = {f: wb.add_format({"num_format": f}) for f in set(FORMATOS_COLUNA.values())}
+
+        for nome, df in folhas:
+            preparar_para_excel(df).to_excel(writer, index=False, sheet_name=nome)
+            ws = writer.sheets[nome]
+            for j, coluna in enumerate(df.columns):
+                ws.set_column(j, j, _largura_coluna(df, coluna), formatos.get(FORMATOS_COLUNA.get(coluna)))
+                ws.write(0, j, coluna, fmt_cabecalho)
+            ws.freeze_panes(1, 0)
+            ws.autofilter(0, 0, len(df), max(len(df.columns) - 1, 0))
 
-        for ws in wb.worksheets:
-            ws.freeze_panes = "A2"
-            ws.auto_filter.ref = ws.dimensions
+    buffer.seek(0)
+    return buffer
 
-            for col_cells in ws.columns:
-                max_len = 0
-                col_letter = col_cells[0].column_letter
 
-                for cell in col_cells:
-                    val = "" if cell.value is None else str(cell.value)
-                    max_len = max(max_len, len(val))
+def _linhas_alinhadas(df: pd.DataFrame, cabecalho: List[str]) -> List[list]:
+    """Linhas do df como listas alinhadas com as colunas da folha (colunas em falta ficam vazias)."""
+    df = preparar_para_excel(df)
+    posicoes = [cabecalho.index(c) if c in cabecalho else None for c in df.columns]
+    linhas = []
+    for valores in df.itertuples(index=False):
+        linha = [None] * len(cabecalho)
+        for pos, v in zip(posicoes, valores):
+            if pos is not None:
+                linha[pos] = v
+        linhas.append(linha)
+    return linhas
+
+
+def acrescentar_excel(
+    uploaded_excel,
+    df_novas: pd.DataFrame,
+    df_controlo: pd.DataFrame,
+    df_duplicadas: pd.DataFrame,
+    df_indice_novos: pd.DataFrame,
+) -> Optional[io.BytesIO]:
+    """
+    Atualiza o Excel existente sem o reescrever: só as linhas novas são
+    acrescentadas à folha principal e ao índice de PDFs, com o formato de
+    cada coluna herdado da última linha; as folhas do lote são substituídas.
+    Devolve None quando o Excel não foi criado por esta página (sem as folhas
+    ou colunas esperadas) — nesse caso usa-se escrever_excel.
+    """
+    uploaded_excel.seek(0)
+    try:
+        livro = LivroXlsx(uploaded_excel.read())
+    except Exception:
+        return None
 
-                    if cell.row == 1:
-                        continue
+    folhas = livro.nomes_folhas
+    if not folhas or any(f not in folhas for f in FOLHAS_DO_LOTE + [FOLHA_INDICE]):
+        return None
 
-                    header = ws.cell(row=1, column=cell.column).value
+    principal = folhas[0]
+    cabecalho = livro.cabecalho(principal)
+    if any(c not in cabecalho for c in COLUNAS_EXCEL) or livro.n_linhas(principal) < 2:
+        return None
 
-                    if header in ["Nome do ficheiro", "Empresa", "Nº da NC", "Data da NC", "Data de registo no SGICM"]:
-                        cell.number_format = "@"
+    # Formato de cada coluna, por nome, a partir da folha principal
+    estilos_principal = livro.estilos_dados(principal)
+    estilo_por_coluna = {c: estilos_principal.get(j) for j, c in enumerate(cabecalho, start=1)}
 
-                    elif header in ["Valor", "Valor utilizado"]:
-                        cell.number_format = "#,##0.00"
-                        if isinstance(cell.value, str) and cell.value.strip():
-                            try:
-                                cell.value = normalizar_monetario_para_float(cell.value)
-                            except Exception:
-                                pass
+    livro.acrescentar(principal, _linhas_alinhadas(garantir_colunas(df_novas, COLUNAS_EXCEL), cabecalho))
 
-                ws.column_dimensions[col_letter].width = min(max(max_len + 2, 12), 60)
+    df_indice_novos = garantir_colunas(df_indice_novos, COLUNAS_INDICE)
+    cab_indice = livro.cabecalho(FOLHA_INDICE) or COLUNAS_INDICE
+    if any(c not in cab_indice for c in COLUNAS_INDICE):
+        return None
+    if livro.n_linhas(FOLHA_INDICE) >= 2:
+        livro.acrescentar(FOLHA_INDICE, _linhas_alinhadas(df_indice_novos, cab_indice))
+    else:
+        livro.substituir(FOLHA_INDICE, COLUNAS_INDICE, _linhas_alinhadas(df_indice_novos, COLUNAS_INDICE))
 
-            for cell in ws[1]:
-                cell.font = cell.font.copy(bold=True)
-                cell.alignment = cell.alignment.copy(horizontal="center")
+    for nome, df in zip(FOLHAS_DO_LOTE, (df_novas, df_duplicadas, df_controlo)):
+        colunas = list(df.columns)
+        estilos = {j: estilo_por_coluna.get(c) for j, c in enumerate(colunas, start=1) if estilo_por_coluna.get(c)}
+        livro.substituir(nome, colunas, _linhas_alinhadas(df, colunas), estilos)
 
-    buffer.seek(0)
-    return buffer
+    return io.BytesIO(livro.guardar())
 
 
 # ============================================================
-# 5. Interface Streamlit
+# 4. Interface Streamlit
 # ============================================================
 
 st.set_page_config(page_title="NC APIFARMA / PAYBACK PDF → Excel", layout="wide")
@@ -649,6 +586,7 @@ O sistema:
 - usa o **NIF do emissor** na coluna **Empresa**;
 - compara por **Empresa + Nº da NC**;
 - **não altera linhas já existentes**;
+- ignora logo à partida os PDFs já registados (mesmo nome, mesmo PDF ou mesma Empresa + Nº da NC), sem os voltar a ler;
 - acrescenta apenas as NC que ainda não existem.
 """
 )
@@ -663,11 +601,23 @@ with col_excel:
     )
 
 with col_pdfs:
-    uploaded_files = st.file_uploader(
-        "PDFs das NC",
-        type=["pdf"],
-        accept_multiple_files=True,
+    modo_origem = st.radio(
+        "Origem dos PDFs",
+        ["Ficheiros PDF", "Ficheiro ZIP", "Pasta no servidor"],
+        horizontal=True,
+        help="Para lotes grandes use ZIP ou pasta: os PDFs são lidos e libertados um a um.",
     )
+    uploaded_files, ficheiro_zip, pasta_pdfs = None, None, ""
+    if modo_origem == "Ficheiros PDF":
+        uploaded_files = st.file_uploader(
+            "PDFs das NC",
+            type=["pdf"],
+            accept_multiple_files=True,
+        )
+    elif modo_origem == "Ficheiro ZIP":
+        ficheiro_zip = st.file_uploader("ZIP com os PDFs das NC", type=["zip"])
+    else:
+        pasta_pdfs = st.text_input("Caminho da pasta (inclui subpastas)").strip()
 
 with col_opts:
     pages_to_try = st.number_input(
@@ -676,49 +626,141 @@ with col_opts:
         max_value=10,
         value=1,
     )
+    usar_cache = st.checkbox(
+        "Usar cache",
+        value=True,
+        help="PDFs já processados (mesmo conteúdo) não voltam a ser lidos.",
+    )
+    tempo_max_doc = st.number_input(
+        "Tempo máx. por PDF (s)",
+        min_value=0,
+        max_value=600,
+        value=TEMPO_MAX_DOC_S,
+        help="PDFs que excedam o tempo ficam com ERRO \"timeout\". 0 = sem limite.",
+    )
+    pre_filtro = st.checkbox(
+        "Saltar já registados",
+        value=True,
+        help="Ignora, antes de ler, PDFs já no Excel (mesmo conteúdo ou mesma Empresa + Nº da NC).",
+    )
 
-if uploaded_files:
-    st.info(f"{len(uploaded_files)} PDF(s) carregado(s).")
+if uploaded_files or ficheiro_zip is not None or pasta_pdfs:
+    if uploaded_files:
+        st.info(f"{len(uploaded_files)} PDF(s) carregado(s).")
 
     if st.button("🚀 Atualizar / Criar Excel", type="primary"):
+        try:
+            if ficheiro_zip is not None:
+                total_pdfs, fonte = pdfs_de_zip(ficheiro_zip)
+            elif pasta_pdfs:
+                total_pdfs, fonte = pdfs_de_pasta(pasta_pdfs)
+            else:
+                total_pdfs, fonte = pdfs_de_uploads(uploaded_files)
+        except Exception as e:
+            st.error(f"Não foi possível abrir a origem dos PDFs: {e}")
+            st.stop()
+
+        if total_pdfs == 0:
+            st.warning("Não foram encontrados PDFs na origem indicada.")
+            st.stop()
+
+        df_existente = ler_excel_existente(excel_existente)
+        df_indice = ler_indice_pdfs(excel_existente)
+        indice = construir_indice_existente(df_existente, df_indice) if pre_filtro else None
+
         progress = st.progress(0)
         registos = []
-
-        for i, f in enumerate(uploaded_files):
-            try:
-                registos.append(processar_pdf_nc(f.name, f.read(), pages_to_try=int(pages_to_try)))
-            except Exception as e:
-                registos.append({
-                    "Nome do ficheiro": f.name,
-                    "Empresa": "",
-                    "Nº da NC": "",
-                    "Data da NC": "",
-                    "Valor": "",
-                    "Valor utilizado": "",
-                    "Data de registo no SGICM": "",
-                    "Estado": "ERRO",
-                    "Erro": str(e),
-                    "Origem": "Erro",
-                    "NIF Emissor QR": "",
-                    "QR bruto": "",
-                })
-
-            progress.progress((i + 1) / len(uploaded_files))
+        ja_registados = []
+        # Uma cascata por lote: as combinações que resultam passam para a frente
+        cascata = CascataQR()
+        cache = CachePDF(NOME_EXTRATOR, VERSAO_EXTRATOR) if usar_cache else None
+        # Cada PDF num processo à parte, com limite de tempo (0 = sem limite)
+        vigilante = VigilanteExtracao(tempo_max_s=float(tempo_max_doc)) if tempo_max_doc else None
+
+        # Um PDF de cada vez: lido, processado e libertado antes do seguinte
+        try:
+            for i, (nome, ler) in enumerate(fonte):
+                try:
+                    dados = ler()
+                    hash_pdf = sha256_bytes(dados)
+
+                    # Pré-filtro: hash e (se a sonda barata chegar) Empresa + Nº da NC,
+                    # antes de qualquer renderização
+                    reg = None
+                    textos = []
+                    if indice is not None:
+                        motivo = motivo_ja_registado(nome, hash_pdf, None, indice)
+                        if not motivo:
+                            conteudo = sondar_pdf(dados, pages_to_try=int(pages_to_try), cache=cache, textos=textos)
+                            if conteudo is not None:
+                                reg = interpretar_nc(nome, conteudo, lambda: ler_texto_completo(conteudo, dados))
+                                motivo = motivo_ja_registado(nome, hash_pdf, reg, indice)
+                        if motivo:
+                            ja_registados.append({"Nome do ficheiro": nome, "Hash PDF": hash_pdf, "Motivo": motivo})
+                            continue
+
+                    if reg is None:
+                        reg = processar_pdf_nc(
+                            nome,
+                            dados,
+                            pages_to_try=int(pages_to_try),
+                            cascata=cascata,
+                            cache=cache,
+                            vigilante=vigilante,
+                            textos=textos or None,
+                        )
+                    reg["Hash PDF"] = hash_pdf
+                    registos.append(reg)
+                except Exception as e:
+                    registos.append({
+                        "Nome do ficheiro": nome,
+                        "Empresa": "",
+                        "Nº da NC": "",
+                        "Data da NC": "",
+                        "Valor": "",
+                        "Valor utilizado": "",
+                        "Data de registo no SGICM": "",
+                        "Estado": "ERRO",
+                        "Erro": str(e),
+                        "Origem": "Erro",
+                        "NIF Emissor QR": "",
+                        "QR bruto": "",
+                    })
+                finally:
+                    progress.progress((i + 1) / total_pdfs, text=f"{i + 1}/{total_pdfs} — {nome}")
+        finally:
+            if vigilante is not None:
+                vigilante.fechar()
 
         progress.empty()
 
+        resumo_qr = cascata.resumo()
+        if resumo_qr:
+            st.caption(resumo_qr)
+        if cache is not None:
+            st.caption(cache.resumo())
+        if vigilante is not None:
+            st.caption(vigilante.resumo())
+
         df_controlo = pd.DataFrame(registos)
         df_controlo = garantir_colunas(df_controlo, COLUNAS_CONTROLO)
+        df_ja_registados = pd.DataFrame(ja_registados, columns=["Nome do ficheiro", "Hash PDF", "Motivo"])
 
         df_extraido = df_controlo[COLUNAS_EXCEL].copy()
-        df_existente = ler_excel_existente(excel_existente)
 
         df_novas, df_duplicadas = separar_novos(df_existente, df_extraido)
         df_final = atualizar_excel(df_existente, df_novas)
 
+        # Índice: PDFs lidos nesta execução com Empresa + Nº da NC, ainda não indexados
+        df_indice_novos = garantir_colunas(df_controlo[chaves_completas(df_controlo)], COLUNAS_INDICE)
+        df_indice_novos = df_indice_novos[~df_indice_novos["Hash PDF"].isin(set(df_indice["Hash PDF"]))]
+        df_indice_novos = df_indice_novos.drop_duplicates(subset=["Hash PDF"])
+
         st.subheader("Resultado")
         st.success(f"{len(df_novas)} nova(s) NC adicionada(s).")
         st.info(f"{len(df_duplicadas)} NC já existia(m) e não foram mexidas.")
+        if not df_ja_registados.empty:
+            st.info(f"{len(df_ja_registados)} PDF(s) já registado(s) ignorado(s) pelo pré-filtro, sem leitura completa.")
 
         problemas = df_controlo[df_controlo["Estado"] != "OK"].copy()
         if not problemas.empty:
@@ -733,11 +775,20 @@ if uploaded_files:
 
         with st.expander("PDFs ignorados porque já existiam"):
             st.dataframe(df_duplicadas, use_container_width=True)
+            if not df_ja_registados.empty:
+                st.caption("Ignorados pelo pré-filtro:")
+                st.dataframe(df_ja_registados, use_container_width=True)
 
         with st.expander("Controlo da extração"):
             st.dataframe(df_controlo, use_container_width=True)
 
-        buffer = escrever_excel(df_final, df_controlo, df_novas, df_duplicadas)
+        # Com Excel existente, só se acrescentam as linhas novas; o histórico fica intacto
+        buffer = None
+        if excel_existente is not None:
+            buffer = acrescentar_excel(excel_existente, df_novas, df_controlo, df_duplicadas, df_indice_novos)
+        if buffer is None:
+            df_indice = pd.concat([df_indice, df_indice_novos], ignore_index=True)
+            buffer = escrever_excel(df_final, df_controlo, df_novas, df_duplicadas, df_indice)
 
         nome_saida = f"NC_APIFARMA_PAYBACK_ATUALIZADO_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
 
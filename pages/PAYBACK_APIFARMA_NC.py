@@ -1,11 +1,19 @@
+import hashlib
 import os
 import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from io import StringIO, BytesIO
 from typing import List, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from codificacao import descodificar, detetar_dialeto
+from indice_entidades import IndiceEntidades
 
 
 # =====================================================
@@ -25,6 +33,9 @@ def get_mapping_path(default_path: str) -> str:
 MAPPING_CSV_PATH = get_mapping_path("mapeamento_entidades_nc.csv")
 ENTIDADE_PADRAO = "999"
 
+# Ficheiros lidos em simultâneo no modo lote
+MAX_FICHEIROS_PARALELO = 8
+
 
 # =====================================================
 # 2. Cabeçalhos EXACTOS do ficheiro de importação
@@ -99,40 +110,29 @@ def limpar_nome_coluna(col: str) -> str:
     return col
 
 
-def obter_mapa_empresas(mapping_df: pd.DataFrame) -> Dict[str, str]:
-    """Cria dicionário de mapeamento Empresa → Entidade."""
-    map_dict: Dict[str, str] = {}
-    for _, row in mapping_df.iterrows():
-        emp = normalizar_texto(row["Empresa"])
-        # A Entidade é lida como string para evitar problemas de formatação
-        ent = str(row["Entidade"]).strip() 
-        if not emp or not ent or ent.lower() in ("nan", "none"):
-            continue
-        
-        # Limpar o formato float se tiver sido lido do mapeamento
-        if ent.endswith(".0"):
-            ent = ent[:-2]
-            
-        map_dict[emp] = ent
-    return map_dict
-
-
 def separar_por_entidade(
     df_nc: pd.DataFrame, 
-    mapping_df: pd.DataFrame
+    mapping_df: pd.DataFrame,
+    indice: IndiceEntidades = None,
 ) -> Dict[str, Tuple[pd.DataFrame, List[str]]]:
-    """Separa o DataFrame por entidade."""
-    map_dict = obter_mapa_empresas(mapping_df)
-    
-    def get_entidade_para_linha(empresa):
-        emp_norm = normalizar_texto(empresa)
-        return map_dict.get(emp_norm, ENTIDADE_PADRAO)
-    
+    """
+    Separa o DataFrame por entidade. Cada empresa distinta é procurada uma
+    vez no índice: exata, pela chave normalizada (acentos, pontuação,
+    sufixos societários) e, por fim, a mais semelhante acima do limiar.
+    """
+    if indice is None:
+        indice = IndiceEntidades.de_dataframe(mapping_df)
+
     df_nc = df_nc.copy()
-    df_nc['_entidade_calculada'] = df_nc['Empresa'].apply(get_entidade_para_linha)
+    empresas_norm = df_nc['Empresa'].map(normalizar_texto)
+    correspondencias = {emp: indice.procurar(emp) for emp in empresas_norm.unique()}
+    df_nc['_entidade_calculada'] = empresas_norm.map(
+        {emp: c.entidade or ENTIDADE_PADRAO for emp, c in correspondencias.items()}
+    )
     
     resultado = {}
     empresas_sem_mapa = []
+    empresas_aproximadas = []
     
     for entidade in df_nc['_entidade_calculada'].unique():
         df_ent = df_nc[df_nc['_entidade_calculada'] == entidade].copy()
@@ -141,12 +141,16 @@ def separar_por_entidade(
         )
         
         for emp in empresas_desta_ent:
-            if emp not in map_dict:
+            c = correspondencias[emp]
+            if c.entidade is None:
                 empresas_sem_mapa.append(emp)
+            elif c.tipo == "aproximada":
+                empresas_aproximadas.append((emp, c.empresa_mapa, c.semelhanca))
         
         resultado[entidade] = (df_ent.drop(columns=['_entidade_calculada']), empresas_desta_ent)
     
     resultado['_empresas_sem_mapa'] = empresas_sem_mapa
+    resultado['_empresas_aproximadas'] = empresas_aproximadas
     return resultado
 
 
@@ -208,29 +212,16 @@ def ler_notas_credito(file) -> pd.DataFrame:
     else:
         file.seek(0)
         raw = file.read()
-        text = None
-        
-        for enc in ["utf-16", "utf-16-le", "utf-16-be", "utf-8", "utf-8-sig", "latin-1", "cp1252", "iso-8859-1"]:
-            try:
-                text = raw.decode(enc)
-                break
-            except (UnicodeDecodeError, AttributeError):
-                continue
-
-        if text is None:
+        try:
+            # Codificação pelo BOM/prefixo, uma só descodificação
+            text, _ = descodificar(raw, alternativas=("latin-1",))
+        except UnicodeDecodeError:
             raise ValueError(f"Não foi possível decodificar '{file.name}'.")
 
-        if text.startswith('\ufeff'):
-            text = text[1:]
-
-        lines = text.splitlines()
-        if not lines:
+        if not text.strip():
             raise ValueError("Ficheiro vazio.")
-            
-        first_line = lines[0]
-        skip = 1 if first_line.lower().strip().startswith(('sep=', '"sep=')) else 0
-        sep = ";" if ";" in first_line else ("," if "," in first_line else "\t")
 
+        sep, skip = detetar_dialeto(text)
         df = pd.read_csv(StringIO(text), sep=sep, skiprows=skip)
 
     df = df.dropna(axis=1, how='all')
@@ -264,6 +255,48 @@ def ler_notas_credito(file) -> pd.DataFrame:
     return df_nc
 
 
+def hash_conteudo(dados: bytes) -> str:
+    """SHA-256 do conteúdo (chave da cache de ficheiros lidos)."""
+    return hashlib.sha256(dados).hexdigest()
+
+
+def versao_mapeamento(path: str = MAPPING_CSV_PATH) -> str:
+    """Hash do CSV de mapeamento: mudar o mapa invalida as separações em cache."""
+    with open(path, "rb") as fh:
+        return hash_conteudo(fh.read())
+
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def indice_entidades(versao_mapa: str, _mapping_df: pd.DataFrame) -> IndiceEntidades:
+    """Índice Empresa → Entidade, construído uma vez por versão do mapeamento."""
+    return IndiceEntidades.de_dataframe(_mapping_df)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def analisar_ficheiro_nc(
+    nome: str,
+    hash_ficheiro: str,
+    versao_mapa: str,
+    _dados: bytes,
+    _mapping_df: pd.DataFrame,
+    _indice: IndiceEntidades = None,
+) -> Tuple[pd.DataFrame, Dict[str, Tuple[pd.DataFrame, List[str]]], List[str], List[Tuple[str, str, float]]]:
+    """
+    Lê um ficheiro de NC e separa-o por entidade, uma única vez por conteúdo:
+    a cache é indexada pelo hash do ficheiro (e do mapeamento), e serve a
+    pré-visualização, a conversão e os reruns do Streamlit.
+    Devolve (df_nc, {entidade: (df, empresas)}, empresas_sem_mapa,
+    empresas_aproximadas).
+    """
+    ficheiro = BytesIO(_dados)
+    ficheiro.name = nome
+    df_nc = ler_notas_credito(ficheiro)
+    entidades_dict = separar_por_entidade(df_nc, _mapping_df, _indice)
+    empresas_sem_mapa = entidades_dict.pop('_empresas_sem_mapa', [])
+    empresas_aproximadas = entidades_dict.pop('_empresas_aproximadas', [])
+    return df_nc, entidades_dict, empresas_sem_mapa, empresas_aproximadas
+
+
 def format_yyyymmdd(data_str: str) -> str:
     """Converte data para AAAAMMDD."""
     s = str(data_str).strip()
@@ -298,83 +331,164 @@ def apenas_algarismos(texto: str) -> str:
     return re.sub(r"\D", "", str(texto))
 
 
+# Colunas de valor fixo no ficheiro de importação (as restantes vêm de cada NC)
+VALORES_FIXOS = {
+    "NC": "NC",
+    "Série": "",
+    "Subtipo": "",
+    "classificador economico": "02.01.09.C0.00",
+    "Classificador funcional": "0730",
+    "Fonte de financiamento": "511",
+    "Programa": "015",
+    "Medida": "022",
+    "Projeto": "",
+    "Regionalização": "",
+    "Atividade": "533",
+    "Natureza": "",
+    "Departamento/Atividade": "1",
+    "Conta Debito": "221111",
+    "Conta a Credito": "31826111",
+    "Centro de custo": "",
+    "Observaçoes lançamento": "",
+    "Classificação Orgânica": "121904000",
+    "Litigio": "",
+    "Data Litigio": "",
+    "Data Fim Litigio": "",
+    "Plano Pagamento": "",
+    "Data Plano Pagamento": "",
+    "Data Fim Plano Pag": "",
+    "Pag Factoring": "",
+    "Nº Compromisso Assumido": "",
+    "Projeto Documento": "",
+    "Ano Compromisso Assumido": "",
+    "Série Compromisso Assumido": "",
+}
+
+
+def _por_valor_distinto(coluna: pd.Series, funcao) -> np.ndarray:
+    """
+    Aplica `funcao` ao str() de cada valor distinto da coluna (o mesmo texto
+    que a leitura linha a linha veria) e espalha o resultado pelas linhas.
+    Datas, anos e tranches repetem-se muito: milhares de NC, poucas dezenas de valores.
+    """
+    if coluna.dtype == object:
+        # None e NaN dão textos diferentes ("None"/"nan"): agrupar já pelo texto
+        codigos, distintos = pd.factorize(coluna.map(str).astype(object))
+    else:
+        codigos, distintos = pd.factorize(coluna, use_na_sentinel=False)
+    resultado = np.array([funcao(str(v)) for v in distintos], dtype=object)
+    return resultado[codigos]
+
+
+def _parte_observacao(coluna: pd.Series) -> np.ndarray:
+    """Valor de Ano/Tranche para as observações ("" quando vazio/nan/none)."""
+    def limpar(v: str) -> str:
+        v = v.strip()
+        return "" if v.lower() in ("nan", "none", "") else v
+
+    partes = _por_valor_distinto(coluna, limpar)
+    partes[coluna.isna().to_numpy()] = ""
+    return partes
+
+
 def gerar_dataframe_importacao(
     df_nc: pd.DataFrame,
     entidade: str,
     tipo_nc_prefix: str,
 ) -> pd.DataFrame:
-    """Gera DataFrame final de importação com os novos cabeçalhos limpos."""
-    
-    tem_ano = "Ano" in df_nc.columns
-    tem_tranche = "Tranche" in df_nc.columns
+    """Gera DataFrame final de importação com os novos cabeçalhos limpos (coluna a coluna)."""
+    n = len(df_nc)
     data_contab = today_yyyymmdd()
-    
-    data_dict: Dict[str, List[str]] = {col: [] for col in HEADER}
 
     # --- CORREÇÃO DE FORMATO DA ENTIDADE ---
     entidade_limpa = str(entidade)
     # Remove o ".0" se existir (porque o Pandas o adiciona a números inteiros lidos como float)
     if entidade_limpa.endswith(".0"):
-        entidade_limpa = entidade_limpa[:-2] 
+        entidade_limpa = entidade_limpa[:-2]
     # ---------------------------------------
 
-    for _, row in df_nc.iterrows():
-        data_doc = format_yyyymmdd(row["Data"])
-        valor = float(row["ValorNum"])
-        ref = str(row["N.º / Ref.ª"])
-        numero_nc = apenas_algarismos(ref)
-
-        obs_parts = []
-        if tem_ano and pd.notna(row["Ano"]):
-            ano_val = str(row["Ano"]).strip()
-            if ano_val and ano_val.lower() not in ("nan", "none", ""):
-                obs_parts.append(ano_val)
-        if tem_tranche and pd.notna(row["Tranche"]):
-            tranche_val = str(row["Tranche"]).strip()
-            if tranche_val and tranche_val.lower() not in ("nan", "none", ""):
-                obs_parts.append(tranche_val)
-        
-        observacoes_base = " ".join(obs_parts).strip()
-        observacoes_doc = f"{tipo_nc_prefix} {observacoes_base}".strip() if observacoes_base else tipo_nc_prefix
-
-        # Preencher o dicionário
-        data_dict["NC"].append("NC")
-        data_dict["Entidade"].append(entidade_limpa) # AQUI: Usa o valor corrigido
-        data_dict["Data documento"].append(data_doc)
-        data_dict["Data Contabilistica"].append(data_contab)
-        data_dict["Nº NC"].append(numero_nc)
-        data_dict["Série"].append("")
-        data_dict["Subtipo"].append("")
-        data_dict["classificador economico"].append("02.01.09.C0.00")
-        data_dict["Classificador funcional"].append("0730") 
-        data_dict["Fonte de financiamento"].append("511")
-        data_dict["Programa"].append("015") 
-        data_dict["Medida"].append("022") 
-        data_dict["Projeto"].append("")
-        data_dict["Regionalização"].append("")
-        data_dict["Atividade"].append("533")
-        data_dict["Natureza"].append("")
-        data_dict["Departamento/Atividade"].append("1")
-        data_dict["Conta Debito"].append("221111")
-        data_dict["Conta a Credito"].append("31826111")
-        data_dict["Valor Lançamento"].append(format_valor_port(valor))
-        data_dict["Centro de custo"].append("")
-        data_dict["Observações Documento"].append(observacoes_doc)
-        data_dict["Observaçoes lançamento"].append("")
-        data_dict["Classificação Orgânica"].append("121904000")
-        data_dict["Litigio"].append("")
-        data_dict["Data Litigio"].append("")
-        data_dict["Data Fim Litigio"].append("")
-        data_dict["Plano Pagamento"].append("")
-        data_dict["Data Plano Pagamento"].append("")
-        data_dict["Data Fim Plano Pag"].append("")
-        data_dict["Pag Factoring"].append("")
-        data_dict["Nº Compromisso Assumido"].append("")
-        data_dict["Projeto Documento"].append("")
-        data_dict["Ano Compromisso Assumido"].append("")
-        data_dict["Série Compromisso Assumido"].append("")
-
-    return pd.DataFrame(data_dict, columns=HEADER)
+    # Observações: "<prefixo> <Ano> <Tranche>", só com as partes preenchidas
+    base = np.full(n, "", dtype=object)
+    for col in ("Ano", "Tranche"):
+        if col in df_nc.columns:
+            parte = _parte_observacao(df_nc[col])
+            base = np.where(parte == "", base, np.where(base == "", parte, base + " " + parte))
+    # f"{prefixo} {base}".strip(), com base já sem espaços nas pontas
+    observacoes_doc = np.where(base == "", tipo_nc_prefix, (tipo_nc_prefix + " ").lstrip() + base)
+
+    if n == 0:
+        return pd.DataFrame({col: [] for col in HEADER}, columns=HEADER)
+
+    # Constantes: um escalar por coluna, difundido pelo índice na construção
+    data_dict: Dict[str, object] = dict(VALORES_FIXOS)
+    data_dict["Entidade"] = entidade_limpa
+    data_dict["Data documento"] = _por_valor_distinto(df_nc["Data"], format_yyyymmdd).tolist()
+    data_dict["Data Contabilistica"] = data_contab
+    data_dict["Nº NC"] = (
+        df_nc["N.º / Ref.ª"].map(str).astype("str").str.replace(r"\D", "", regex=True).tolist()
+    )
+    # Igual a format_valor_port, sem o custo de uma chamada por linha
+    data_dict["Valor Lançamento"] = [f"{v:.2f}".replace(".", ",") for v in df_nc["ValorNum"].astype(float).tolist()]
+    data_dict["Observações Documento"] = observacoes_doc.tolist()
+
+    return pd.DataFrame(data_dict, columns=HEADER, index=pd.RangeIndex(n))
+
+
+def analisar_ficheiros(
+    ficheiros: List[Tuple[object, str]],
+    versao_mapa: str,
+    mapping_df: pd.DataFrame,
+    indice: IndiceEntidades,
+) -> List[Tuple[object, str, object]]:
+    """
+    Lê e separa todos os ficheiros em paralelo (cada um passa pela cache de
+    analisar_ficheiro_nc). Devolve [(ficheiro, tipo, resultado ou exceção)]
+    pela ordem de carregamento.
+    """
+    def analisar(item):
+        file, tipo = item
+        dados = file.getvalue()
+        try:
+            resultado = analisar_ficheiro_nc(file.name, hash_conteudo(dados), versao_mapa, dados, mapping_df, indice)
+        except Exception as e:
+            resultado = e
+        return file, tipo, resultado
+
+    if len(ficheiros) <= 1:
+        return [analisar(item) for item in ficheiros]
+
+    # As threads herdam o contexto do script (cache do Streamlit sem avisos)
+    ctx = get_script_run_ctx()
+    n_threads = min(len(ficheiros), MAX_FICHEIROS_PARALELO)
+    with ThreadPoolExecutor(max_workers=n_threads, initializer=lambda: add_script_run_ctx(ctx=ctx)) as ex:
+        return list(ex.map(analisar, ficheiros))
+
+
+def converter_ficheiro_nc(
+    entidades_dict: Dict[str, Tuple[pd.DataFrame, List[str]]],
+    tipo_nc_prefix: str,
+) -> pd.DataFrame:
+    """Linhas de importação de um ficheiro (todas as entidades)."""
+    todas_dfs = [
+        gerar_dataframe_importacao(df_ent, entidade, tipo_nc_prefix)
+        for entidade, (df_ent, empresas) in entidades_dict.items()
+    ]
+    return pd.concat(todas_dfs, ignore_index=True)
+
+
+def nome_ficheiro_saida(nome: str, tipo_nc_prefix: str) -> str:
+    nome_base = os.path.splitext(nome)[0]
+    return f"NC_{tipo_nc_prefix}_{nome_base}_importacao.xlsx"
+
+
+def gerar_zip_importacao(saidas: List[Tuple[str, pd.DataFrame]]) -> bytes:
+    """ZIP com um XLSX por ficheiro, escritos diretamente no ZIP (uma passagem)."""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nome_saida, df_final in saidas:
+            with zf.open(nome_saida, "w") as fh:
+                df_final.to_excel(fh, index=False)
+    return buffer.getvalue()
 
 
 # =====================================================
@@ -430,42 +544,62 @@ if uploaded_payback:
     for f in uploaded_payback:
         ficheiros_para_processar.append((f, "PAYBACK"))
 
+# Cada ficheiro é lido uma vez por conteúdo (cache); pré-visualização e
+# conversão usam o mesmo resultado, também entre reruns.
+versao_mapa = versao_mapeamento(MAPPING_CSV_PATH)
+indice = indice_entidades(versao_mapa, mapping_df)
+analises = analisar_ficheiros(ficheiros_para_processar, versao_mapa, mapping_df, indice)
+
 if ficheiros_para_processar:
     st.header("2️⃣ Pré-visualização")
     preview_rows = []
-    for file, tipo in ficheiros_para_processar:
-        try:
-            df_nc = ler_notas_credito(file)
-            entidades_dict = separar_por_entidade(df_nc, mapping_df)
-            empresas_sem_mapa = entidades_dict.pop('_empresas_sem_mapa', [])
-            
-            entidades_str = ", ".join(sorted(entidades_dict.keys()))
-            formato = df_nc.attrs.get('formato_detectado', 'N/A')
-            
-            status = "✅ OK"
-            if empresas_sem_mapa:
-                status += f" (⚠️ {len(empresas_sem_mapa)} → {ENTIDADE_PADRAO})"
-            
-            preview_rows.append({
-                "Ficheiro": file.name,
-                "Tipo": tipo,
-                "Entidades": entidades_str,
-                "Formato": formato,
-                "NCs": len(df_nc),
-                "Estado": status
-            })
-        except Exception as e:
+    for file, tipo, resultado in analises:
+        if isinstance(resultado, Exception):
             preview_rows.append({
                 "Ficheiro": file.name,
                 "Tipo": tipo,
                 "Entidades": "",
                 "Formato": "",
                 "NCs": 0,
-                "Estado": f"❌ {str(e)[:50]}..."
+                "Estado": f"❌ {str(resultado)[:50]}..."
             })
+            continue
+
+        df_nc, entidades_dict, empresas_sem_mapa, empresas_aproximadas = resultado
+
+        entidades_str = ", ".join(sorted(entidades_dict.keys()))
+        formato = df_nc.attrs.get('formato_detectado', 'N/A')
+
+        status = "✅ OK"
+        if empresas_sem_mapa:
+            status += f" (⚠️ {len(empresas_sem_mapa)} → {ENTIDADE_PADRAO})"
+        if empresas_aproximadas:
+            status += f" (🔎 {len(empresas_aproximadas)} aproximada(s))"
+
+        preview_rows.append({
+            "Ficheiro": file.name,
+            "Tipo": tipo,
+            "Entidades": entidades_str,
+            "Formato": formato,
+            "NCs": len(df_nc),
+            "Estado": status
+        })
 
     st.dataframe(pd.DataFrame(preview_rows), use_container_width=True)
 
+MODOS_SAIDA = {
+    "individual": "Um ficheiro por NC",
+    "consolidado": "Ficheiro de importação consolidado",
+    "zip": "ZIP com um ficheiro por NC",
+}
+modo_saida = st.radio(
+    "Saída",
+    list(MODOS_SAIDA),
+    format_func=MODOS_SAIDA.get,
+    horizontal=True,
+    help="Com muitos ficheiros (fecho do mês), o consolidado ou o ZIP geram um só download.",
+)
+
 process_button = st.button("▶️ Converter ficheiros", type="primary")
 
 if process_button:
@@ -473,65 +607,134 @@ if process_button:
         st.error("❌ Carrega pelo menos um ficheiro.")
     else:
         st.header("3️⃣ Ficheiros gerados")
+        individual = modo_saida == "individual"
         
         todas_empresas_sem_mapa = set()
+        todas_aproximadas = []
+        saidas = []
+        resumo_rows = []
+        progress_bar = st.progress(0.0)
         
-        for file, tipo_nc_prefix in ficheiros_para_processar:
-            st.subheader(f"📄 {file.name} ({tipo_nc_prefix})")
+        for idx, (file, tipo_nc_prefix, resultado) in enumerate(analises):
+            if individual:
+                st.subheader(f"📄 {file.name} ({tipo_nc_prefix})")
             
             try:
-                df_nc = ler_notas_credito(file)
-                entidades_dict = separar_por_entidade(df_nc, mapping_df)
-                empresas_sem_mapa = entidades_dict.pop('_empresas_sem_mapa', [])
+                if isinstance(resultado, Exception):
+                    raise resultado
+                df_nc, entidades_dict, empresas_sem_mapa, empresas_aproximadas = resultado
                 
-                if empresas_sem_mapa:
-                    todas_empresas_sem_mapa.update(empresas_sem_mapa)
-                    st.warning(
-                        f"⚠️ {len(empresas_sem_mapa)} empresa(s) → código {ENTIDADE_PADRAO}: "
-                        f"{', '.join(empresas_sem_mapa)}"
-                    )
-                
-                todas_dfs = []
-                total_notas_ficheiro = 0
-                
-                for entidade, (df_ent, empresas) in entidades_dict.items():
-                    total_notas_ficheiro += len(df_ent)
-                    df_temp = gerar_dataframe_importacao(df_ent, entidade, tipo_nc_prefix)
-                    todas_dfs.append(df_temp)
-                
-                df_final = pd.concat(todas_dfs, ignore_index=True)
+                todas_empresas_sem_mapa.update(empresas_sem_mapa)
+                todas_aproximadas.extend(empresas_aproximadas)
                 
+                df_final = converter_ficheiro_nc(entidades_dict, tipo_nc_prefix)
+                nome_saida = nome_ficheiro_saida(file.name, tipo_nc_prefix)
+                saidas.append((nome_saida, df_final))
                 formato = df_nc.attrs.get('formato_detectado', 'desconhecido')
                 
-                st.success(
-                    f"✅ **Processado!**\n\n"
-                    f"- NCs: {total_notas_ficheiro}\n"
-                    f"- Linhas: {len(df_final)}\n"
-                    f"- Formato: {formato}"
-                )
+                resumo_rows.append({
+                    "Ficheiro": file.name,
+                    "Tipo": tipo_nc_prefix,
+                    "Formato": formato,
+                    "NCs": sum(len(df_ent) for df_ent, _ in entidades_dict.values()),
+                    "Linhas": len(df_final),
+                    "Entidades": len(entidades_dict),
+                    "Sem mapa": len(empresas_sem_mapa),
+                    "Aproximadas": len(empresas_aproximadas),
+                    "Estado": "✅ OK",
+                })
                 
-                with st.expander("👁️ Preview dos dados"):
-                    st.dataframe(df_final.head(20), use_container_width=True)
+                if individual:
+                    if empresas_sem_mapa:
+                        st.warning(
+                            f"⚠️ {len(empresas_sem_mapa)} empresa(s) → código {ENTIDADE_PADRAO}: "
+                            f"{', '.join(empresas_sem_mapa)}"
+                        )
+                    
+                    if empresas_aproximadas:
+                        st.info(
+                            f"🔎 {len(empresas_aproximadas)} empresa(s) associada(s) por semelhança:\n\n"
+                            + "\n".join(
+                                f"- {emp} → {emp_mapa} ({sem:.0%})"
+                                for emp, emp_mapa, sem in empresas_aproximadas
+                            )
+                        )
+                    
+                    st.success(
+                        f"✅ **Processado!**\n\n"
+                        f"- NCs: {resumo_rows[-1]['NCs']}\n"
+                        f"- Linhas: {len(df_final)}\n"
+                        f"- Formato: {formato}"
+                    )
+                    
+                    with st.expander("👁️ Preview dos dados"):
+                        st.dataframe(df_final.head(20), use_container_width=True)
+                    
+                    # GERAR EXCEL XLSX 
+                    buffer = BytesIO()
+                    df_final.to_excel(buffer, index=False)
+                    buffer.seek(0)
+                    
+                    st.download_button(
+                        f"⬇️ Descarregar {nome_saida}",
+                        buffer.getvalue(),
+                        nome_saida,
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key=f"download_{file.name}"
+                    )
                 
-                # GERAR EXCEL XLSX 
+            except Exception as e:
+                resumo_rows.append({
+                    "Ficheiro": file.name,
+                    "Tipo": tipo_nc_prefix,
+                    "Formato": "",
+                    "NCs": 0,
+                    "Linhas": 0,
+                    "Entidades": 0,
+                    "Sem mapa": 0,
+                    "Aproximadas": 0,
+                    "Estado": f"❌ {str(e)[:80]}",
+                })
+                if individual:
+                    st.error(f"❌ Erro: {e}")
+                    st.exception(e)
+            
+            progress_bar.progress((idx + 1) / len(analises))
+        
+        if not individual and saidas:
+            tipos = "_".join(sorted({tipo for _, tipo, _ in analises}))
+            if modo_saida == "consolidado":
+                df_consolidado = pd.concat([df for _, df in saidas], ignore_index=True)
                 buffer = BytesIO()
-                df_final.to_excel(buffer, index=False)
-                buffer.seek(0)
-                
-                nome_base = os.path.splitext(file.name)[0]
-                nome_saida = f"NC_{tipo_nc_prefix}_{nome_base}_importacao.xlsx"
-                
-                st.download_button(
-                    f"⬇️ Descarregar {nome_saida}",
-                    buffer.getvalue(),
-                    nome_saida,
-                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key=f"download_{file.name}"
+                df_consolidado.to_excel(buffer, index=False)
+                nome_saida = f"NC_{tipos}_{date.today():%Y%m}_importacao_consolidada.xlsx"
+                conteudo = buffer.getvalue()
+                mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                st.success(f"✅ {len(saidas)} ficheiro(s) → {len(df_consolidado)} linhas num só ficheiro de importação.")
+            else:
+                nome_saida = f"NC_{tipos}_{date.today():%Y%m}_importacao.zip"
+                conteudo = gerar_zip_importacao(saidas)
+                mime = "application/zip"
+                st.success(f"✅ {len(saidas)} ficheiro(s) de importação no ZIP.")
+            
+            st.download_button(
+                f"⬇️ Descarregar {nome_saida}",
+                conteudo,
+                nome_saida,
+                mime,
+                key=f"download_lote_{modo_saida}",
+            )
+        
+        st.subheader("📋 Resumo por ficheiro")
+        st.dataframe(pd.DataFrame(resumo_rows), use_container_width=True)
+        
+        if todas_aproximadas and not individual:
+            with st.expander(f"🔎 {len(todas_aproximadas)} empresa(s) associada(s) por semelhança"):
+                st.dataframe(
+                    pd.DataFrame(todas_aproximadas, columns=["Empresa", "Empresa no mapeamento", "Semelhança"])
+                    .drop_duplicates(subset=["Empresa"]),
+                    use_container_width=True,
                 )
-                
-            except Exception as e:
-                st.error(f"❌ Erro: {e}")
-                st.exception(e)
         
         if todas_empresas_sem_mapa:
             st.divider()
@@ -6,6 +6,8 @@ from datetime import datetime
 from openpyxl import load_workbook
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 
+from codificacao import descodificar
+
 st.set_page_config(page_title="Importar Ficheiro para Excel", layout="centered")
 
 st.title("Importar ficheiro → Excel (formatado)")
@@ -118,13 +120,10 @@ if uploaded is not None:
     # Lê o ficheiro tentando várias codificações
     raw_bytes = uploaded.read()
     try:
-        text = raw_bytes.decode("utf-8")
+        text, _ = descodificar(raw_bytes, alternativas=("cp1252",))
     except UnicodeDecodeError:
-        try:
-            text = raw_bytes.decode("cp1252")
-        except Exception:
-            st.error("O ficheiro não parece ser de texto legível.")
-            st.stop()
+        st.error("O ficheiro não parece ser de texto legível.")
+        st.stop()
 
     df, df_total = parse_txt(text)
 
@@ -1,10 +1,25 @@
 # -*- coding: utf-8 -*-
+import os
 import re
-from typing import Dict, Tuple, Optional
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Optional
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+from codificacao import descodificar
+from conversor_mcdt import (
+    group_missing,
+    iter_transform_text,
+    normalize_mapping_key,
+    read_lines,
+    scan_missing_conventions,
+)
+
 # =========================================================
 # ⚙️ Configuração
 # =========================================================
@@ -13,6 +28,23 @@ MAPPING_SEPARATOR = ";"
 MAPPING_HEADER_CONV = "Cod. Convencao"
 MAPPING_HEADER_ENTITY = "Cod. Entidade"
 
+# Intervalo mínimo entre atualizações da barra de progresso (segundos)
+PROGRESS_INTERVAL_S = 0.25
+
+# Pastas temporárias com ficheiros convertidos: prefixo e idade (horas) a
+# partir da qual são apagadas (sessões antigas)
+OUTPUT_DIR_PREFIX = "mcdt_"
+OUTPUT_MAX_AGE_H = 12
+
+# Linhas de exemplo (conteúdo completo) guardadas por convenção e ficheiro
+MISSING_SAMPLE_LINES = 5
+
+# Linhas por página na tabela das convenções em falta
+MISSING_TABLE_PAGE_SIZE = 200
+
+MODE_CONVERT = "🚀 Converter ficheiros"
+MODE_SCAN = "🔎 Só procurar convenções em falta"
+
 # =========================================================
 # ⚙️ Estado global
 # =========================================================
@@ -22,38 +54,36 @@ if "mapping_dict" not in st.session_state:
 if "mapping_df" not in st.session_state:
     st.session_state.mapping_df = None
 
-# Estrutura:
+# Estrutura (compacta: uma convenção nova pode aparecer em centenas de
+# milhares de linhas):
 # {
 #   "123456": {
-#       "ficheiro|linha|texto": {
-#           "Convencao": "123456",
-#           "Ficheiro": "ficheiro.txt",
-#           "Linha": 15,
-#           "Conteudo da linha": "..."
+#       "ficheiro.txt": {
+#           "lines": np.array([15, 16, 230, ...]),   # n.º das linhas (1-based), por ordem
+#           "samples": {15: "...", 16: "..."}         # até MISSING_SAMPLE_LINES linhas completas
 #       }
 #   }
 # }
 if "missing_codes" not in st.session_state or not isinstance(st.session_state.missing_codes, dict):
     st.session_state.missing_codes = {}
 
+# Pasta temporária da sessão com os ficheiros convertidos (um por upload,
+# reescrito em cada rerun); os downloads são servidos a partir do disco.
+# Ao criar a pasta de uma sessão nova apagam-se as de sessões antigas.
+if "output_dir" not in st.session_state:
+    limite = time.time() - OUTPUT_MAX_AGE_H * 3600
+    for old_dir in Path(tempfile.gettempdir()).glob(f"{OUTPUT_DIR_PREFIX}*"):
+        try:
+            if old_dir.is_dir() and old_dir.stat().st_mtime < limite:
+                shutil.rmtree(old_dir, ignore_errors=True)
+        except OSError:
+            pass
+    st.session_state.output_dir = tempfile.mkdtemp(prefix=OUTPUT_DIR_PREFIX)
+
 
 # =========================================================
 # ⚙️ Funções auxiliares de normalização
 # =========================================================
-def normalize_mapping_key(value: str) -> str:
-    """
-    Normaliza a convenção apenas para uso interno na app.
-    Mantém o princípio que já existia:
-    - remove tudo o que não é dígito
-    - completa à esquerda até 6 dígitos
-
-    Importante:
-    Isto NÃO altera o valor guardado no CSV exportado.
-    """
-    digits = re.sub(r"\D", "", str(value))
-    return digits.zfill(6) if digits else ""
-
-
 def normalize_entity_value(value: str) -> str:
     """
     Limpa o código de entidade introduzido pelo utilizador,
@@ -132,297 +162,77 @@ def load_default_mapping(
 
 
 # =========================================================
-# 🔍 Regras de layout por código de ficheiro
+# 🔍 Registo das convenções em falta
 # =========================================================
-def get_file_code(line: str) -> str:
-    """
-    Código de ficheiro = 3 primeiras colunas/caracteres da linha.
-    Exemplo:
-        702... = medicamentos
-        902/903/904/906... = layout MCDT/Termas
-    """
-    return line[:3] if len(line) >= 3 else ""
-
-
-def get_token2_rule(file_code: str, token2: str) -> dict:
-    """
-    Define como ler a parte convertível do 2.º token, consoante
-    o código de ficheiro existente nas 3 primeiras colunas da linha.
-
-    Regras conhecidas:
-      - 702: medicamentos
-          token2 = CCCCCCPPPPPPPP
-          parte convertível = 6 primeiros dígitos
-          exemplo: 80089292015442 -> 800892 + 92015442
-
-      - 902/903/904/906: MCDT/Termas
-          token2 = 0CCCCCCPPPPPPPP
-          parte convertível = 7 primeiros dígitos
-          exemplo: 003010092030559 -> 0030100 + 92030559
-
-    Fallback:
-      - se começar por 0 + 6 dígitos, usa regra de 7
-      - caso contrário, tenta regra de 6
-    """
-    if file_code == "702":
-        return {
-            "name": "medicamentos",
-            "convert_len": 6,
-            "has_leading_zero": False,
-        }
-
-    if file_code in {"902", "903", "904", "906"}:
-        return {
-            "name": "mcdt_termas",
-            "convert_len": 7,
-            "has_leading_zero": True,
-        }
-
-    # Fallback automático para ficheiros não catalogados
-    if re.match(r"^0\d{6}", token2):
-        return {
-            "name": "auto_0_6",
-            "convert_len": 7,
-            "has_leading_zero": True,
-        }
-
-    return {
-        "name": "auto_6",
-        "convert_len": 6,
-        "has_leading_zero": False,
-    }
-
-
-# =========================================================
-# 🔍 Detetar convenção em falta
-# =========================================================
-def extract_missing_convention_from_token2(
-    token2: str,
-    file_code: str
-) -> Optional[str]:
-    """
-    Extrai a convenção candidata apenas da parte convertível do 2.º token,
-    de acordo com o código de ficheiro das 3 primeiras colunas.
-    """
-    rule = get_token2_rule(file_code, token2)
-    convert_len = rule["convert_len"]
-
-    if len(token2) < convert_len:
-        return None
-
-    parte_convertivel = token2[:convert_len]
-
-    if rule["has_leading_zero"]:
-        match = re.match(r"^0(\d{6})$", parte_convertivel)
-        if match:
-            return match.group(1)
-        return None
-
-    match = re.match(r"^(\d{6})$", parte_convertivel)
-    if match:
-        return match.group(1)
-
-    return None
-
-
-# =========================================================
-# 🔍 Procurar convenção apenas na parte convertível do token2
-# =========================================================
-def find_mapping_for_token2(
-    token2: str,
-    mapping: Dict[str, str],
-    file_code: str
-) -> Optional[str]:
+def register_missing_lines(
+    filename: str,
+    line_indices: np.ndarray,
+    codes,
+    read_sample: Callable[[List[int]], List[str]]
+) -> Dict[str, np.ndarray]:
     """
-    Procura o código de convenção apenas na parte convertível do 2.º token,
-    escolhendo a regra através do código de ficheiro nas 3 primeiras colunas.
-
-    Medicamentos:
-        80089292015442
-        800892 = convenção
-
-    MCDT/Termas:
-        003010092030559
-        0030100 = 0 + convenção 030100
+    Junta ao registo as linhas (índices 0-based) com convenção em falta.
+    As linhas de cada convenção/ficheiro ficam num array ordenado sem
+    repetições (reruns do Streamlit não duplicam) e só as primeiras
+    MISSING_SAMPLE_LINES guardam o conteúdo, lido com uma só chamada a
+    `read_sample`. Devolve os índices agrupados por convenção.
     """
-    candidate = extract_missing_convention_from_token2(token2, file_code)
-
-    if not candidate:
-        return None
+    groups = group_missing(line_indices, codes)
+    new_samples = {}
 
-    candidate_internal = normalize_mapping_key(candidate)
-
-    if candidate_internal in mapping:
-        return candidate_internal
-
-    return None
-
-# =========================================================
-# 🧩 Transformação + deteção de convenções em falta
-# =========================================================
-def transform_line(
-    line: str,
-    mapping: Dict[str, str],
-    expected_len: int = None
-):
-    original_len = len(line)
-
-    if expected_len is None:
-        expected_len = original_len
-
-    missing_code = None
-
-    # -----------------------------------------------------
-    # 1️⃣ Corrigir Coluna 12
-    # -----------------------------------------------------
-    if len(line) >= 12 and line[11] == "0":
-        line = line[:11] + " " + line[12:]
-
-    # -----------------------------------------------------
-    # 2️⃣ Corrigir CC
-    # -----------------------------------------------------
-    line = re.sub(r"\+93\s\s", "+9197", line)
-
-    # -----------------------------------------------------
-    # 3️⃣ Processar tokens
-    # -----------------------------------------------------
-    file_code = get_file_code(line)
-    parts = line.split(maxsplit=2)
-
-    if len(parts) >= 2:
-        token2 = parts[1]
-
-        # Escolhe a regra pela estrutura/código do ficheiro nas 3 primeiras colunas
-        rule = get_token2_rule(file_code, token2)
-        convert_len = rule["convert_len"]
-
-        # Procura a convenção apenas na parte convertível do token2
-        matched_conv = find_mapping_for_token2(token2, mapping, file_code)
-
-        if matched_conv:
-            ent_code = mapping[matched_conv]
-
-            try:
-                ent7 = f"{int(ent_code):07d}"
-
-                # -------------------------------------------------
-                # Divisão correta do segundo token, dependente do ficheiro:
-                #
-                # Medicamentos, código 702:
-                #   80089292015442
-                #   parte_convertivel = 800892
-                #   parte_fixa        = 92015442
-                #
-                # MCDT/Termas, códigos 902/903/904/906:
-                #   003010092030559
-                #   parte_convertivel = 0030100
-                #   parte_fixa        = 92030559
-                #
-                # Só a parte convertível é substituída.
-                # A parte fixa fica intacta.
-                # -------------------------------------------------
-                parte_convertivel = token2[:convert_len]
-                parte_fixa = token2[convert_len:]
-
-                new_token2 = ent7 + parte_fixa
-
-                # Linhas especiais 903 / 904 / 906
-                if file_code in {"903", "904", "906"} and new_token2.startswith("0"):
-                    new_token2 = new_token2[1:]
-
-                # Nos medicamentos (702), a convenção tem 6 dígitos e a entidade tem 7.
-                # Por isso o token pode crescer 1 carácter. Não se deve cortar aqui.
-                if len(new_token2) < len(token2):
-                    new_token2 = new_token2.ljust(len(token2))
-
-                # Reconstrução segura da linha
-                prefix = line[:line.find(token2)]
-                suffix = line[line.find(token2) + len(token2):]
-
-                line = prefix.rstrip() + " " + new_token2 + suffix
-
-            except Exception:
-                pass
-
-        else:
-            # -------------------------------------------------
-            # 🔍 Só regista como falta a convenção real existente
-            # na parte convertível do token2
-            # -------------------------------------------------
-            candidate = extract_missing_convention_from_token2(token2, file_code)
-
-            if candidate:
-                candidate_internal = normalize_mapping_key(candidate)
-
-                if candidate_internal not in mapping:
-                    missing_code = candidate_internal
-
-    # -----------------------------------------------------
-    # 4️⃣ Remover NIF final
-    # -----------------------------------------------------
-    line = re.sub(r"\s\d{9}\s*$", " ", line)
-
-    # -----------------------------------------------------
-    # 5️⃣ Ajuste do comprimento final
-    # -----------------------------------------------------
-    if len(line) > expected_len:
-        line = line[:expected_len]
-    elif len(line) < expected_len:
-        line = line.ljust(expected_len)
-
-    return line, missing_code
-
-
-# =========================================================
-# 📄 Utilitários de texto
-# =========================================================
-def split_keep_eol(text: str):
-    parts = text.splitlines(keepends=True)
-    out = []
-
-    for p in parts:
-        if p.endswith("\r\n"):
-            out.append((p[:-2], "\r\n"))
-        elif p.endswith("\n"):
-            out.append((p[:-1], "\n"))
-        elif p.endswith("\r"):
-            out.append((p[:-1], "\r"))
-        else:
-            out.append((p, ""))
+    for code, indices in groups.items():
+        per_file = st.session_state.missing_codes.setdefault(code, {})
+        entry = per_file.setdefault(
+            filename, {"lines": np.empty(0, dtype=np.int64), "samples": {}}
+        )
+        entry["lines"] = np.union1d(entry["lines"], indices + 1)
+
+        free = MISSING_SAMPLE_LINES - len(entry["samples"])
+        if free > 0:
+            new = [i for i in indices[:MISSING_SAMPLE_LINES].tolist() if i + 1 not in entry["samples"]]
+            if new[:free]:
+                new_samples[code] = new[:free]
+
+    wanted = [i for indices in new_samples.values() for i in indices]
+    if wanted:
+        bodies = dict(zip(wanted, read_sample(wanted)))
+        for code, indices in new_samples.items():
+            st.session_state.missing_codes[code][filename]["samples"].update(
+                (i + 1, bodies[i]) for i in indices
+            )
 
-    return out
+    return groups
 
 
-def guess_default_eol(text: str) -> str:
-    if "\r\n" in text:
-        return "\r\n"
-    if "\n" in text:
-        return "\n"
-    if "\r" in text:
-        return "\r"
-    return "\n"
+def count_missing_occurrences(code: str) -> int:
+    return sum(len(entry["lines"]) for entry in st.session_state.missing_codes[code].values())
 
 
-def register_missing_code(
-    code: str,
-    filename: str,
-    line_number: int,
-    original_line: str
-):
+def missing_table_page(page: int, page_size: int) -> pd.DataFrame:
     """
-    Guarda a ocorrência sem duplicar em reruns do Streamlit.
+    Uma página da tabela (convenção, ficheiro, linha) lida do registo,
+    sem construir a tabela completa. O conteúdo só existe nas linhas de exemplo.
     """
-    if code not in st.session_state.missing_codes:
-        st.session_state.missing_codes[code] = {}
-
-    occurrence_key = f"{filename}|{line_number}|{original_line}"
-
-    st.session_state.missing_codes[code][occurrence_key] = {
-        "Convencao": convention_for_csv(code),
-        "Ficheiro": filename,
-        "Linha": line_number,
-        "Conteudo da linha": original_line
-    }
+    start, stop = (page - 1) * page_size, page * page_size
+    rows = []
+    offset = 0
+
+    for code in sorted(st.session_state.missing_codes):
+        for filename, entry in sorted(st.session_state.missing_codes[code].items()):
+            lines = entry["lines"]
+            if offset + len(lines) > start and offset < stop:
+                for line_number in lines[max(start - offset, 0):stop - offset].tolist():
+                    rows.append({
+                        "Convencao": convention_for_csv(code),
+                        "Ficheiro": filename,
+                        "Linha": line_number,
+                        "Conteudo da linha": entry["samples"].get(line_number, "")
+                    })
+            offset += len(lines)
+            if offset >= stop:
+                return pd.DataFrame(rows)
+
+    return pd.DataFrame(rows)
 
 
 # =========================================================
@@ -537,59 +347,114 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+mode = st.radio(
+    "Modo",
+    [MODE_CONVERT, MODE_SCAN],
+    horizontal=True,
+    help=(
+        "Só procurar: lista as convenções sem mapeamento em todos os ficheiros, "
+        "sem os converter (muito mais rápido)."
+    )
+)
+
+# Ficheiros convertidos nesta execução (os restantes da pasta são de
+# uploads anteriores e são apagados no fim)
+current_outputs = set()
+
 # =========================================================
-# 🚀 PROCESSAMENTO
+# 🔎 SÓ PROCURAR CONVENÇÕES EM FALTA
 # =========================================================
-if uploaded_files:
-    for f in uploaded_files:
-        content = f.read()
+if uploaded_files and mode == MODE_SCAN:
+    progress = st.progress(0)
+    scan_summary = {}
 
-        try:
-            text = content.decode("utf-8-sig")
-        except UnicodeDecodeError:
-            try:
-                text = content.decode("utf-8")
-            except UnicodeDecodeError:
-                text = content.decode("latin-1")
+    for file_index, f in enumerate(uploaded_files):
+        text, _ = descodificar(f.getvalue(), alternativas=("latin-1",))
 
-        default_eol = guess_default_eol(text)
-        lines = split_keep_eol(text)
+        scan = scan_missing_conventions(text, mapping_dict)
 
-        total = len(lines)
-        progress = st.progress(0)
+        groups = register_missing_lines(
+            f.name,
+            scan.lines,
+            scan.codes,
+            lambda indices: read_lines(text, indices)
+        )
 
-        processed = []
-        missing_found_in_file = set()
+        for code, indices in groups.items():
+            entry = scan_summary.setdefault(
+                code, {"Ocorrencias": 0, "Ficheiros": [], "Primeiras linhas": []}
+            )
+            entry["Ocorrencias"] += len(indices)
+            entry["Ficheiros"].append(f.name)
+            entry["Primeiras linhas"].extend(
+                f"{f.name}:{i + 1}" for i in indices[:MISSING_SAMPLE_LINES].tolist()
+            )
+
+        progress.progress((file_index + 1) / len(uploaded_files))
 
-        for i, (line_body, eol) in enumerate(lines):
+    if scan_summary:
+        st.warning(
+            f"⚠️ {len(scan_summary)} convenções sem mapeamento em "
+            f"{sum(e['Ocorrencias'] for e in scan_summary.values())} linhas."
+        )
+        st.dataframe(
+            pd.DataFrame([
+                {
+                    "Convencao": convention_for_csv(code),
+                    "Ocorrencias": entry["Ocorrencias"],
+                    "Ficheiros": ", ".join(entry["Ficheiros"]),
+                    "Primeiras linhas": ", ".join(entry["Primeiras linhas"][:MISSING_SAMPLE_LINES]),
+                }
+                for code, entry in sorted(scan_summary.items())
+            ]),
+            use_container_width=True,
+            hide_index=True
+        )
+    else:
+        st.success("✅ Todas as convenções dos ficheiros têm mapeamento.")
 
-            if not line_body.strip():
-                processed.append(line_body + eol)
-                continue
+# =========================================================
+# 🚀 PROCESSAMENTO
+# =========================================================
+elif uploaded_files:
+    os.makedirs(st.session_state.output_dir, exist_ok=True)
 
-            new_line, missing_code = transform_line(line_body, mapping_dict)
+    for file_index, f in enumerate(uploaded_files):
+        text, _ = descodificar(f.getvalue(), alternativas=("latin-1",))
 
-            if missing_code:
-                missing_found_in_file.add(missing_code)
+        total = max(text.count("\n") + text.count("\r") - text.count("\r\n"), 1)
+        progress = st.progress(0)
+        last_update = time.monotonic()
 
-                register_missing_code(
-                    code=missing_code,
-                    filename=f.name,
-                    line_number=i + 1,
-                    original_line=line_body
-                )
+        # Conversão em lote (conversor_mcdt): mesmo resultado do ciclo
+        # transform_line linha a linha. Cada bloco é escrito logo no ficheiro
+        # temporário, sem juntar o ficheiro convertido em memória.
+        output_path = Path(st.session_state.output_dir) / f"{file_index}_CORRIGIDO.txt"
+        current_outputs.add(output_path.name)
+        missing_found_in_file = set()
 
-            processed.append(new_line + eol)
+        with open(output_path, "wb") as out:
+            for batch in iter_transform_text(text, mapping_dict):
+                out.write(batch.data)
 
-            if i % 500 == 0 or i == total - 1:
-                progress.progress((i + 1) / total)
+                if batch.missing_codes:
+                    missing_found_in_file.update(batch.missing_codes)
+                    bodies = dict(zip(batch.missing_lines.tolist(), batch.missing_bodies))
 
-        progress.progress(1.0)
+                    register_missing_lines(
+                        f.name,
+                        batch.missing_lines,
+                        batch.missing_codes,
+                        lambda indices: [bodies[i] for i in indices]
+                    )
 
-        output = "".join(processed)
+                now = time.monotonic()
+                if now - last_update >= PROGRESS_INTERVAL_S:
+                    progress.progress(min(batch.lines_done / total, 1.0))
+                    last_update = now
 
-        if not output.endswith(("\n", "\r\n", "\r")):
-            output += default_eol
+        del text
+        progress.progress(1.0)
 
         st.success(f"✅ {f.name} convertido")
 
@@ -599,14 +464,21 @@ if uploaded_files:
                 f"{len(missing_found_in_file)} convenções sem mapeamento."
             )
 
+        # Lido do disco só quando o utilizador carrega no botão
         st.download_button(
             f"📥 Download {f.name}",
-            output.encode("utf-8"),
+            output_path.read_bytes,
             f"CORRIGIDO_{f.name}",
             "text/plain",
             key=f"download_{f.name}"
         )
 
+# Saídas de uploads substituídos ou removidos
+if os.path.isdir(st.session_state.output_dir):
+    for stale_output in Path(st.session_state.output_dir).iterdir():
+        if stale_output.name not in current_outputs:
+            stale_output.unlink(missing_ok=True)
+
 # =========================================================
 # 🧠 UI de atualização dos mapeamentos
 # =========================================================
@@ -617,8 +489,8 @@ if st.session_state.missing_codes:
 
     total_missing_codes = len(st.session_state.missing_codes)
     total_occurrences = sum(
-        len(occurrences)
-        for occurrences in st.session_state.missing_codes.values()
+        count_missing_occurrences(code)
+        for code in st.session_state.missing_codes
     )
 
     st.write(
@@ -627,25 +499,26 @@ if st.session_state.missing_codes:
     )
 
     # -----------------------------------------------------
-    # 📋 Tabela com linhas completas onde ocorreu o erro
+    # 📋 Linhas onde ocorreu o erro (paginadas a partir do registo;
+    # o conteúdo completo só é guardado nas primeiras linhas de cada ficheiro)
     # -----------------------------------------------------
-    all_missing_rows = []
+    if total_occurrences:
+        st.subheader("📋 Linhas onde foram encontradas convenções sem mapeamento")
 
-    for code, occurrences in st.session_state.missing_codes.items():
-        for record in occurrences.values():
-            all_missing_rows.append(record)
+        total_pages = -(-total_occurrences // MISSING_TABLE_PAGE_SIZE)
+        if st.session_state.get("missing_table_page", 1) > total_pages:
+            st.session_state.missing_table_page = total_pages
 
-    if all_missing_rows:
-        df_missing = pd.DataFrame(all_missing_rows)
-        df_missing = df_missing.sort_values(
-            by=["Convencao", "Ficheiro", "Linha"],
-            ascending=[True, True, True]
+        page = st.number_input(
+            f"Página (de {total_pages})",
+            min_value=1,
+            max_value=total_pages,
+            step=1,
+            key="missing_table_page"
         )
 
-        st.subheader("📋 Linhas onde foram encontradas convenções sem mapeamento")
-
         st.dataframe(
-            df_missing,
+            missing_table_page(int(page), MISSING_TABLE_PAGE_SIZE),
             use_container_width=True,
             hide_index=True
         )
@@ -658,7 +531,7 @@ if st.session_state.missing_codes:
     new_entries = {}
 
     for code_internal in sorted(st.session_state.missing_codes.keys()):
-        occurrences_count = len(st.session_state.missing_codes[code_internal])
+        occurrences_count = count_missing_occurrences(code_internal)
         code_display = convention_for_csv(code_internal)
 
         col1, col2, col3 = st.columns([1.2, 2, 1.2])
@@ -7,6 +7,8 @@ import pandas as pd
 import streamlit as st
 from openpyxl.styles import numbers
 
+from codificacao import descodificar
+
 
 POS_NIF_INI = 10
 POS_NIF_FIM = 19
@@ -98,10 +100,7 @@ def ler_dmr_txt(dmr_file):
     conteudo = dmr_file.read()
 
     if isinstance(conteudo, bytes):
-        try:
-            texto = conteudo.decode("utf-8")
-        except UnicodeDecodeError:
-            texto = conteudo.decode("latin-1")
+        texto, _ = descodificar(conteudo, alternativas=("latin-1",))
     else:
         texto = conteudo
 
@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from cache_pdf import PASTA_DADOS_LOCAIS
+
+
+# ============================================================
+# REGISTO PERSISTENTE DE FATURAS EXPORTADAS (P2 / SICC)
+#
+# Cada documento exportado fica registado em SQLite, pela chave:
+#   H:<ATCUD>                      (campo H do QR AT)
+#   A:<NIF emissor>|G:<n.º doc>    (quando não há ATCUD)
+#
+# Antes de construir o ficheiro de exportação, o lote é verificado
+# contra o registo (consulta pela chave primária, O(1) por documento)
+# para a mesma fatura não ser exportada duas vezes em meses diferentes.
+# ============================================================
+
+CAMINHO_REGISTO_FATURAS = os.path.join(PASTA_DADOS_LOCAIS, "registo_faturas.sqlite")
+
+# O SQLite limita o n.º de parâmetros por consulta
+_LOTE_SQL = 500
+
+
+def chave_fatura(atcud: str, nif_emissor: str, num_documento: str) -> str:
+    """Chave do documento ("" se não houver dados para a construir)."""
+    atcud = re.sub(r"\s+", "", str(atcud or "")).upper()
+    if atcud and atcud != "0":
+        return f"H:{atcud}"
+
+    nif = re.sub(r"\D", "", str(nif_emissor or ""))
+    num = re.sub(r"\s+", "", str(num_documento or "")).upper()
+    if nif and num:
+        return f"A:{nif}|G:{num}"
+    return ""
+
+
+class RegistoFaturas:
+    def __init__(self, caminho: str = CAMINHO_REGISTO_FATURAS):
+        self.caminho = caminho
+
+        pasta = os.path.dirname(caminho)
+        if pasta:
+            os.makedirs(pasta, exist_ok=True)
+
+        with closing(self._ligar()) as con, con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documentos (
+                    chave TEXT PRIMARY KEY,
+                    atcud TEXT,
+                    nif_emissor TEXT,
+                    num_documento TEXT,
+                    data TEXT,
+                    total TEXT,
+                    ficheiro TEXT,
+                    lote TEXT,
+                    exportado_em TEXT NOT NULL
+                )
+                """
+            )
+
+    def _ligar(self) -> sqlite3.Connection:
+        # Uma ligação por operação: o Streamlit pode correr o script em threads diferentes.
+        return sqlite3.connect(self.caminho, timeout=30)
+
+    def procurar(self, chaves: Iterable[str]) -> Dict[str, dict]:
+        """Documentos já registados, por chave (só as chaves encontradas)."""
+        chaves = [c for c in dict.fromkeys(chaves) if c]
+        encontrados: Dict[str, dict] = {}
+
+        with closing(self._ligar()) as con:
+            con.row_factory = sqlite3.Row
+            for i in range(0, len(chaves), _LOTE_SQL):
+                parte = chaves[i:i + _LOTE_SQL]
+                marcadores = ",".join("?" * len(parte))
+                for row in con.execute(f"SELECT * FROM documentos WHERE chave IN ({marcadores})", parte):
+                    encontrados[row["chave"]] = dict(row)
+        return encontrados
+
+    def registar(self, documentos: List[dict], lote: Optional[str] = None) -> int:
+        """
+        Regista documentos exportados ({"chave", "atcud", "nif_emissor",
+        "num_documento", "data", "total", "ficheiro"}). Os que já existem
+        ficam como estavam. Devolve o n.º de documentos novos.
+        """
+        agora = datetime.now().isoformat(timespec="seconds")
+        lote = lote or agora
+        linhas = [
+            (
+                d["chave"],
+                d.get("atcud", ""),
+                d.get("nif_emissor", ""),
+                d.get("num_documento", ""),
+                d.get("data", ""),
+                d.get("total", ""),
+                d.get("ficheiro", ""),
+                lote,
+                agora,
+            )
+            for d in documentos
+            if d.get("chave")
+        ]
+        with closing(self._ligar()) as con, con:
+            antes = con.total_changes
+            con.executemany(
+                "INSERT OR IGNORE INTO documentos "
+                "(chave, atcud, nif_emissor, num_documento, data, total, ficheiro, lote, exportado_em) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                linhas,
+            )
+            return con.total_changes - antes